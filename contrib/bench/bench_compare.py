@@ -0,0 +1,182 @@
+#! /usr/bin/env python
+#
+#   bench_compare.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark: compare the contents of files with synctool.compare,
+and with the MD5 loop that synctool used before
+
+    The old loop read 16 kiB at a time from both files, hashed both
+    blocks with MD5, and compared the digests after every block.
+    For files of several sizes, the benchmark compares a pair of equal
+    files, and a pair that differs in the first block. It reports the
+    CPU time, and the number of bytes and reads of both files together.
+    The files are in the page cache; this measures CPU and I/O calls,
+    not the disk.
+    For memory mapped files, the bytes are the size of the regions that
+    are compared, as synctool charges them to its I/O budget; when a
+    region differs early on, fewer pages are actually read.
+
+    usage: bench_compare.py [total MB per case]
+'''
+
+import os
+import sys
+import shutil
+import hashlib
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+import synctool.compare
+import synctool.iobudget
+import synctool.param
+
+# block size of the old loop
+OLD_IO_SIZE = 16 * 1024
+
+# max number of times to compare a pair of files
+MAX_REPEAT = 20000
+
+# file sizes to test
+SIZES = [(1024, '1 kB'), (48 * 1024, '48 kB'), (1024 * 1024, '1 MB'),
+         (64 * 1024 * 1024, '64 MB'), (300 * 1024 * 1024, '300 MB')]
+
+
+def old_compare(f1, f2):
+    '''the lockstep MD5 loop
+    Returns tuple: same, bytes read, number of reads'''
+
+    sum1 = hashlib.md5()
+    sum2 = hashlib.md5()
+    nbytes = nreads = 0
+
+    ended = False
+    while not ended and (sum1.digest() == sum2.digest()):
+        data1 = f1.read(OLD_IO_SIZE)
+        nreads += 1
+        if not data1:
+            ended = True
+        else:
+            nbytes += len(data1)
+            sum1.update(data1)
+
+        data2 = f2.read(OLD_IO_SIZE)
+        nreads += 1
+        if not data2:
+            ended = True
+        else:
+            nbytes += len(data2)
+            sum2.update(data2)
+
+    return sum1.digest() == sum2.digest(), nbytes, nreads
+
+
+def new_compare(f1, f2, size):
+    '''synctool.compare
+    Returns tuple: same, bytes read, number of reads'''
+
+    bytes0 = synctool.iobudget.BYTES_READ
+    reads0 = synctool.iobudget.READS
+    same = synctool.compare.compare_files(f1, f2, size)
+    return (same, synctool.iobudget.BYTES_READ - bytes0,
+            synctool.iobudget.READS - reads0)
+
+
+def make_file(filename, size, first_byte):
+    '''create file of size bytes'''
+
+    block = os.urandom(min(size, 1024 * 1024))
+    with open(filename, 'wb') as f:
+        f.write(first_byte)
+        written = 1
+        while written < size:
+            data = block[:size - written]
+            f.write(data)
+            written += len(data)
+
+
+def cpu_time():
+    '''Returns user + system CPU time of this process'''
+
+    times = os.times()
+    return times[0] + times[1]
+
+
+def run_case(path1, path2, size, repeat):
+    '''compare the files repeat times, with both methods
+    Returns list of two tuples: cpu time, bytes read, reads, same'''
+
+    results = []
+    for method in ('old', 'new'):
+        nbytes = nreads = 0
+        t0 = cpu_time()
+        for _ in xrange(repeat):
+            with open(path1, 'rb') as f1:
+                with open(path2, 'rb') as f2:
+                    if method == 'old':
+                        same, n, r = old_compare(f1, f2)
+                    else:
+                        same, n, r = new_compare(f1, f2, size)
+            nbytes += n
+            nreads += r
+
+        results.append((cpu_time() - t0, nbytes, nreads, same))
+
+    return results
+
+
+def main():
+    '''run the benchmark'''
+
+    if len(sys.argv) > 1:
+        total_mb = int(sys.argv[1])
+    else:
+        total_mb = 600
+
+    # no I/O budget
+    synctool.param.COMPARE_MAX_READ = 0
+    synctool.param.COMPARE_MAX_IOPS = 0
+
+    print '%-7s %-6s %6s  %9s %9s  %8s %8s  %8s %8s' % (
+        'size', 'case', 'repeat', 'old cpu', 'new cpu', 'old MB',
+        'new MB', 'old rd', 'new rd')
+
+    topdir = tempfile.mkdtemp(prefix='bench-compare-')
+    try:
+        for size, label in SIZES:
+            path1 = os.path.join(topdir, 'a')
+            path2 = os.path.join(topdir, 'b')
+            path3 = os.path.join(topdir, 'c')
+            make_file(path1, size, 'a')
+            shutil.copyfile(path1, path2)
+            # differs in the first byte
+            make_file(path3, size, 'c')
+
+            # with small files, it is mostly open() that is measured
+            repeat = max(1, min(MAX_REPEAT, total_mb * 1024 * 1024 / size))
+
+            for case, other in (('equal', path2), ('differ', path3)):
+                old, new = run_case(path1, other, size, repeat)
+                if old[3] != new[3]:
+                    sys.exit('error: the methods do not agree')
+
+                print ('%-7s %-6s %6d  %8.3fs %8.3fs  %8.1f %8.1f  %8d %8d' %
+                       (label, case, repeat, old[0], new[0],
+                        old[1] / 1048576.0, new[1] / 1048576.0, old[2],
+                        new[2]))
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -0,0 +1,124 @@
+#! /usr/bin/env python
+#
+#   bench_ignore.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark: walk an overlay tree of 100k entries with 50 ignore rules,
+using the compiled matcher of synctool.ignore and using the fnmatch loop
+that synctool used before
+
+    usage: bench_ignore.py [number of entries]
+'''
+
+import os
+import sys
+import time
+import shutil
+import fnmatch
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+import synctool.ignore
+import synctool.overlay
+import synctool.param
+
+FILES_PER_DIR = 1000
+
+PLAIN = ['.git', '.svn', 'CVS', 'core', 'Thumbs.db']
+WILDCARDS = ['*.tmp%02d' % i for i in xrange(40)] + [
+    '.*.swp', '*~', '*.orig', '*.rej', '#*#']
+
+
+def make_tree(topdir, num_entries):
+    '''create overlay/all/ with num_entries files'''
+
+    # two out of five are ignored
+    names = ['file%04d._all', 'conf%04d._all', 'data%04d._all',
+             'file%04d.tmp07', '.file%04d.swp']
+    group_dir = os.path.join(topdir, 'overlay', 'all')
+    for i in xrange(num_entries / FILES_PER_DIR):
+        d = os.path.join(group_dir, 'd%03d._all' % i)
+        os.makedirs(d)
+        for j in xrange(FILES_PER_DIR):
+            name = names[j % len(names)] % j
+            open(os.path.join(d, name), 'w').close()
+
+    return os.path.join(topdir, 'overlay')
+
+
+def old_match(rel_dir, name):
+    '''the way the walker matched the rules before'''
+
+    if name in synctool.param.IGNORE_FILES:
+        return synctool.ignore.MATCH_NAME
+
+    for pattern in synctool.param.IGNORE_FILES_WITH_WILDCARDS:
+        if fnmatch.fnmatchcase(name, pattern):
+            return synctool.ignore.MATCH_PATTERN
+
+    return synctool.ignore.NO_MATCH
+
+
+def walk(overlay):
+    '''Returns pair: seconds, number of entries seen'''
+
+    seen = [0]
+
+    def _callback(obj, post_dict, dir_changed, *args):
+        seen[0] += 1
+        return True, False
+
+    t0 = time.time()
+    synctool.overlay.visit(overlay, _callback)
+    return time.time() - t0, seen[0]
+
+
+def main():
+    '''run the benchmark'''
+
+    if len(sys.argv) > 1:
+        num_entries = int(sys.argv[1])
+    else:
+        num_entries = 100000
+
+    synctool.param.MY_GROUPS = ['all']
+    synctool.param.ALL_GROUPS = ['all']
+    synctool.param.IGNORE_FILES = set(PLAIN)
+    synctool.param.IGNORE_FILES_WITH_WILDCARDS = WILDCARDS
+    synctool.param.IGNORE_PATHS = []
+    synctool.param.FULL_PATH = True
+
+    topdir = tempfile.mkdtemp(prefix='bench-ignore-')
+    try:
+        overlay = make_tree(topdir, num_entries)
+        synctool.param.OVERLAY_DIR = overlay
+
+        new_match = synctool.ignore.match
+        for label, func in (('fnmatch loop', old_match),
+                            ('compiled matcher', new_match)):
+            synctool.ignore.match = func
+            best = None
+            for _ in xrange(3):
+                secs, seen = walk(overlay)
+                if best is None or secs < best:
+                    best = secs
+
+            print '%-18s %7.3f s  (%d entries selected)' % (label, best,
+                                                           seen)
+        synctool.ignore.match = new_match
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
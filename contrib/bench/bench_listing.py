@@ -0,0 +1,122 @@
+#! /usr/bin/env python
+#
+#   bench_listing.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark: walk an overlay tree on a slow (network) filesystem,
+with and without listing the directories concurrently
+
+    The latency of the filesystem is simulated by sleeping in every
+    directory listing. The tree has an ignored .git tree and a subtree
+    for another group; neither should be listed.
+
+    usage: bench_listing.py [latency in ms] [threads]
+'''
+
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..', 'src'))
+
+import synctool.dirent
+import synctool.overlay
+import synctool.param
+
+GROUPS = ['node1', 'wn', 'all']
+DIRS_PER_GROUP = 40
+FILES_PER_DIR = 10
+
+
+def make_tree(topdir):
+    '''create the overlay tree
+    Returns path to the overlay dir'''
+
+    overlay = os.path.join(topdir, 'overlay')
+    for group in GROUPS:
+        for i in xrange(DIRS_PER_GROUP):
+            d = os.path.join(overlay, group, 'etc', 'd%02d' % (i / 8),
+                             'sub%02d' % i)
+            os.makedirs(d)
+            for j in xrange(FILES_PER_DIR):
+                open(os.path.join(d, 'f%02d._all' % j), 'w').close()
+
+    # these are never entered by the walk
+    for i in xrange(DIRS_PER_GROUP):
+        os.makedirs(os.path.join(overlay, 'all', '.git', 'objects',
+                                 '%02x' % i))
+        os.makedirs(os.path.join(overlay, 'all', 'opt._other', 'd%02d' % i))
+
+    return overlay
+
+
+def main():
+    '''run the benchmark'''
+
+    if len(sys.argv) > 1:
+        latency = float(sys.argv[1]) / 1000.0
+    else:
+        latency = 0.005
+
+    if len(sys.argv) > 2:
+        threads = int(sys.argv[2])
+    else:
+        threads = 8
+
+    synctool.param.MY_GROUPS = GROUPS
+    synctool.param.ALL_GROUPS = GROUPS + ['other']
+    synctool.param.IGNORE_FILES = set(['.git'])
+    synctool.param.IGNORE_FILES_WITH_WILDCARDS = []
+    synctool.param.IGNORE_PATHS = []
+    synctool.param.FULL_PATH = True
+
+    calls = [0]
+    lock = threading.Lock()
+    real_listdir = synctool.dirent.listdir
+
+    def slow_listdir(path):
+        '''listdir with network latency'''
+
+        with lock:
+            calls[0] += 1
+        time.sleep(latency)
+        return real_listdir(path)
+
+    synctool.dirent.listdir = slow_listdir
+
+    def _callback(obj, post_dict, dir_changed, *args):
+        return True, False
+
+    topdir = tempfile.mkdtemp(prefix='bench-listing-')
+    try:
+        overlay = make_tree(topdir)
+        synctool.param.OVERLAY_DIR = overlay
+
+        print 'latency %.1f ms per directory listing' % (latency * 1000.0)
+        for num in (1, threads):
+            synctool.param.LIST_THREADS = num
+            calls[0] = 0
+            t0 = time.time()
+            synctool.overlay.visit(overlay, _callback)
+            secs = time.time() - t0
+            print '%2d thread(s)  %7.3f s  %d listings' % (num, secs,
+                                                         calls[0])
+    finally:
+        synctool.dirent.listdir = real_listdir
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
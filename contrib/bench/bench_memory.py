@@ -0,0 +1,133 @@
+#! /usr/bin/env python
+#
+#   bench_memory.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark: memory footprint of the objects of an overlay tree walk
+
+    The benchmark walks a synthetic overlay tree with
+    synctool.overlay.visit(). The callback keeps every object, and stats
+    both the source and the destination, as the prefetch pool does.
+    It reports the growth of the max RSS of the process, per entry.
+    The walk runs in a separate process, so that the numbers are not
+    clouded by creating the tree.
+
+    To compare with another version of synctool, pass the src/ dir of
+    a checkout of it with --src, for example:
+      git worktree add /tmp/old <commit>
+      bench_memory.py --src /tmp/old/src
+
+    usage: bench_memory.py [--src DIR] [dirs] [files per dir]
+'''
+
+import os
+import sys
+import shutil
+import getopt
+import tempfile
+import resource
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', 'src')
+
+
+def make_tree(topdir, num_dirs, num_files):
+    '''create the overlay tree
+    Returns path to the overlay dir'''
+
+    overlay = os.path.join(topdir, 'overlay')
+    for i in xrange(num_dirs):
+        d = os.path.join(overlay, 'all', 'bench-memory', 'd%03d' % i)
+        os.makedirs(d)
+        for j in xrange(num_files):
+            open(os.path.join(d, 'f%03d._all' % j), 'w').close()
+
+    return overlay
+
+
+def walk(src_dir, overlay):
+    '''walk the tree, keeping all objects
+    This is the child process'''
+
+    sys.path.insert(0, src_dir)
+
+    import synctool.overlay
+    import synctool.param
+
+    synctool.param.MY_GROUPS = ['all']
+    synctool.param.ALL_GROUPS = set(['all'])
+    synctool.param.IGNORE_FILES = set()
+    synctool.param.IGNORE_FILES_WITH_WILDCARDS = []
+    synctool.param.IGNORE_PATHS = []
+    synctool.param.FULL_PATH = True
+    synctool.param.OVERLAY_DIR = overlay
+    synctool.param.LIST_THREADS = 1
+
+    kept = []
+
+    def _callback(obj, post_dict, dir_changed, *args):
+        '''keep the object'''
+
+        # stat both sides
+        obj.src_stat
+        obj.dest_stat
+        kept.append(obj)
+        return True, False
+
+    rss0 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    synctool.overlay.visit(overlay, _callback)
+    rss1 = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    # ru_maxrss is in kilobytes
+    print '%d entries, max RSS +%d kB (%d bytes/entry)' % (len(kept),
+            rss1 - rss0, (rss1 - rss0) * 1024 / len(kept))
+
+
+def main():
+    '''run the benchmark'''
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], '', ['src=', 'walk='])
+    except getopt.GetoptError as reason:
+        sys.exit('bench_memory.py: %s' % reason)
+
+    src_dir = SRC_DIR
+    for opt, arg in opts:
+        if opt == '--src':
+            src_dir = os.path.abspath(arg)
+        elif opt == '--walk':
+            walk(src_dir, arg)
+            return
+
+    if len(args) > 0:
+        num_dirs = int(args[0])
+    else:
+        num_dirs = 500
+
+    if len(args) > 1:
+        num_files = int(args[1])
+    else:
+        num_files = 200
+
+    topdir = tempfile.mkdtemp(prefix='bench-memory-')
+    try:
+        overlay = make_tree(topdir, num_dirs, num_files)
+        print 'synctool in %s' % os.path.normpath(src_dir)
+        sys.stdout.flush()
+        subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                               '--src', src_dir, '--walk', overlay])
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -0,0 +1,259 @@
+#! /usr/bin/env python
+#
+#   bench_syscalls.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''benchmark: count the filesystem calls of a synctool-client run
+in which nothing changed
+
+    The benchmark sets up a scratch synctool root with an overlay tree,
+    of which the destination is a scratch dir as well. After a first
+    --fix run that installs everything, it counts the calls that the
+    client makes in a few more --fix runs:
+     - with dir_state off; every entry is checked
+     - with dir_state on; the entries and directories that are known
+       to be in sync are skipped
+     - as the master runs the client after a successful rsync:
+       with a manifest and the tree hash
+    The calls are counted in the client process by wrapping the os
+    functions; a directory listing takes a few system calls itself
+    (open, getdents, close).
+
+    usage: bench_syscalls.py [dirs] [files per dir]
+'''
+
+import os
+import sys
+import shutil
+import tempfile
+import subprocess
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                       '..', '..', 'src')
+sys.path.insert(0, SRC_DIR)
+
+GROUPS = ['wn', 'all']
+
+# calls that touch the filesystem
+OS_CALLS = ('lstat', 'stat', 'listdir', 'open', 'access', 'readlink',
+            'chmod', 'chown', 'lchown', 'utime', 'rename', 'unlink',
+            'mkdir', 'link', 'symlink')
+
+# the line in the output of a counted run
+MARKER = 'bench-syscalls:'
+
+
+def make_tree(topdir, num_dirs, num_files):
+    '''create a synctool root dir with an overlay tree, that maps
+    onto topdir/dest'''
+
+    for d in ('bin', 'etc', 'var/overlay', 'var/delete', 'var/purge'):
+        os.makedirs(os.path.join(topdir, d))
+
+    dest = os.path.join(topdir, 'dest')
+    os.mkdir(dest)
+
+    for group in GROUPS:
+        base = os.path.join(topdir, 'var', 'overlay', group)
+        os.mkdir(base)
+
+        # the directories that lead to dest/ exist already;
+        # give them the same mode and owner, or else synctool fixes them
+        path = os.sep
+        for name in dest.split(os.sep)[1:]:
+            path = os.path.join(path, name)
+            d = base + path
+            os.mkdir(d)
+            statbuf = os.lstat(path)
+            os.chmod(d, statbuf.st_mode & 07777)
+            os.chown(d, statbuf.st_uid, statbuf.st_gid)
+
+        for i in xrange(num_dirs):
+            if group != 'all' and i % 4 != 0:
+                continue
+
+            d = os.path.join(base + dest, 'd%02d' % (i / 10),
+                             'sub%03d' % i)
+            os.makedirs(d)
+            for j in xrange(num_files):
+                # wn overrides some of the files of all
+                if group != 'all' and j % 2 != 0:
+                    continue
+
+                with open(os.path.join(d, 'f%03d._%s' % (j, group)),
+                          'w') as f:
+                    f.write('%s %d %d\n' % (group, i, j))
+
+    return dest
+
+
+def write_config(topdir, dir_state):
+    '''write synctool.conf'''
+
+    with open(os.path.join(topdir, 'etc', 'synctool.conf'), 'w') as f:
+        f.write('master n1\n'
+                'node n1 wn hostname:localhost\n'
+                'dir_state %s\n' % ('yes' if dir_state else 'no'))
+
+
+def counted_run(topdir, args):
+    '''run synctool-client in this process, and count its calls
+    This is the child process of run_client()'''
+
+    import atexit
+    import __builtin__
+
+    import synctool.dirent
+    import synctool.main.client
+
+    counts = dict([(name, 0) for name in OS_CALLS])
+
+    def wrap(module, name, key):
+        '''count calls of module.name'''
+
+        func = getattr(module, name)
+
+        def counted(*args, **kwargs):
+            counts[key] += 1
+            return func(*args, **kwargs)
+
+        setattr(module, name, counted)
+
+    for name in OS_CALLS:
+        if name in ('listdir', 'open'):
+            continue
+        if hasattr(os, name):
+            wrap(os, name, name)
+
+    wrap(os, 'listdir', 'listdir')
+    wrap(synctool.dirent, 'listdir', 'listdir')
+    wrap(os, 'open', 'open')
+    wrap(__builtin__, 'open', 'open')
+
+    def report():
+        '''print the counts'''
+
+        sys.stderr.write('%s %s\n' % (MARKER, ' '.join(['%s=%d' % (k, v)
+                                      for k, v in counts.items()])))
+
+    atexit.register(report)
+
+    sys.argv = [os.path.join(topdir, 'bin', 'synctool-client'),
+                '--nodename=n1', '--fix', '--no-post'] + args
+    synctool.main.client.main()
+
+
+def make_tree_hash(topdir):
+    '''make the manifest and tree hash, like the master does
+    This is the child process of run_client()'''
+
+    import synctool.config
+    import synctool.manifest
+    import synctool.param
+
+    sys.argv = [os.path.join(topdir, 'bin', 'synctool-master')]
+    synctool.param.init()
+    synctool.config.read_config()
+    synctool.param.NODENAME = 'n1'
+    synctool.param.MY_GROUPS = synctool.config.get_my_groups()
+    if not (synctool.manifest.make_manifests(['n1']) and
+            synctool.manifest.make_tree_hash()):
+        sys.exit(1)
+
+
+def run_client(topdir, args):
+    '''run synctool-client in a fresh process
+    Returns dict of counts'''
+
+    cmd = [sys.executable, os.path.abspath(__file__), '--run', topdir] + args
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                            stderr=subprocess.PIPE, cwd=topdir)
+    out, err = proc.communicate()
+
+    for line in err.splitlines():
+        if line.startswith(MARKER):
+            return dict([(k, int(v)) for k, v in
+                         [x.split('=') for x in line.split()[1:]]])
+
+    sys.stderr.write(out + err)
+    sys.exit('error: the client run failed')
+
+
+def print_counts(label, counts, base):
+    '''print a line of the report'''
+
+    total = sum(counts.values())
+    print '%-28s %7d %7d %7d %7d %6.1f%%' % (label, counts['lstat'] +
+                                             counts['stat'],
+                                             counts['listdir'],
+                                             counts['open'], total,
+                                             100.0 * total / base)
+
+
+def main():
+    '''run the benchmark'''
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--run':
+        counted_run(sys.argv[2], sys.argv[3:])
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == '--make-tree-hash':
+        make_tree_hash(sys.argv[2])
+        return
+
+    if len(sys.argv) > 1:
+        num_dirs = int(sys.argv[1])
+    else:
+        num_dirs = 100
+
+    if len(sys.argv) > 2:
+        num_files = int(sys.argv[2])
+    else:
+        num_files = 20
+
+    topdir = os.path.realpath(tempfile.mkdtemp(prefix='bench-syscalls-'))
+    try:
+        make_tree(topdir, num_dirs, num_files)
+
+        write_config(topdir, False)
+        # install everything
+        run_client(topdir, [])
+
+        print '%d dirs, %d files per dir' % (num_dirs, num_files)
+        print '%-28s %7s %7s %7s %7s %7s' % ('', 'stat', 'listdir', 'open',
+                                             'total', '')
+
+        full = run_client(topdir, [])
+        base = sum(full.values())
+        print_counts('dir_state off', full, base)
+
+        write_config(topdir, True)
+        # record the state; the second run also records the directories
+        run_client(topdir, [])
+        run_client(topdir, [])
+        print_counts('dir_state on', run_client(topdir, []), base)
+
+        cmd = [sys.executable, os.path.abspath(__file__),
+               '--make-tree-hash', topdir]
+        if subprocess.call(cmd, cwd=topdir) != 0:
+            sys.exit('error: failed to make the tree hash')
+
+        args = ['--manifest', '--tree-hash']
+        run_client(topdir, args)
+        run_client(topdir, args)
+        print_counts('manifest and tree hash', run_client(topdir, args),
+                     base)
+    finally:
+        shutil.rmtree(topdir)
+
+
+if __name__ == '__main__':
+    main()
+
+# EOB
@@ -21,16 +21,19 @@ BUILD_DOCS="no"
 PROGS="synctool_master.py synctool_launch.py
 dsh.py dsh_cp.py dsh_ping.py dsh_pkg.py synctool_config.py
 synctool_aggr.py synctool_client.py synctool_client_pkg.py
-synctool_template.py"
+synctool_template.py synctool_watch.py"
 
 LAUNCHER="synctool_launch.py"
 
-LIBS="__init__.py aggr.py config.py configparser.py lib.py nodeset.py
-object.py overlay.py param.py pkgclass.py range.py syncstat.py unbuffered.py
-update.py upload.py"
+LIBS="__init__.py aggr.py bandwidth.py checkpoint.py compare.py config.py
+configparser.py digest.py dirent.py dirstate.py drift.py executor.py history.py
+ignore.py inotify.py install.py iobudget.py lib.py listing.py manifest.py
+nodeset.py object.py overlay.py param.py pathset.py pkgclass.py plan.py
+postqueue.py prefetch.py purge.py range.py rollout.py saved.py syncstat.py
+tmplcache.py unbuffered.py update.py upload.py"
 
 MAIN_LIBS="__init__.py aggr.py client.py config.py master.py dsh_pkg.py
-client_pkg.py dsh_ping.py dsh_cp.py dsh.py template.py wrapper.py"
+client_pkg.py dsh_ping.py dsh_cp.py dsh.py template.py watch.py wrapper.py"
 
 PKG_LIBS="__init__.py aptget.py brew.py bsdpkg.py pacman.py yum.py zypper.py"
 
@@ -39,7 +42,7 @@ thank_you.md footer.html header.html toc.md synctool_doc.css
 synctool_logo.jpg synctool_logo_large.jpg build.sh"
 
 SYMLINKS="synctool dsh-pkg dsh dsh-cp dsh-ping synctool-config
-synctool-client synctool-client-pkg synctool-template"
+synctool-client synctool-client-pkg synctool-template synctool-watch"
 
 
 if test "x$1" = x
@@ -0,0 +1,198 @@
+#
+#   synctool.bandwidth.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''bandwidth budget for the rsyncs from the master to the nodes
+
+    With rsync_bandwidth, all rsyncs together may use no more than the
+    given number of MB/s. Every rsync gets an even share of what is not
+    in use by the rsyncs that are still running, passed as --bwlimit.
+    So once the run nears its end and fewer nodes are left, the last
+    rsyncs get a larger share. A node can have its own cap with the
+    node specifier bwlimit:.
+    rsync is given --stats, so that the number of bytes sent can be
+    reported at the end of the run. With adaptive_num_proc, rsync is
+    given --stats as well, so that the executor knows the throughput
+    of every rsync.
+'''
+
+import time
+
+from synctool.lib import verbose, stdout
+import synctool.executor
+import synctool.lib
+import synctool.param
+
+# rsync statistics; these lines are not shown if we asked for --stats
+STATS_PREFIXES = ('Number of ', 'Total ', 'Literal data', 'Matched data',
+                  'File list ', 'sent ', 'total size is ')
+BYTES_SENT = 'Total bytes sent:'
+
+# KB/s for all rsyncs together; 0 means no budget
+TOTAL = 0
+
+# the number of rsyncs that may run at the same time
+SLOTS = 1
+
+# the number of rsyncs yet to start
+TO_START = 0
+
+# ALLOCATED[nodename] -> KB/s given to the running rsync of the node
+ALLOCATED = {}
+
+# statistics
+FIRST_START = None
+LAST_DONE = None
+BYTES = 0
+TRANSFERS = 0
+REPORTED = 0
+
+
+def kbps(mbps):
+    '''Returns MB/s as KB/s'''
+
+    return int(mbps * 1024)
+
+
+def setup(num_transfers):
+    '''prepare for num_transfers rsyncs'''
+
+    global TOTAL, SLOTS, TO_START
+
+    TOTAL = kbps(synctool.param.RSYNC_BANDWIDTH)
+
+    if synctool.param.SLEEP_TIME != 0:
+        SLOTS = 1
+    elif synctool.param.ADAPTIVE_NUM_PROC:
+        SLOTS = synctool.param.MAX_NUM_PROC
+    else:
+        SLOTS = max(synctool.param.NUM_PROC, 1)
+
+    TO_START = num_transfers
+
+    if TOTAL > 0:
+        verbose('bandwidth budget %d KB/s for %d transfers' %
+                (TOTAL, num_transfers))
+
+
+def _limit(nodename):
+    '''Returns KB/s for a new rsync to node, or 0 for no limit'''
+
+    if nodename in synctool.param.BWLIMITS:
+        cap = kbps(synctool.param.BWLIMITS[nodename])
+    else:
+        cap = 0
+
+    if TOTAL <= 0:
+        return cap
+
+    free = TOTAL - sum(ALLOCATED.values())
+    slots = max(min(SLOTS - len(ALLOCATED), TO_START), 1)
+    share = free / slots
+    if cap > 0:
+        share = min(share, cap)
+
+    # rsync can not go slower than 1 KB/s
+    return max(share, 1)
+
+
+def rsync_command(cmd_arr, nodename, phase=None):
+    '''Returns Command for rsync to node, with a bandwidth limit
+    The options are put before the '--' in cmd_arr, if any'''
+
+    global TO_START, FIRST_START
+
+    limit = _limit(nodename)
+    if limit <= 0 and TOTAL <= 0 and not synctool.param.ADAPTIVE_NUM_PROC:
+        return synctool.executor.Command(cmd_arr, nodename, phase=phase)
+
+    options = []
+    if limit > 0:
+        options.append('--bwlimit=%d' % limit)
+    own_stats = not '--stats' in cmd_arr
+    if own_stats:
+        options.append('--stats')
+
+    if '--' in cmd_arr:
+        index = cmd_arr.index('--')
+    else:
+        index = len(cmd_arr)
+    cmd_arr = cmd_arr[:index] + options + cmd_arr[index:]
+
+    ALLOCATED[nodename] = limit
+    TO_START = max(TO_START - 1, 0)
+    if FIRST_START is None:
+        FIRST_START = time.time()
+
+    if limit > 0:
+        verbose('rsync to node %s at %d KB/s' % (nodename, limit))
+
+    def _handler(line):
+        '''pick the statistics out of the rsync output'''
+
+        if line.startswith(BYTES_SENT):
+            command.nbytes = _count_bytes(line)
+
+        if own_stats and (not line or line.startswith(STATS_PREFIXES)):
+            return
+
+        synctool.lib.output_with_nodename(line, nodename)
+
+    command = synctool.executor.Command(cmd_arr, nodename, _handler, phase)
+    return command
+
+
+def _count_bytes(line):
+    '''add the number in a 'Total bytes sent:' line
+    Returns the number, or None if it is not a number'''
+
+    global BYTES, REPORTED
+
+    num = line[len(BYTES_SENT):].strip().replace(',', '')
+    try:
+        nbytes = int(num)
+    except ValueError:
+        return None
+
+    BYTES += nbytes
+    REPORTED += 1
+    return nbytes
+
+
+def done(nodename):
+    '''the rsync to node finished'''
+
+    global LAST_DONE, TRANSFERS
+
+    if nodename in ALLOCATED:
+        del ALLOCATED[nodename]
+        TRANSFERS += 1
+        LAST_DONE = time.time()
+
+
+def report():
+    '''show the throughput of the rsyncs'''
+
+    if not TRANSFERS:
+        return
+
+    if not REPORTED:
+        verbose('rsync did not report how many bytes were sent')
+        return
+
+    elapsed = max(LAST_DONE - FIRST_START, 0.001)
+    megabytes = BYTES / 1048576.0
+    msg = ('rsync sent %.1f MB to %d nodes in %.1f s: %.1f MB/s' %
+           (megabytes, REPORTED, elapsed, megabytes / elapsed))
+    if TOTAL > 0:
+        msg += ' (budget %.1f MB/s)' % (TOTAL / 1024.0)
+    stdout(msg)
+
+
+# EOB
@@ -0,0 +1,245 @@
+#
+#   synctool.checkpoint.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''time-limited runs that continue where the previous run stopped
+
+    With a time budget, synctool checks the entries of the overlay tree
+    in the usual order until the budget runs out. The position in that
+    order (a count of entries, plus the last destination that was
+    checked) is written to a checkpoint file, and the next run skips
+    the entries up to that position. Once the end of the overlay tree
+    is reached, the next run starts at the beginning again.
+    Entries under the priority paths are not counted; they are checked
+    first, in every run. The clock starts after them, as do purging and
+    comparing files in advance; the budget is for the regular entries
+    only. Every run checks at least one regular entry, so that a run
+    always makes progress.
+    The checkpoint also holds the .post scripts that were queued but
+    did not run yet, so they are run by the next run if this one is
+    interrupted.
+'''
+
+import os
+import time
+
+from synctool.lib import verbose, stderr
+import synctool.lib
+import synctool.overlay
+import synctool.param
+
+CHECKPOINT_FILE = 'checkpoint'
+CHECKPOINT_MAGIC = '# synctool checkpoint'
+
+# the time budget in seconds; None means there is no budget
+BUDGET = None
+
+# time at which the budget runs out; set by start_clock()
+DEADLINE = None
+
+# position where the previous run stopped: count of entries
+# and the last destination path that was checked
+POSITION = 0
+LAST_PATH = None
+
+# .post scripts of the previous run that did not run:
+# list of (run_dir, cmd)
+PENDING = []
+
+# position where this run stopped; 0 when it got to the end
+NEW_POSITION = 0
+NEW_LAST_PATH = None
+
+
+class Cursor(object):
+    '''keeps track of the position in the overlay order during a walk'''
+
+    def __init__(self, use_deadline=True):
+        self.use_deadline = use_deadline
+        self.count = 0
+        # True once the checkpoint of the previous run is passed
+        self.resumed = (POSITION == 0)
+        # True once the budget ran out
+        self.stopped = False
+        # True once an entry was checked in this run
+        self.progressed = False
+        self.last_path = None
+        # a template gets a second callback for the generated file
+        self.template = None
+        self.template_wanted = False
+
+    def wanted(self, obj):
+        '''Returns True if SyncObject obj is to be checked in this run
+        Entries under the priority paths are never wanted here'''
+
+        if obj is self.template:
+            # the second callback for a template
+            self.template = None
+            return self.template_wanted
+
+        if priority(obj.dest_path):
+            return False
+
+        wanted = self._wanted(obj)
+
+        if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+            self.template = obj
+            self.template_wanted = wanted
+
+        if wanted:
+            self.last_path = obj.dest_path
+        return wanted
+
+    def _wanted(self, obj):
+        '''count entry and decide whether it is to be checked'''
+
+        global NEW_POSITION, NEW_LAST_PATH
+
+        index = self.count
+        self.count += 1
+
+        if not self.resumed:
+            if index < POSITION and obj.dest_path != LAST_PATH:
+                return False
+
+            self.resumed = True
+            if index < POSITION:
+                # the last one that was checked in the previous run
+                self.last_path = obj.dest_path
+                return False
+
+            if LAST_PATH is not None:
+                verbose('checkpoint: %s not found, resuming at entry %d' %
+                        (LAST_PATH, index))
+
+        if self.stopped:
+            return False
+
+        if (self.use_deadline and DEADLINE is not None and
+                self.progressed and time.time() >= DEADLINE):
+            self.stopped = True
+            NEW_POSITION = index
+            NEW_LAST_PATH = self.last_path
+            verbose('time budget used up at entry %d' % index)
+            return False
+
+        self.progressed = True
+        return True
+
+
+def priority(path):
+    '''Returns True if destination path is under a priority path'''
+
+    for prio_path in synctool.param.PRIORITY_PATHS:
+        if (path == prio_path or
+                path.startswith(prio_path.rstrip(os.sep) + os.sep)):
+            return True
+
+    return False
+
+
+def active():
+    '''Returns True if running with a time budget'''
+
+    return BUDGET is not None
+
+
+def partial():
+    '''Returns True if this run did not get to the end of the overlay'''
+
+    return NEW_POSITION > 0
+
+
+def _filename():
+    '''Returns full path to the checkpoint file'''
+
+    return os.path.join(synctool.param.STATE_DIR, CHECKPOINT_FILE)
+
+
+def start(budget):
+    '''start run with a time budget, in seconds
+    This loads the checkpoint of the previous run; the clock is
+    started by start_clock()'''
+
+    global BUDGET, POSITION, LAST_PATH
+
+    BUDGET = budget
+
+    filename = _filename()
+    try:
+        with open(filename) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        verbose('no checkpoint; starting at the beginning')
+        return
+
+    if not lines or lines[0] != CHECKPOINT_MAGIC:
+        verbose('ignoring invalid checkpoint file %s' % filename)
+        return
+
+    for line in lines[1:]:
+        arr = line.split(' ', 1)
+        if len(arr) != 2:
+            continue
+
+        if arr[0] == 'position':
+            try:
+                POSITION = int(arr[1])
+            except ValueError:
+                POSITION = 0
+
+        elif arr[0] == 'path':
+            LAST_PATH = arr[1]
+
+        elif arr[0] == 'post':
+            arr = arr[1].split('\t', 1)
+            if len(arr) == 2:
+                PENDING.append((arr[0], arr[1]))
+
+    if POSITION > 0:
+        verbose('resuming after entry %d: %s' % (POSITION, LAST_PATH))
+
+
+def start_clock():
+    '''start spending the time budget'''
+
+    global DEADLINE
+
+    if BUDGET is not None:
+        DEADLINE = time.time() + BUDGET
+
+
+def save(pending):
+    '''write checkpoint of this run
+    pending is a list of (run_dir, cmd) of .post scripts yet to run'''
+
+    if BUDGET is None or synctool.lib.DRY_RUN:
+        return
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return
+
+    filename = _filename()
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'w') as f:
+            f.write(CHECKPOINT_MAGIC + '\n')
+            f.write('position %d\n' % NEW_POSITION)
+            if NEW_LAST_PATH is not None:
+                f.write('path %s\n' % NEW_LAST_PATH)
+
+            for run_dir, cmd in pending:
+                f.write('post %s\t%s\n' % (run_dir, cmd))
+
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as err:
+        stderr('failed to write %s: %s' % (filename, err.strerror))
+
+
+# EOB
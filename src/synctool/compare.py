@@ -0,0 +1,170 @@
+#
+#   synctool.compare.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''compare the contents of two local files
+
+    Both files are local, so there is no need to checksum them; the
+    contents are compared directly and the comparison stops at the first
+    block that differs. The method depends on the file size:
+     - tiny files are read in one go
+     - mid-size files are compared region by region; the source file
+       is memory mapped, the destination file is read
+     - large files are compared using large reads, while the kernel
+       reads ahead
+    The caller may pass checksums to take along; see compare_files().
+    The tiers are listed in TIERS, and can be changed as seen fit.
+'''
+
+import os
+import mmap
+
+import synctool.iobudget
+
+# files up to this size are read in one go
+TINY_SIZE = 64 * 1024
+
+# files up to this size are memory mapped
+MMAP_SIZE = 256 * 1024 * 1024
+
+# size for comparing regions of memory mapped files
+MMAP_CHUNK = 1024 * 1024
+
+# size for doing I/O while comparing large files
+IO_SIZE = 1024 * 1024
+
+# no checksums to update while comparing
+NO_CHECKSUMS = (None, None)
+
+
+def _read(f, size, checksum=None):
+    '''read from file, and update the checksum (if any) with the data
+    Raises IOError with the filename set'''
+
+    try:
+        data = f.read(size)
+    except IOError as err:
+        raise IOError(err.errno, err.strerror, f.name)
+
+    synctool.iobudget.charge(len(data))
+    if checksum is not None:
+        checksum.update(data)
+    return data
+
+
+def compare_tiny(f1, f2, size, checksums=NO_CHECKSUMS):
+    '''compare tiny files in a single read
+    Returns True if the same'''
+
+    # read one byte more than expected, so that growing files differ
+    return (_read(f1, size + 1, checksums[0]) ==
+            _read(f2, size + 1, checksums[1]))
+
+
+def compare_mmap(f1, f2, size, checksums=NO_CHECKSUMS):
+    '''compare files by memory mapping f1, and reading f2
+    f2 is the destination file, which is not mapped; if another process
+    truncated it while it was mapped, reading it would raise SIGBUS
+    Returns True if the same'''
+
+    size1 = os.fstat(f1.fileno()).st_size
+    size2 = os.fstat(f2.fileno()).st_size
+    if size1 != size2:
+        return False
+
+    if size1 == 0:
+        return True
+
+    try:
+        map1 = mmap.mmap(f1.fileno(), size1, access=mmap.ACCESS_READ)
+    except EnvironmentError:
+        # can not mmap this file (it may be on a weird filesystem)
+        return compare_large(f1, f2, size, checksums)
+
+    try:
+        # buffer objects compare without making copies
+        offset = 0
+        while offset < size1:
+            synctool.iobudget.charge(min(MMAP_CHUNK, size1 - offset))
+            region1 = buffer(map1, offset, MMAP_CHUNK)
+            data2 = _read(f2, MMAP_CHUNK, checksums[1])
+            if region1 != buffer(data2):
+                return False
+
+            if checksums[0] is not None:
+                checksums[0].update(region1)
+
+            offset += MMAP_CHUNK
+    finally:
+        map1.close()
+
+    # f2 may have grown since
+    return _read(f2, 1) == ''
+
+
+def compare_large(f1, f2, size, checksums=NO_CHECKSUMS):
+    '''compare large files using large reads
+    Returns True if the same'''
+
+    fd1 = f1.fileno()
+    fd2 = f2.fileno()
+    synctool.iobudget.sequential(fd1)
+    synctool.iobudget.sequential(fd2)
+
+    offset = f1.tell()
+    while True:
+        # let the kernel read the next blocks while these are compared
+        synctool.iobudget.read_ahead(fd1, offset + IO_SIZE, IO_SIZE)
+        synctool.iobudget.read_ahead(fd2, offset + IO_SIZE, IO_SIZE)
+
+        data1 = _read(f1, IO_SIZE, checksums[0])
+        data2 = _read(f2, IO_SIZE, checksums[1])
+        if data1 != data2:
+            return False
+
+        if not data1:
+            break
+
+        offset += IO_SIZE
+
+    return True
+
+
+# list of tiers: (max file size, compare function)
+# a max size of None means any size
+TIERS = [(TINY_SIZE, compare_tiny),
+         (MMAP_SIZE, compare_mmap),
+         (None, compare_large)]
+
+
+def compare_files(f1, f2, size, checksums=NO_CHECKSUMS):
+    '''compare contents of open files f1 and f2
+    size is the expected size of the files
+    checksums is a pair of hashlib objects (or None) that are updated
+    with the contents of f1 and f2; they are complete only if the files
+    are the same
+    Returns True if the same
+    Raises IOError (with the filename set) on read errors'''
+
+    uncached1 = synctool.iobudget.uncached(f1.fileno(), size)
+    uncached2 = synctool.iobudget.uncached(f2.fileno(), size)
+    try:
+        for max_size, func in TIERS:
+            if max_size is None or size <= max_size:
+                return func(f1, f2, size, checksums)
+
+        # not reached when the last tier has no max size
+        return compare_large(f1, f2, size, checksums)
+    finally:
+        # do not leave behind what was not in the page cache before
+        synctool.iobudget.drop(f1.fileno(), uncached1)
+        synctool.iobudget.drop(f2.fileno(), uncached2)
+
+
+# EOB
@@ -20,6 +20,7 @@ import os
 import sys
 import re
 
+import synctool.ignore
 import synctool.lib
 import synctool.param
 
@@ -349,6 +350,187 @@ def config_backup_copies(arr, configfile, lineno):
     return err
 
 
+def config_backup_dir(arr, configfile, lineno):
+    '''parse keyword: backup_dir'''
+
+    if len(arr) < 2:
+        stderr("%s:%d: 'backup_dir' requires an argument" %
+               (configfile, lineno))
+        return 1
+
+    if not check_definition(arr[0], configfile, lineno):
+        return 1
+
+    d = ' '.join(arr[1:])
+    d = synctool.lib.prepare_path(d)
+
+    if not os.path.isabs(d):
+        stderr("%s:%d: backup_dir must be an absolute path" % (configfile,
+                                                               lineno))
+        return 1
+
+    synctool.param.BACKUP_DIR = d
+    return 0
+
+
+def config_digest_cache(arr, configfile, lineno):
+    '''parse keyword: digest_cache'''
+
+    (err, synctool.param.DIGEST_CACHE) = _config_boolean('digest_cache',
+                                                arr[1], configfile, lineno)
+    return err
+
+
+def config_digest_cache_size(arr, configfile, lineno):
+    '''parse keyword: digest_cache_size'''
+
+    (err, synctool.param.DIGEST_CACHE_SIZE) = _config_integer(
+                        'digest_cache_size', arr[1], configfile, lineno)
+
+    if not err and synctool.param.DIGEST_CACHE_SIZE < 1:
+        stderr("%s:%d: invalid argument for digest_cache_size" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_compare_max_read(arr, configfile, lineno):
+    '''parse keyword: compare_max_read'''
+
+    (err, synctool.param.COMPARE_MAX_READ) = _config_integer(
+                        'compare_max_read', arr[1], configfile, lineno)
+
+    if not err and synctool.param.COMPARE_MAX_READ < 0:
+        stderr("%s:%d: invalid argument for compare_max_read" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_compare_max_iops(arr, configfile, lineno):
+    '''parse keyword: compare_max_iops'''
+
+    (err, synctool.param.COMPARE_MAX_IOPS) = _config_integer(
+                        'compare_max_iops', arr[1], configfile, lineno)
+
+    if not err and synctool.param.COMPARE_MAX_IOPS < 0:
+        stderr("%s:%d: invalid argument for compare_max_iops" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_compare_idle(arr, configfile, lineno):
+    '''parse keyword: compare_idle'''
+
+    (err, synctool.param.COMPARE_IDLE) = _config_boolean('compare_idle',
+                                                arr[1], configfile, lineno)
+    return err
+
+
+def config_compare_drop_cache(arr, configfile, lineno):
+    '''parse keyword: compare_drop_cache'''
+
+    (err, synctool.param.COMPARE_DROP_CACHE) = _config_boolean(
+                        'compare_drop_cache', arr[1], configfile, lineno)
+    return err
+
+
+def config_delta_size(arr, configfile, lineno):
+    '''parse keyword: delta_size'''
+
+    (err, synctool.param.DELTA_SIZE) = _config_integer('delta_size', arr[1],
+                                                       configfile, lineno)
+
+    if not err and synctool.param.DELTA_SIZE < 0:
+        stderr("%s:%d: invalid argument for delta_size" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_dir_state(arr, configfile, lineno):
+    '''parse keyword: dir_state'''
+
+    (err, synctool.param.DIR_STATE) = _config_boolean('dir_state', arr[1],
+                                                      configfile, lineno)
+    return err
+
+
+def config_fsync(arr, configfile, lineno):
+    '''parse keyword: fsync'''
+
+    (err, synctool.param.FSYNC) = _config_boolean('fsync', arr[1],
+                                                  configfile, lineno)
+    return err
+
+
+def config_list_threads(arr, configfile, lineno):
+    '''parse keyword: list_threads'''
+
+    (err, synctool.param.LIST_THREADS) = _config_integer('list_threads',
+                                                arr[1], configfile, lineno)
+
+    if not err and synctool.param.LIST_THREADS < 1:
+        stderr("%s:%d: invalid argument for list_threads" %
+               (configfile, lineno))
+        return 1
+
+    return err
+
+
+def config_purge_rsync(arr, configfile, lineno):
+    '''parse keyword: purge_rsync'''
+
+    (err, synctool.param.PURGE_RSYNC) = _config_boolean('purge_rsync',
+                                                        arr[1], configfile,
+                                                        lineno)
+    return err
+
+
+def config_template_cache(arr, configfile, lineno):
+    '''parse keyword: template_cache'''
+
+    (err, synctool.param.TEMPLATE_CACHE) = _config_boolean('template_cache',
+                                                arr[1], configfile, lineno)
+    return err
+
+
+def config_template_env(arr, configfile, lineno):
+    '''parse keyword: template_env'''
+
+    for var in arr[1:]:
+        if not var in synctool.param.TEMPLATE_ENV:
+            synctool.param.TEMPLATE_ENV.append(var)
+
+    return 0
+
+
+def config_priority_path(arr, configfile, lineno):
+    '''parse keyword: priority_path'''
+
+    if len(arr) < 2:
+        stderr("%s:%d: 'priority_path' requires at least 1 argument: "
+               "the destination path to check first" % (configfile, lineno))
+        return 1
+
+    for path in arr[1:]:
+        path = synctool.lib.strip_path(path)
+        if not path or path[0] != os.sep:
+            stderr("%s:%d: priority_path must be an absolute path" %
+                   (configfile, lineno))
+            return 1
+
+        if not path in synctool.param.PRIORITY_PATHS:
+            synctool.param.PRIORITY_PATHS.append(path)
+
+    return 0
+
+
 def config_syslogging(arr, configfile, lineno):
     '''parse keyword: syslogging'''
 
@@ -382,9 +564,13 @@ def config_ignore(arr, configfile, lineno):
         return 1
 
     for fn in arr[1:]:
+        # if fn has a slash, it's a pattern for the path
+        if '/' in fn:
+            if not fn in synctool.param.IGNORE_PATHS:
+                synctool.param.IGNORE_PATHS.append(fn)
+
         # if fn has wildcards, put it in array IGNORE_FILES_WITH_WILDCARDS
-        if (fn.find('*') >= 0 or fn.find('?') >= 0 or
-            (fn.find('[') >= 0 and fn.find(']') >= 0)):
+        elif synctool.ignore.has_wildcards(fn):
             if not fn in synctool.param.IGNORE_FILES_WITH_WILDCARDS:
                 synctool.param.IGNORE_FILES_WITH_WILDCARDS.append(fn)
         else:
@@ -800,7 +986,7 @@ def config_node(arr, configfile, lineno):
 
 def _node_specifier(configfile, lineno, node, spec):
     '''parse optional node specifiers like 'ipaddress:', 'hostname:',
-    'hostid:', 'rsync:' etc.
+    'hostid:', 'rsync:', 'bwlimit:' etc.
     Returns True if OK, False on error'''
 
     specifier, arg = spec.split(':', 1)
@@ -864,6 +1050,19 @@ def _node_specifier(configfile, lineno, node, spec):
             stderr("%s:%d: node specifier 'rsync' can have value "
                    "'yes' or 'no'" % (configfile, lineno))
             return False
+
+    elif specifier == 'bwlimit':
+        try:
+            mbps = float(arg)
+        except ValueError:
+            mbps = 0
+
+        if mbps <= 0:
+            stderr("%s:%d: node specifier 'bwlimit' requires a bandwidth "
+                   "in MB/s" % (configfile, lineno))
+            return False
+
+        synctool.param.BWLIMITS[node] = mbps
     else:
         stderr('%s:%d: unknown node specifier %s' %
                (configfile, lineno, specifier))
@@ -1013,6 +1212,25 @@ def config_rsync_cmd(arr, configfile, lineno):
     return err
 
 
+def config_rsync_bandwidth(arr, configfile, lineno):
+    '''parse keyword: rsync_bandwidth'''
+
+    if not check_definition('rsync_bandwidth', configfile, lineno):
+        return 1
+
+    try:
+        synctool.param.RSYNC_BANDWIDTH = float(arr[1])
+    except ValueError:
+        synctool.param.RSYNC_BANDWIDTH = -1
+
+    if synctool.param.RSYNC_BANDWIDTH < 0:
+        stderr("%s:%d: invalid argument for rsync_bandwidth" %
+               (configfile, lineno))
+        return 1
+
+    return 0
+
+
 def config_synctool_cmd(arr, configfile, lineno):
     '''parse keyword: synctool_cmd'''
 
@@ -1044,6 +1262,58 @@ def config_num_proc(arr, configfile, lineno):
     return err
 
 
+def config_adaptive_num_proc(arr, configfile, lineno):
+    '''parse keyword: adaptive_num_proc <min> <max> [<max load>]'''
+
+    if len(arr) < 3 or len(arr) > 4:
+        stderr("%s:%d: 'adaptive_num_proc' requires two arguments: "
+               "the minimum and maximum number of processes" %
+               (configfile, lineno))
+        return 1
+
+    (err, num_min) = _config_integer('adaptive_num_proc', arr[1],
+                                     configfile, lineno)
+    if err:
+        return err
+
+    try:
+        num_max = int(arr[2])
+        if len(arr) == 4:
+            max_load = float(arr[3])
+        else:
+            max_load = None
+    except ValueError:
+        stderr("%s:%d: invalid argument for adaptive_num_proc" %
+               (configfile, lineno))
+        return 1
+
+    if (num_min < 1 or num_max < num_min or
+            (max_load is not None and max_load <= 0)):
+        stderr("%s:%d: invalid argument for adaptive_num_proc" %
+               (configfile, lineno))
+        return 1
+
+    synctool.param.ADAPTIVE_NUM_PROC = True
+    synctool.param.MIN_NUM_PROC = num_min
+    synctool.param.MAX_NUM_PROC = num_max
+    synctool.param.MAX_LOAD = max_load
+    return 0
+
+
+def config_num_post_proc(arr, configfile, lineno):
+    '''parse keyword: num_post_proc'''
+
+    (err, synctool.param.NUM_POST_PROC) = _config_integer('num_post_proc',
+                                                    arr[1], configfile, lineno)
+
+    if not err and synctool.param.NUM_POST_PROC < 1:
+        stderr("%s:%d: invalid argument for num_post_proc" % (configfile,
+                                                              lineno))
+        return 1
+
+    return err
+
+
 def expand_grouplist(grouplist):
     '''expand a list of (compound) groups recursively
     Returns the expanded group list'''
@@ -0,0 +1,229 @@
+#
+#   synctool.digest.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''persistent cache of MD5 digests of files
+
+    A digest is valid as long as the file has the same device, inode,
+    size, mtime and ctime as when the digest was computed. The ctime can
+    not be set from userland, so a file can not be modified without
+    invalidating its cache entry.
+    A file that was modified within RACY_TIME seconds of computing its
+    digest is not cached; it may still be written to within the
+    same timestamp granularity.
+    Files are compared directly when a digest is missing (see compare()),
+    so that the compare may stop early when the files differ.
+    The cache holds at most DIGEST_CACHE_SIZE entries; the least
+    recently used entries are evicted first.
+'''
+
+import os
+import time
+import hashlib
+import threading
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    # Python 2.6 has no OrderedDict; run without the cache
+    OrderedDict = None
+
+import synctool.compare
+from synctool.lib import verbose, stderr
+import synctool.lib
+import synctool.param
+
+# do not cache digests of files this recently modified (in seconds)
+RACY_TIME = 2
+
+CACHE_FILE = 'digests'
+CACHE_MAGIC = '# synctool digest cache'
+
+# the cache:  CACHE[path] -> (dev, ino, size, mtime, ctime, hexdigest)
+# ordered from least recently used to most recently used
+CACHE = None
+CACHE_CHANGED = False
+
+# the cache may be used from multiple threads (see synctool.prefetch)
+CACHE_LOCK = threading.Lock()
+
+# statistics
+HITS = 0
+MISSES = 0
+
+
+def enabled():
+    '''Returns True if the digest cache is enabled'''
+
+    return synctool.param.DIGEST_CACHE and OrderedDict is not None
+
+
+def _cache_filename():
+    '''Returns full path to the cache file'''
+
+    return os.path.join(synctool.param.STATE_DIR, CACHE_FILE)
+
+
+def load():
+    '''load the cache from disk'''
+
+    global CACHE
+
+    CACHE = OrderedDict()
+
+    filename = _cache_filename()
+    try:
+        f = open(filename)
+    except IOError:
+        # no cache (yet)
+        return
+
+    with f:
+        if f.readline().rstrip('\n') != CACHE_MAGIC:
+            verbose('ignoring invalid digest cache %s' % filename)
+            return
+
+        for line in f:
+            arr = line.rstrip('\n').split(' ', 6)
+            if len(arr) != 7:
+                verbose('ignoring invalid digest cache %s' % filename)
+                CACHE = OrderedDict()
+                return
+
+            try:
+                CACHE[arr[6]] = (int(arr[1]), int(arr[2]), int(arr[3]),
+                                 float(arr[4]), float(arr[5]), arr[0])
+            except ValueError:
+                verbose('ignoring invalid digest cache %s' % filename)
+                CACHE = OrderedDict()
+                return
+
+    verbose('loaded %d entries from digest cache' % len(CACHE))
+
+
+def save():
+    '''write the cache to disk (if it changed)'''
+
+    if CACHE is None:
+        return
+
+    verbose('digest cache: %d hits, %d misses' % (HITS, MISSES))
+
+    if not CACHE_CHANGED:
+        return
+
+    # evict least recently used entries
+    while len(CACHE) > synctool.param.DIGEST_CACHE_SIZE:
+        CACHE.popitem(last=False)
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return
+
+    filename = _cache_filename()
+    tmp_filename = filename + '.tmp'
+    try:
+        f = open(tmp_filename, 'w')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (tmp_filename, err.strerror))
+        return
+
+    with f:
+        f.write('%s\n' % CACHE_MAGIC)
+        for path, entry in CACHE.iteritems():
+            f.write('%s %d %d %d %r %r %s\n' % (entry[5], entry[0], entry[1],
+                                                entry[2], entry[3], entry[4],
+                                                path))
+
+    try:
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        stderr('failed to rename %s: %s' % (tmp_filename, err.strerror))
+
+
+def _key(statbuf):
+    '''Returns cache key for SyncStat object'''
+
+    return (statbuf.dev, statbuf.ino, statbuf.size, statbuf.mtime,
+            statbuf.ctime)
+
+
+def lookup(path, statbuf):
+    '''statbuf is a SyncStat object for path
+    Returns cached hexdigest, or None if not in the cache'''
+
+    global CACHE_CHANGED, HITS, MISSES
+
+    with CACHE_LOCK:
+        if CACHE is None:
+            load()
+
+        entry = CACHE.pop(path, None)
+        if entry is not None and entry[:5] == _key(statbuf):
+            HITS += 1
+            # re-insert to mark as most recently used
+            CACHE[path] = entry
+            return entry[5]
+
+        MISSES += 1
+        if entry is not None:
+            # the entry was popped; it is stale
+            CACHE_CHANGED = True
+
+    return None
+
+
+def store(path, statbuf, hexdigest, timestamp):
+    '''store digest in the cache
+    timestamp is the time at which computing the digest started'''
+
+    global CACHE_CHANGED
+
+    if (max(statbuf.mtime, statbuf.ctime) >= timestamp - RACY_TIME or
+            '\n' in path):
+        return
+
+    with CACHE_LOCK:
+        CACHE[path] = _key(statbuf) + (hexdigest,)
+        CACHE_CHANGED = True
+
+
+def compare(f1, stat1, f2, stat2):
+    '''compare contents of open files f1 and f2, using the cache
+    stat1 and stat2 are SyncStat objects for the files
+    Returns True if the same
+    Raises IOError (with the filename set) on read errors'''
+
+    digest1 = lookup(f1.name, stat1)
+    digest2 = lookup(f2.name, stat2)
+    if digest1 is not None and digest2 is not None:
+        return digest1 == digest2
+
+    # the files are compared directly, which stops at the first block
+    # that differs. If the files are the same, they have the same digest;
+    # so when neither digest is known, only f1 is hashed along the way
+    checksums = synctool.compare.NO_CHECKSUMS
+    if digest1 is None and digest2 is None:
+        checksums = (hashlib.md5(), None)
+
+    now = time.time()
+    if not synctool.compare.compare_files(f1, f2, stat1.size, checksums):
+        return False
+
+    if digest1 is None and digest2 is None:
+        digest1 = digest2 = checksums[0].hexdigest()
+        store(f1.name, stat1, digest1, now)
+        store(f2.name, stat2, digest2, now)
+    elif digest1 is None:
+        store(f1.name, stat1, digest2, now)
+    else:
+        store(f2.name, stat2, digest1, now)
+    return True
+
+
+# EOB
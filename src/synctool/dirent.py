@@ -0,0 +1,115 @@
+#
+#   synctool.dirent.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''list directories along with the type of each entry
+
+    On Linux, readdir() tells the type of the entry, so that it is not
+    necessary to stat() it to find out whether it is a directory.
+    Not all filesystems fill in the type; then it is DT_UNKNOWN.
+    On other platforms, all types are DT_UNKNOWN.
+'''
+
+import os
+import sys
+import ctypes
+import ctypes.util
+
+# entry types, from <dirent.h>
+DT_UNKNOWN = 0
+DT_FIFO = 1
+DT_CHR = 2
+DT_DIR = 4
+DT_BLK = 6
+DT_REG = 8
+DT_LNK = 10
+DT_SOCK = 12
+
+
+class _Dirent64(ctypes.Structure):
+    '''struct dirent64 on Linux'''
+
+    _fields_ = [('d_ino', ctypes.c_uint64),
+                ('d_off', ctypes.c_int64),
+                ('d_reclen', ctypes.c_ushort),
+                ('d_type', ctypes.c_ubyte),
+                ('d_name', ctypes.c_char * 256)]
+
+
+# handle to the C library; False if it can not be used
+LIBC = None
+
+
+def _libc():
+    '''Returns handle to the C library, or False if not usable'''
+
+    global LIBC
+
+    if LIBC is None:
+        LIBC = False
+
+        if not sys.platform.startswith('linux'):
+            return LIBC
+
+        libname = ctypes.util.find_library('c')
+        if not libname:
+            return LIBC
+
+        try:
+            libc = ctypes.CDLL(libname, use_errno=True)
+            libc.opendir.argtypes = [ctypes.c_char_p]
+            libc.opendir.restype = ctypes.c_void_p
+            libc.readdir64.argtypes = [ctypes.c_void_p]
+            libc.readdir64.restype = ctypes.POINTER(_Dirent64)
+            libc.closedir.argtypes = [ctypes.c_void_p]
+        except (OSError, AttributeError):
+            return LIBC
+
+        LIBC = libc
+
+    return LIBC
+
+
+def listdir(path):
+    '''Returns list of tuples: (name, type)
+    Raises OSError on error, like os.listdir() does'''
+
+    libc = _libc()
+    if not libc:
+        return [(name, DT_UNKNOWN) for name in os.listdir(path)]
+
+    dirp = libc.opendir(path)
+    if not dirp:
+        err = ctypes.get_errno()
+        raise OSError(err, os.strerror(err), path)
+
+    arr = []
+    try:
+        while True:
+            ctypes.set_errno(0)
+            entry = libc.readdir64(dirp)
+            if not entry:
+                err = ctypes.get_errno()
+                if err != 0:
+                    raise OSError(err, os.strerror(err), path)
+                break
+
+            entry = entry.contents
+            name = entry.d_name
+            if name == '.' or name == '..':
+                continue
+
+            arr.append((name, entry.d_type))
+    finally:
+        libc.closedir(dirp)
+
+    return arr
+
+
+# EOB
@@ -0,0 +1,445 @@
+#
+#   synctool.dirstate.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''recorded state of entries that were found to be in sync
+
+    After a --fix run, synctool records for every destination directory
+    the entries that were in sync: the source path, and the stat
+    fingerprint (dev, inode, mode, owner, size, mtime, ctime) of both the
+    source and the destination. On the next run, an entry whose source
+    and destination fingerprints are unchanged is known to be in sync,
+    and is not checked again. Any change to either file (even a chmod)
+    changes its ctime, so it drops back to a full check.
+    When synctool-watch is running, the destination of an entry that it
+    saw no change to is not stat'ed at all (see synctool.drift).
+
+    Likewise, synctool records the source directories of which all
+    entries were in sync: the fingerprint of the directory, the entries
+    that it provides, and its subdirectories. When the directory itself
+    is unchanged, as well as the source and destination of each of its
+    entries, the walk does not even list it; it goes on with the recorded
+    subdirectories. A new, removed or renamed entry changes the mtime of
+    the directory.
+    After a successful rsync, the master passes --tree-hash; the client
+    then takes the hashes that the master made of the directories of the
+    repository (see synctool.manifest) to know that the sources did not
+    change, rather than stat'ing them.
+'''
+
+import os
+import marshal
+
+from synctool.lib import verbose, stderr, prettypath
+import synctool.drift
+import synctool.lib
+import synctool.param
+
+STATE_FILE = 'dirstate'
+STATE_VERSION = 2
+
+# the recorded state of the previous run
+# STATE[dest_dir] -> { basename: (src_path, src_fingerprint, dest_fp) }
+STATE = None
+
+# the state as found in this run
+NEW_STATE = {}
+
+# the recorded source directories of which all entries were in sync
+# DIRS[src_dir] -> (dest_dir, dir_fp, tree_hash, files, shadowed, posts,
+#                   subdirs)
+#  files: tuple of (src name, dest name) of the entries that it provides
+#  shadowed: tuple of the dest paths that more important entries provide
+#  posts: tuple of (key, src_path) that it registers in the post_dict
+#  subdirs: tuple of the names of its subdirectories, in order of the walk
+DIRS = None
+NEW_DIRS = {}
+
+# the settings and groups that the recorded directories depend on
+CONTEXT = None
+
+# hashes of the source directories, made by the master
+# TREE_HASH[src_dir] -> hash
+TREE_HASH = None
+
+# outcome of dir_unchanged() in this run
+# CHECKED[src_dir] -> directory record, or None
+CHECKED = {}
+
+# fingerprints of source directories, taken before they were listed
+DIR_FP = {}
+
+# statistics
+SKIPPED = 0
+SKIPPED_DIRS = 0
+
+
+def _state_filename():
+    '''Returns full path to the state file'''
+
+    return os.path.join(synctool.param.STATE_DIR, STATE_FILE)
+
+
+def fingerprint(statbuf):
+    '''Returns tuple that identifies the state of a file'''
+
+    return (statbuf.dev, statbuf.ino, statbuf.mode, statbuf.uid,
+            statbuf.gid, statbuf.size, statbuf.mtime, statbuf.ctime)
+
+
+def _lstat_fingerprint(path):
+    '''Returns fingerprint of path, or None on error'''
+
+    try:
+        statbuf = os.lstat(path)
+    except OSError:
+        return None
+
+    return (statbuf.st_dev, statbuf.st_ino, statbuf.st_mode, statbuf.st_uid,
+            statbuf.st_gid, statbuf.st_size, statbuf.st_mtime,
+            statbuf.st_ctime)
+
+
+def start(context, tree_hash):
+    '''set the context of the recorded directories: the settings and
+    groups that the overlay resolution depends on
+    tree_hash is the dict of source directory hashes, or None'''
+
+    global CONTEXT, TREE_HASH
+
+    CONTEXT = context
+    TREE_HASH = tree_hash
+    load()
+
+
+def load():
+    '''load the recorded state'''
+
+    global STATE, DIRS
+
+    STATE = {}
+    DIRS = {}
+
+    filename = _state_filename()
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return
+
+    with f:
+        try:
+            version, context, state, dirs = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            verbose('ignoring invalid state file %s' % filename)
+            return
+
+    if version != STATE_VERSION:
+        verbose('ignoring state file %s of another version' % filename)
+        return
+
+    STATE = state
+
+    if context == CONTEXT:
+        DIRS = dirs
+    else:
+        verbose('settings changed; not skipping any directories')
+
+
+def save():
+    '''save state of this run
+    Only entries that were seen in this run are kept
+    Returns True if the state was saved'''
+
+    if STATE is None:
+        # not used
+        return False
+
+    verbose('skipped %d entries that are known to be in sync' % SKIPPED)
+    if SKIPPED_DIRS > 0:
+        verbose('skipped %d directories that are known to be in sync' %
+                SKIPPED_DIRS)
+
+    if synctool.lib.DRY_RUN:
+        # only the state of --fix runs is recorded
+        return False
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return False
+
+    filename = _state_filename()
+    tmp_filename = filename + '.tmp'
+    try:
+        f = open(tmp_filename, 'wb')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    with f:
+        marshal.dump((STATE_VERSION, CONTEXT, NEW_STATE, NEW_DIRS), f)
+
+    try:
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        stderr('failed to rename %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    return True
+
+
+def unchanged(obj):
+    '''Returns True if SyncObject obj was in sync in the previous run,
+    and neither the source nor the destination changed since'''
+
+    if STATE is None:
+        load()
+
+    dest_dir, name = os.path.split(obj.dest_path)
+    try:
+        src_path, src_fp, dest_fp = STATE[dest_dir][name]
+    except KeyError:
+        return False
+
+    if src_path != obj.src_path or src_fp != fingerprint(obj.src_stat):
+        return False
+
+    if synctool.drift.clean(obj.dest_path):
+        # synctool-watch saw no change; don't even look at it
+        return True
+
+    return (obj.dest_stat.exists() and
+            dest_fp == fingerprint(obj.dest_stat))
+
+
+def skip(obj):
+    '''skip checking SyncObject obj, which is known to be in sync'''
+
+    global SKIPPED
+
+    SKIPPED += 1
+
+    # carry over the recorded state, without stat'ing the destination
+    dest_dir, name = os.path.split(obj.dest_path)
+    if not dest_dir in NEW_STATE:
+        NEW_STATE[dest_dir] = {}
+
+    NEW_STATE[dest_dir][name] = STATE[dest_dir][name]
+
+
+def carry(obj):
+    '''keep the recorded state of SyncObject obj, which was not checked
+    in this run'''
+
+    if STATE is None:
+        load()
+
+    dest_dir, name = os.path.split(obj.dest_path)
+    try:
+        entry = STATE[dest_dir][name]
+    except KeyError:
+        return
+
+    if not dest_dir in NEW_STATE:
+        NEW_STATE[dest_dir] = {}
+
+    if not name in NEW_STATE[dest_dir]:
+        NEW_STATE[dest_dir][name] = entry
+
+
+def record(obj):
+    '''record SyncObject obj as being in sync'''
+
+    dest_dir, name = os.path.split(obj.dest_path)
+    if not dest_dir in NEW_STATE:
+        NEW_STATE[dest_dir] = {}
+
+    NEW_STATE[dest_dir][name] = (obj.src_path, fingerprint(obj.src_stat),
+                                 fingerprint(obj.dest_stat))
+
+
+def in_sync(dest_path):
+    '''Returns True if the entry for dest_path was found in sync
+    in this run'''
+
+    dest_dir, name = os.path.split(dest_path)
+    return name in NEW_STATE.get(dest_dir, ())
+
+
+def dir_fingerprint(src_dir):
+    '''take the fingerprint of source directory src_dir,
+    before it is listed'''
+
+    if not src_dir in DIR_FP:
+        DIR_FP[src_dir] = _lstat_fingerprint(src_dir)
+
+
+def _entries_unchanged(src_dir, dest_dir, files, check_src):
+    '''Returns True if the entries of a recorded directory are unchanged'''
+
+    try:
+        state = STATE[dest_dir]
+    except KeyError:
+        return False
+
+    for src_name, dest_name in files:
+        try:
+            src_path, src_fp, dest_fp = state[dest_name]
+        except KeyError:
+            return False
+
+        if src_path != os.path.join(src_dir, src_name):
+            return False
+
+        if check_src and _lstat_fingerprint(src_path) != src_fp:
+            return False
+
+        dest_path = os.path.join(dest_dir, dest_name)
+        if (not synctool.drift.clean(dest_path) and
+                _lstat_fingerprint(dest_path) != dest_fp):
+            return False
+
+    return True
+
+
+def dir_unchanged(src_dir, dest_dir, duplicates=None, entries=None):
+    '''Returns the record of source directory src_dir if all of its
+    entries were in sync in the previous run, and nothing changed since
+    When walking the tree, duplicates is the set of destinations that
+    are already provided. When replaying a manifest, entries is the list
+    of (src name, dest name) of the manifest entries in src_dir
+    Returns None if the directory must be checked'''
+
+    if src_dir in CHECKED:
+        return CHECKED[src_dir]
+
+    if STATE is None:
+        load()
+
+    CHECKED[src_dir] = None
+
+    try:
+        rec = DIRS[src_dir]
+    except KeyError:
+        return None
+
+    (rec_dest_dir, dir_fp, tree_hash, files, shadowed, _,
+     subdirs) = rec
+    if rec_dest_dir != dest_dir:
+        return None
+
+    if duplicates is not None:
+        # the same entries must win as before
+        for dest_path in shadowed:
+            if not dest_path in duplicates:
+                return None
+
+        for _, dest_name in files:
+            if os.path.join(dest_dir, dest_name) in duplicates:
+                return None
+
+    if entries is not None:
+        # the manifest must hold the same entries as before
+        if (set([x for x in entries if not x[0] in subdirs]) !=
+                set(files)):
+            return None
+
+    new_hash = None
+    if TREE_HASH is not None:
+        new_hash = TREE_HASH.get(src_dir)
+
+    if new_hash is not None and tree_hash is not None:
+        if new_hash != tree_hash:
+            return None
+
+        # the master saw no change to the sources
+        check_src = False
+    else:
+        dir_fingerprint(src_dir)
+        if DIR_FP[src_dir] != dir_fp:
+            return None
+
+        check_src = True
+
+    if not _entries_unchanged(src_dir, dest_dir, files, check_src):
+        return None
+
+    if new_hash is not None and tree_hash is None:
+        rec = rec[:2] + (new_hash,) + rec[3:]
+
+    CHECKED[src_dir] = rec
+    return rec
+
+
+def skip_dir(src_dir, rec, duplicates=None):
+    '''skip the entries of source directory src_dir, of which
+    the record is rec, as returned by dir_unchanged()
+    Returns pair: the .post scripts it registers, its subdirectories'''
+
+    global SKIPPED, SKIPPED_DIRS
+
+    dest_dir, _, _, files, _, posts, subdirs = rec
+
+    if duplicates is not None:
+        for _, dest_name in files:
+            duplicates.add(os.path.join(dest_dir, dest_name))
+
+    verbose('skipping %s, known to be in sync' % prettypath(src_dir))
+
+    if src_dir in NEW_DIRS:
+        # it was skipped before in this run
+        return posts, subdirs
+
+    SKIPPED += len(files)
+    SKIPPED_DIRS += 1
+
+    NEW_DIRS[src_dir] = rec
+
+    # carry over the recorded state of its entries
+    if not dest_dir in NEW_STATE:
+        NEW_STATE[dest_dir] = {}
+
+    state = STATE[dest_dir]
+    new_state = NEW_STATE[dest_dir]
+    for _, dest_name in files:
+        new_state[dest_name] = state[dest_name]
+
+    return posts, subdirs
+
+
+def record_dir(src_dir, dest_dir, files, shadowed, posts, subdirs):
+    '''record source directory src_dir, of which all entries are in sync'''
+
+    dir_fp = DIR_FP.get(src_dir)
+    if dir_fp is None:
+        return
+
+    tree_hash = None
+    if TREE_HASH is not None:
+        tree_hash = TREE_HASH.get(src_dir)
+
+    NEW_DIRS[src_dir] = (dest_dir, dir_fp, tree_hash, tuple(files),
+                         tuple(shadowed), tuple(posts), tuple(subdirs))
+
+
+def unchanged_subdirs(src_dir):
+    '''Returns the recorded subdirectories of src_dir if the master saw
+    no change to it, or else None
+    This is used by the listing pool, to not list directories
+    that are likely to be skipped'''
+
+    if TREE_HASH is None or DIRS is None:
+        return None
+
+    rec = DIRS.get(src_dir)
+    if rec is None or rec[2] is None or TREE_HASH.get(src_dir) != rec[2]:
+        return None
+
+    return rec[6]
+
+
+# EOB
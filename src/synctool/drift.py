@@ -0,0 +1,304 @@
+#
+#   synctool.drift.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''changes to destination paths, as seen by synctool-watch
+
+    synctool-watch watches the directories that hold the destination
+    paths of the overlay tree. It appends any path that changes to the
+    'dirty' file in the state dir, and it lists the directories that
+    it is watching in the 'dirs' file.
+    synctool-client takes the dirty paths at the start of a run. A path
+    that is in a watched directory and that is not dirty (nor is any of
+    its parent directories) did not change since the previous run; if
+    dirstate recorded it as in sync, it is not even looked at.
+    This is valid only when the previous --fix run completed while the
+    same watcher was running; the run records the watcher's generation
+    in the 'base' file. In any other case, all paths are checked.
+'''
+
+import os
+import time
+import errno
+import fcntl
+
+from synctool.lib import verbose, stderr
+import synctool.lib
+import synctool.param
+
+PID_FILE = 'pid'
+LOCK_FILE = 'lock'
+DIRTY_FILE = 'dirty'
+DIRS_FILE = 'dirs'
+BASE_FILE = 'base'
+
+# marker in the dirty file: all paths must be checked
+ALL = '*'
+
+# client side:
+# generation of the watcher that was running at the start of the run
+GENERATION = None
+# set of dirty paths; None means that all paths must be checked
+DIRTY = None
+# set of watched directories
+WATCHED = set()
+
+# watcher side:
+# the pid file; it is locked for as long as the watcher runs
+PID_FILE_OBJ = None
+# paths that are in the dirty file
+REPORTED = set()
+
+
+def _path(name):
+    '''Returns full path to file in the watch state dir'''
+
+    return os.path.join(synctool.param.STATE_DIR, 'watch', name)
+
+
+def _lock():
+    '''lock the dirty and dirs files
+    Returns locked file object, or None on error'''
+
+    try:
+        f = open(_path(LOCK_FILE), 'a')
+    except IOError as err:
+        stderr('failed to open %s: %s' % (_path(LOCK_FILE), err.strerror))
+        return None
+
+    fcntl.flock(f, fcntl.LOCK_EX)
+    return f
+
+
+def _unlock(f):
+    '''unlock the dirty and dirs files'''
+
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+
+def _read_lines(filename):
+    '''Returns list of lines in file, or None on error'''
+
+    try:
+        with open(filename) as f:
+            return f.read().splitlines()
+    except IOError:
+        return None
+
+
+def watcher_generation():
+    '''Returns generation of the running watcher,
+    or None if it is not running'''
+
+    try:
+        f = open(_path(PID_FILE))
+    except IOError:
+        return None
+
+    with f:
+        try:
+            fcntl.flock(f, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as err:
+            if err.errno not in (errno.EAGAIN, errno.EACCES):
+                return None
+        else:
+            # not locked; the watcher is gone
+            fcntl.flock(f, fcntl.LOCK_UN)
+            return None
+
+        arr = f.read().split()
+
+    if len(arr) != 2:
+        return None
+
+    return arr[1]
+
+
+def start():
+    '''take the dirty paths for this run
+    In a dry run, they are left in place for the next run'''
+
+    global GENERATION, DIRTY, WATCHED
+
+    DIRTY = None
+    WATCHED = set()
+
+    GENERATION = watcher_generation()
+    if GENERATION is None:
+        verbose('synctool-watch is not running')
+        return
+
+    base = _read_lines(_path(BASE_FILE))
+
+    if not synctool.lib.DRY_RUN:
+        # the dirty paths are about to be consumed;
+        # they are accounted for only when this run completes
+        try:
+            os.unlink(_path(BASE_FILE))
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                stderr('failed to remove %s: %s' % (_path(BASE_FILE),
+                                                    err.strerror))
+                GENERATION = None
+                return
+
+    f = _lock()
+    if f is None:
+        GENERATION = None
+        return
+
+    try:
+        dirty = _read_lines(_path(DIRTY_FILE))
+        dirs = _read_lines(_path(DIRS_FILE))
+
+        if not synctool.lib.DRY_RUN and dirty:
+            open(_path(DIRTY_FILE), 'w').close()
+    finally:
+        _unlock(f)
+
+    if base != [GENERATION]:
+        verbose('synctool-watch was (re)started; checking all paths')
+        return
+
+    if dirty is None or dirs is None or ALL in dirty:
+        verbose('synctool-watch lost track of changes; checking all paths')
+        return
+
+    DIRTY = set(dirty)
+    WATCHED = set(dirs)
+    verbose('synctool-watch reported %d changed paths' % len(DIRTY))
+
+
+def finish():
+    '''record that the run took care of all dirty paths'''
+
+    if GENERATION is None or synctool.lib.DRY_RUN:
+        return
+
+    if watcher_generation() != GENERATION:
+        # the watcher stopped or restarted during the run
+        return
+
+    try:
+        with open(_path(BASE_FILE), 'w') as f:
+            f.write(GENERATION + '\n')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (_path(BASE_FILE), err.strerror))
+
+
+def clean(path):
+    '''Returns True if the destination path did not change
+    since the previous run'''
+
+    if DIRTY is None:
+        return False
+
+    if not os.path.dirname(path) in WATCHED:
+        return False
+
+    while path != os.sep:
+        if path in DIRTY:
+            return False
+
+        path = os.path.dirname(path)
+
+    return not os.sep in DIRTY
+
+
+def register():
+    '''register the watcher
+    Returns its generation, or None if a watcher is already running'''
+
+    global PID_FILE_OBJ
+
+    if not synctool.lib.mkdir_p(os.path.dirname(_path(PID_FILE))):
+        return None
+
+    try:
+        # do not truncate it yet; another watcher may be using it
+        f = open(_path(PID_FILE), 'a+')
+    except IOError as err:
+        stderr('failed to open %s: %s' % (_path(PID_FILE), err.strerror))
+        return None
+
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        return None
+
+    pid = os.getpid()
+    generation = '%d.%d' % (pid, int(time.time()))
+    f.seek(0)
+    f.truncate()
+    f.write('%d %s\n' % (pid, generation))
+    f.flush()
+
+    # keep it open (and locked) for as long as the watcher runs
+    PID_FILE_OBJ = f
+    return generation
+
+
+def unregister():
+    '''unregister the watcher'''
+
+    global PID_FILE_OBJ
+
+    if PID_FILE_OBJ is None:
+        return
+
+    try:
+        os.unlink(_path(PID_FILE))
+    except OSError:
+        pass
+
+    PID_FILE_OBJ.close()
+    PID_FILE_OBJ = None
+
+
+def update(paths, dirs=None):
+    '''add paths to the dirty file
+    If dirs is not None, it is the new list of watched directories'''
+
+    f = _lock()
+    if f is None:
+        return
+
+    try:
+        if dirs is not None:
+            tmp_filename = _path(DIRS_FILE) + '.tmp'
+            with open(tmp_filename, 'w') as f2:
+                for path in dirs:
+                    f2.write(path + '\n')
+
+            os.rename(tmp_filename, _path(DIRS_FILE))
+
+        with open(_path(DIRTY_FILE), 'a') as f2:
+            if os.fstat(f2.fileno()).st_size == 0:
+                # the client took the paths
+                REPORTED.clear()
+
+            for path in paths:
+                if '\n' in path:
+                    # it can not be written as a line
+                    path = ALL
+
+                if not path in REPORTED:
+                    REPORTED.add(path)
+                    f2.write(path + '\n')
+
+    except (IOError, OSError) as err:
+        stderr('failed to update %s: %s' % (err.filename, err.strerror))
+
+    finally:
+        _unlock(f)
+
+
+# EOB
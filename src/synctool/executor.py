@@ -0,0 +1,527 @@
+#
+#   synctool.executor.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''run commands for many nodes at once, from a single process
+
+    The work for a node is written as a generator function that yields
+    a Command for every program that it wants to run (like rsync and
+    ssh), and gets the exit code of the program back from the yield.
+    The executor keeps up to NUM_PROC nodes going at the same time. It
+    starts the programs with their output going into a pipe, and waits
+    for output on all pipes at once with poll(); the output is shown
+    line by line, prefixed with the nodename. So there is no Python
+    process per node, only the programs themselves.
+    With adaptive_num_proc, the number of nodes at the same time starts
+    at the minimum and goes up by one for every command that finishes
+    well. After it was lowered once, it goes up by one for every round
+    of commands that finish well. It is halved when ssh fails to
+    connect, when connecting is much slower than usual, when an rsync
+    transfers much slower than the rsyncs before it, or when the load
+    of the master is too high. Commands that were already
+    running when it was halved do not halve it again.
+'''
+
+import os
+import sys
+import time
+import errno
+import fcntl
+import select
+import resource
+import subprocess
+
+from synctool.lib import verbose, stderr
+import synctool.history
+import synctool.lib
+import synctool.param
+import synctool.rollout
+
+# file descriptors to keep free for other purposes
+SPARE_FDS = 64
+
+# size of reads from the output pipes
+READ_SIZE = 16384
+
+# how often to check for programs that closed their output,
+# but did not exit yet (in seconds)
+EXIT_INTERVAL = 0.01
+
+# ssh exits with this code when it can not connect
+SSH_FAILED = 255
+
+# adaptive_num_proc: an rsync is slow when its bytes per second are
+# this many times lower than the moving average of the run so far;
+# only transfers of at least RATE_MIN_BYTES say something about that
+RATE_FACTOR = 2.0
+RATE_MIN_BYTES = 1024 * 1024
+# weight of a new measurement in the moving average
+RATE_WEIGHT = 0.3
+
+# adaptive_num_proc: check the load average at most this often
+LOAD_INTERVAL = 5.0
+
+
+class Command(object):
+    '''a program to run for a node'''
+
+    __slots__ = ('cmd_arr', 'nodename', 'handler', 'phase', 'stdin',
+                 'nbytes')
+
+    def __init__(self, cmd_arr, nodename, handler=None, phase=None,
+                 stdin=None):
+        '''cmd_arr is the command with arguments
+        The output is shown with the nodename, unless handler is given;
+        then handler(line) is called for every line of output
+        If phase is given, the duration is recorded in the history
+        If stdin is given, the file by that name is the input of
+        the command
+        The handler of an rsync may set nbytes to the number of bytes
+        sent, as reported by rsync --stats'''
+
+        self.cmd_arr = cmd_arr
+        self.nodename = nodename
+        self.handler = handler
+        self.phase = phase
+        self.stdin = stdin
+        self.nbytes = None
+
+
+class Job(object):
+    '''the work for one node'''
+
+    __slots__ = ('item', 'gen', 'command', 'proc', 'fd', 'buf',
+                 'returncode', 'started', 'elapsed', 'slow')
+
+    def __init__(self, item, gen):
+        self.item = item
+        self.gen = gen
+        self.command = None
+        self.proc = None
+        self.fd = -1
+        self.buf = ''
+        # exit code of the last command that failed, or 0
+        self.returncode = 0
+        # time the command started, and how long it ran
+        self.started = 0.0
+        self.elapsed = 0.0
+        # True if connecting was much slower than usual
+        self.slow = False
+
+    def output(self, data):
+        '''handle a chunk of output of the running command'''
+
+        lines = (self.buf + data).split('\n')
+        self.buf = lines.pop()
+        for line in lines:
+            self._line(line)
+
+    def flush(self):
+        '''handle the last, incomplete line of output'''
+
+        if self.buf:
+            self._line(self.buf)
+            self.buf = ''
+
+    def _line(self, line):
+        '''handle a line of output'''
+
+        line = line.rstrip()
+        if self.command.handler is not None:
+            self.command.handler(line)
+        else:
+            synctool.lib.output_with_nodename(line, self.command.nodename)
+
+    def advance(self, returncode=None):
+        '''run the job up to the next command, and start it
+        Returns True if a command is running, False if the job is done'''
+
+        while True:
+            try:
+                if self.command is None:
+                    command = self.gen.next()
+                else:
+                    command = self.gen.send(returncode)
+            except StopIteration:
+                return False
+
+            self.command = command
+            self.started = time.time()
+            self.slow = False
+            try:
+                if command.stdin is not None:
+                    stdin = open(command.stdin)
+                else:
+                    stdin = None
+            except IOError as err:
+                stderr('failed to open %s: %s' % (command.stdin,
+                                                  err.strerror))
+                returncode = -1
+                self.returncode = returncode
+                continue
+
+            try:
+                self.proc = subprocess.Popen(command.cmd_arr, shell=False,
+                                             stdin=stdin,
+                                             stdout=subprocess.PIPE,
+                                             stderr=subprocess.STDOUT)
+            except OSError as err:
+                stderr('failed to run command %s: %s' % (command.cmd_arr[0],
+                                                         err.strerror))
+                returncode = -1
+                self.returncode = returncode
+                continue
+            finally:
+                if stdin is not None:
+                    # the child has its own copy
+                    stdin.close()
+
+            self.fd = self.proc.stdout.fileno()
+            # do not pass this pipe on to programs started later
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFD)
+            fcntl.fcntl(self.fd, fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+            flags = fcntl.fcntl(self.fd, fcntl.F_GETFL)
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            return True
+
+    def reap(self):
+        '''Returns exit code of the command, or None if it is still
+        running'''
+
+        returncode = self.proc.poll()
+        if returncode is None:
+            return None
+
+        self.proc.stdout.close()
+        self.proc = None
+        self.fd = -1
+        self.elapsed = time.time() - self.started
+        if returncode != 0:
+            self.returncode = returncode
+        elif self.command.phase is not None:
+            self._record()
+        return returncode
+
+    def _record(self):
+        '''record the duration of the command in the history'''
+
+        self.slow = synctool.history.record(self.command.nodename,
+                                            self.command.phase,
+                                            self.elapsed)
+
+    def kill(self):
+        '''terminate the running command'''
+
+        if self.proc is None:
+            return
+
+        try:
+            self.proc.terminate()
+        except OSError:
+            pass
+
+        self.proc.wait()
+        self.proc.stdout.close()
+        self.proc = None
+
+
+class _Concurrency(object):
+    '''the number of nodes to do at the same time'''
+
+    def __init__(self):
+        if (synctool.param.ADAPTIVE_NUM_PROC and
+                synctool.param.SLEEP_TIME == 0):
+            self.adaptive = True
+            self.low = synctool.param.MIN_NUM_PROC
+            self.high = synctool.param.MAX_NUM_PROC
+        else:
+            self.adaptive = False
+            self.low = self.high = max(synctool.param.NUM_PROC, 1)
+
+        # the number is kept as a float, so that it can grow
+        # by a fraction for every command
+        self.limit = float(self.low)
+        self.num = self.low
+        self.peak = self.num
+        # grow fast until the first time it is lowered
+        self.slow_start = True
+        self.decreased = 0.0
+        self.load_checked = 0.0
+        # moving average of the bytes per second of the rsyncs
+        self.rate = None
+        if synctool.param.MAX_LOAD is not None:
+            self.max_load = synctool.param.MAX_LOAD
+        else:
+            self.max_load = _num_cpus()
+
+    def update(self, job, returncode):
+        '''adapt to how the command of job went'''
+
+        if not self.adaptive:
+            return
+
+        command = job.command
+        # only for the connect probe, exit code 255 is sure to come
+        # from ssh; a remote command may exit with 255 as well
+        if returncode < 0 or (returncode == SSH_FAILED and
+                              command.phase ==
+                              synctool.history.PHASE_CONNECT):
+            self._decrease(job, '%s failed' % command.cmd_arr[0])
+        elif job.slow:
+            self._decrease(job, 'slow to connect to node %s' %
+                           command.nodename)
+        elif self._slow_rsync(job):
+            self._decrease(job, 'rsync slow for node %s' % command.nodename)
+        elif self._overloaded():
+            self._decrease(None, 'load average over %.1f' % self.max_load)
+        elif self.limit < self.high:
+            if self.slow_start:
+                self.limit = min(self.limit + 1.0, self.high)
+            else:
+                # one more for every round of num commands
+                self.limit = min(self.limit + 1.0 / self.num, self.high)
+            self.num = int(self.limit)
+            self.peak = max(self.peak, self.num)
+
+    def _decrease(self, job, reason):
+        '''halve the number of processes'''
+
+        if job is not None and job.started < self.decreased:
+            # it was already lowered while this command ran
+            return
+
+        self.decreased = time.time()
+        self.slow_start = False
+        num = max(self.num / 2, self.low)
+        if num < self.num:
+            verbose('lowering number of processes to %d: %s' % (num, reason))
+            self.num = num
+            self.limit = float(num)
+
+    def _slow_rsync(self, job):
+        '''Returns True if the rsync of job transferred much slower than
+        the rsyncs before it'''
+
+        nbytes = job.command.nbytes
+        if nbytes is None or nbytes < RATE_MIN_BYTES:
+            return False
+
+        rate = nbytes / max(job.elapsed, 0.001)
+        if self.rate is None:
+            self.rate = rate
+            return False
+
+        slow = rate * RATE_FACTOR < self.rate
+        self.rate += RATE_WEIGHT * (rate - self.rate)
+        return slow
+
+    def _overloaded(self):
+        '''Returns True if the load average of the master is too high'''
+
+        now = time.time()
+        if now - self.load_checked < LOAD_INTERVAL:
+            return False
+
+        self.load_checked = now
+        try:
+            load = os.getloadavg()[0]
+        except OSError:
+            return False
+
+        return load > self.max_load
+
+
+def _num_cpus():
+    '''Returns number of CPUs of this host'''
+
+    try:
+        return max(os.sysconf('SC_NPROCESSORS_ONLN'), 1)
+    except (ValueError, OSError):
+        return 1
+
+
+def _raise_fd_limit(num):
+    '''make sure that num more files can be opened'''
+
+    try:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    except (ValueError, resource.error):
+        return
+
+    wanted = num + SPARE_FDS
+    if soft == resource.RLIM_INFINITY or soft >= wanted:
+        return
+
+    if hard != resource.RLIM_INFINITY and hard < wanted:
+        wanted = hard
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (wanted, hard))
+    except (ValueError, resource.error):
+        pass
+
+
+class _Poller(object):
+    '''wait for output on a number of pipes
+    using poll() if the platform has it, else select()'''
+
+    def __init__(self):
+        if hasattr(select, 'poll'):
+            self.poll = select.poll()
+        else:
+            self.poll = None
+        self.fds = set()
+
+    def register(self, fd):
+        '''start watching fd'''
+
+        self.fds.add(fd)
+        if self.poll is not None:
+            self.poll.register(fd, select.POLLIN)
+
+    def unregister(self, fd):
+        '''stop watching fd'''
+
+        self.fds.discard(fd)
+        if self.poll is not None:
+            self.poll.unregister(fd)
+
+    def wait(self, timeout):
+        '''Returns list of fds that can be read
+        timeout is in seconds, or None to wait indefinitely'''
+
+        if self.poll is not None:
+            if timeout is not None:
+                timeout = int(timeout * 1000)
+            return [fd for fd, _ in self.poll.poll(timeout)]
+
+        if not self.fds:
+            time.sleep(timeout)
+            return []
+
+        readable, _, _ = select.select(list(self.fds), [], [], timeout)
+        return readable
+
+
+def run(fn, work, nodename_of=None):
+    '''run fn(item) for every item in work, for up to NUM_PROC items
+    at the same time
+    fn is a generator function that yields Commands
+    The items are started according to the rollout policy;
+    nodename_of(item) gives the nodename for an item
+    If --zzz was given, sleep after finishing an item
+    Returns dict: RESULTS[item] -> exit code of the last command
+    that failed, or 0'''
+
+    if synctool.param.SLEEP_TIME != 0:
+        synctool.param.NUM_PROC = 1
+
+    concurrency = _Concurrency()
+    _raise_fd_limit(concurrency.high)
+
+    scheduler = synctool.rollout.Scheduler(work, nodename_of)
+    results = {}
+
+    # JOBS[fd] -> job that is reading output from fd
+    jobs = {}
+    # jobs whose command closed its output, but did not exit yet
+    exiting = []
+    active = 0
+
+    poller = _Poller()
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+
+    try:
+        while scheduler.pending() or active:
+            while active < concurrency.num:
+                item = scheduler.next()
+                if item is None:
+                    break
+
+                gen = fn(item)
+                if gen is None:
+                    # a plain function; it did all of its work already
+                    results[item] = 0
+                    scheduler.done(item, 0)
+                    continue
+
+                job = Job(item, gen)
+                active += 1
+                if job.advance():
+                    jobs[job.fd] = job
+                    poller.register(job.fd)
+                else:
+                    results[item] = job.returncode
+                    active -= 1
+                    scheduler.done(item, job.returncode)
+
+            if exiting:
+                timeout = EXIT_INTERVAL
+            elif scheduler.pending() and active < concurrency.num:
+                # None when waiting for running nodes
+                timeout = scheduler.wait
+            else:
+                timeout = None
+
+            if timeout is None and not jobs:
+                continue
+
+            for fd in poller.wait(timeout):
+                job = jobs[fd]
+                try:
+                    data = os.read(fd, READ_SIZE)
+                except OSError as err:
+                    if err.errno in (errno.EAGAIN, errno.EINTR):
+                        continue
+                    data = ''
+
+                if data:
+                    job.output(data)
+                    continue
+
+                # end of output
+                job.flush()
+                poller.unregister(fd)
+                del jobs[fd]
+                exiting.append(job)
+
+            still_exiting = []
+            for job in exiting:
+                returncode = job.reap()
+                if returncode is None:
+                    still_exiting.append(job)
+                    continue
+
+                concurrency.update(job, returncode)
+                if job.advance(returncode):
+                    jobs[job.fd] = job
+                    poller.register(job.fd)
+                else:
+                    results[job.item] = job.returncode
+                    active -= 1
+                    scheduler.done(job.item, job.returncode)
+
+            exiting = still_exiting
+
+    finally:
+        # on error or Ctrl-C, stop all programs
+        for job in jobs.values() + exiting:
+            job.kill()
+
+        sys.stdout.flush()
+
+    if concurrency.adaptive:
+        verbose('number of processes: at most %d, at the end %d' %
+                (concurrency.peak, concurrency.num))
+
+    return results
+
+
+# EOB
@@ -0,0 +1,191 @@
+#
+#   synctool.history.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''how long the nodes took in previous runs
+
+    The master records for every node how long the rsync took, how long
+    ssh took to connect, and how long the client ran. The connect time
+    is measured with an ssh command of its own that only runs 'true'
+    on the node; it is subtracted from the ssh command that runs the
+    client. It keeps a moving average of each in a history file under
+    the state directory.
+    The next run starts the nodes that are expected to take longest
+    first, so that a slow node does not hold up the run by being
+    started last. Nodes that are not in the history are expected to be
+    as slow as the slowest known node.
+'''
+
+import os
+
+from synctool.lib import verbose, stderr
+import synctool.lib
+import synctool.param
+
+HISTORY_FILE = 'history'
+# version 3 measures the connect time with a probe of its own
+HISTORY_MAGIC = '# synctool history 3'
+
+# phases of the work for a node
+PHASE_RSYNC = 'rsync'
+PHASE_CONNECT = 'connect'
+PHASE_CLIENT = 'client'
+
+# weight of a new measurement in the moving average
+WEIGHT = 0.3
+
+# connecting is slow when it takes this many times longer
+# than usual, plus a margin (in seconds) for small numbers
+SLOW_FACTOR = 2.0
+SLOW_MARGIN = 0.5
+
+# HISTORY[nodename] -> dict: PHASES[phase] -> seconds
+HISTORY = {}
+
+# True if there were new measurements in this run
+CHANGED = False
+
+# CONNECTED[nodename] -> connect time of the node in this run
+CONNECTED = {}
+
+
+def _filename():
+    '''Returns full path to the history file'''
+
+    return os.path.join(synctool.param.STATE_DIR, HISTORY_FILE)
+
+
+def load():
+    '''load the history of previous runs'''
+
+    filename = _filename()
+    try:
+        with open(filename) as f:
+            lines = f.read().splitlines()
+    except IOError:
+        return
+
+    if not lines or lines[0] != HISTORY_MAGIC:
+        verbose('ignoring invalid history file %s' % filename)
+        return
+
+    for line in lines[1:]:
+        arr = line.split()
+        if len(arr) != 3:
+            continue
+
+        try:
+            seconds = float(arr[2])
+        except ValueError:
+            continue
+
+        if not arr[0] in HISTORY:
+            HISTORY[arr[0]] = {}
+        HISTORY[arr[0]][arr[1]] = seconds
+
+
+def _update(nodename, phase, seconds):
+    '''add a measurement to the moving average
+    Returns True if it was much slower than the average'''
+
+    global CHANGED
+
+    if not nodename in HISTORY:
+        HISTORY[nodename] = {}
+
+    CHANGED = True
+
+    phases = HISTORY[nodename]
+    if not phase in phases:
+        phases[phase] = seconds
+        return False
+
+    average = phases[phase]
+    phases[phase] += WEIGHT * (seconds - average)
+    return seconds > average * SLOW_FACTOR + SLOW_MARGIN
+
+
+def record(nodename, phase, elapsed):
+    '''record how long a command for a node took
+    Returns True if connecting was much slower than usual; this is a
+    sign that the master or the network is overloaded'''
+
+    if phase == PHASE_CONNECT:
+        CONNECTED[nodename] = elapsed
+    elif phase == PHASE_CLIENT and nodename in CONNECTED:
+        # the ssh command that runs the client connected as well
+        elapsed = max(elapsed - CONNECTED.pop(nodename), 0.0)
+
+    slow = _update(nodename, phase, elapsed)
+    # the client run depends on the node only, and the rsync on how much
+    # changed in the repository; see executor for the rsync throughput
+    return slow and phase == PHASE_CONNECT
+
+
+def expected(nodename):
+    '''Returns expected duration for node in seconds,
+    or None if the node is not in the history'''
+
+    if not nodename in HISTORY:
+        return None
+
+    return sum(HISTORY[nodename].values())
+
+
+def order(address_list, nodename_of):
+    '''Returns address_list sorted by expected duration, longest first
+    nodename_of(addr) gives the nodename for an address'''
+
+    known = [expected(nodename) for nodename in HISTORY]
+    if not known:
+        return address_list
+
+    # nodes not seen before go together with the slowest ones
+    slowest = max(known)
+
+    def _key(addr):
+        '''Returns sort key for address'''
+
+        seconds = expected(nodename_of(addr))
+        if seconds is None:
+            seconds = slowest
+        return -seconds
+
+    # sort is stable, so equal nodes keep their order
+    ordered = sorted(address_list, key=_key)
+    verbose('scheduling nodes by expected duration, longest first')
+    return ordered
+
+
+def save():
+    '''write the history'''
+
+    if not CHANGED:
+        return
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return
+
+    filename = _filename()
+    tmp_filename = filename + '.tmp'
+    try:
+        with open(tmp_filename, 'w') as f:
+            f.write(HISTORY_MAGIC + '\n')
+            for nodename in sorted(HISTORY):
+                phases = HISTORY[nodename]
+                for phase in sorted(phases):
+                    f.write('%s %s %.3f\n' % (nodename, phase,
+                                              phases[phase]))
+
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as err:
+        stderr('failed to write %s: %s' % (filename, err.strerror))
+
+
+# EOB
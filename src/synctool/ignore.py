@@ -0,0 +1,167 @@
+#
+#   synctool.ignore.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''matching of the 'ignore' rules in the overlay tree
+
+    The rules are compiled once into:
+    - a set of plain names
+    - one regular expression for all names with wildcards
+    - one regular expression for all path patterns
+
+    Path patterns are rules that contain a slash, like 'etc/**/*.rpmnew'.
+    They are anchored at the top of the group directory, and are matched
+    against the path of the entry in the repository (so, including any
+    group extension). '*' and '?' do not match a slash; '**' matches any
+    number of directories.
+'''
+
+import re
+
+import synctool.param
+
+# results of match()
+NO_MATCH = 0
+MATCH_NAME = 1
+MATCH_PATTERN = 2
+
+# the compiled rules
+NAMES = None
+NAME_REGEX = None
+PATH_REGEX = None
+
+
+def has_wildcards(pattern):
+    '''Returns True if the pattern has wildcards'''
+
+    return ('*' in pattern or '?' in pattern or
+            ('[' in pattern and ']' in pattern))
+
+
+def _translate_class(pattern, i):
+    '''translate character class that starts at pattern[i] (the '[')
+    Returns pair: regex, index after the class
+    or None, i if it is not a class'''
+
+    n = len(pattern)
+    j = i + 1
+    if j < n and pattern[j] == '!':
+        j += 1
+    if j < n and pattern[j] == ']':
+        j += 1
+    while j < n and pattern[j] != ']':
+        j += 1
+
+    if j >= n:
+        return None, i
+
+    chars = pattern[i + 1:j].replace('\\', '\\\\')
+    if chars[0] == '!':
+        chars = '^' + chars[1:]
+    elif chars[0] == '^':
+        chars = '\\' + chars
+
+    return '[%s]' % chars, j + 1
+
+
+def translate(pattern, path_pattern=False):
+    '''translate shell wildcard pattern to regular expression
+    For path patterns, wildcards do not match a slash'''
+
+    if path_pattern:
+        any_chars = '[^/]*'
+        any_char = '[^/]'
+    else:
+        any_chars = '.*'
+        any_char = '.'
+
+    res = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        c = pattern[i]
+
+        if c == '*':
+            if path_pattern and pattern[i:i + 3] == '**/':
+                # any number of directories, including none
+                res.append('(?:.*/)?')
+                i += 3
+                continue
+
+            if path_pattern and pattern[i:i + 2] == '**':
+                res.append('.*')
+                i += 2
+                continue
+
+            res.append(any_chars)
+
+        elif c == '?':
+            res.append(any_char)
+
+        elif c == '[':
+            regex, i = _translate_class(pattern, i)
+            if regex is not None:
+                res.append(regex)
+                continue
+
+            res.append('\\[')
+
+        else:
+            res.append(re.escape(c))
+
+        i += 1
+
+    return ''.join(res)
+
+
+def _compile_regex(patterns, path_pattern):
+    '''Returns compiled regex that matches any of the patterns,
+    or None if there are no patterns'''
+
+    if not patterns:
+        return None
+
+    regex = '|'.join(['(?:%s)' % translate(pattern, path_pattern)
+                      for pattern in patterns])
+    return re.compile('(?:%s)\\Z' % regex, re.DOTALL)
+
+
+def compile_rules():
+    '''compile the ignore rules from the config'''
+
+    global NAMES, NAME_REGEX, PATH_REGEX
+
+    NAMES = synctool.param.IGNORE_FILES
+    NAME_REGEX = _compile_regex(synctool.param.IGNORE_FILES_WITH_WILDCARDS,
+                                False)
+    PATH_REGEX = _compile_regex([pattern.lstrip('/') for pattern in
+                                 synctool.param.IGNORE_PATHS], True)
+
+
+def match(rel_dir, name):
+    '''rel_dir is the directory relative to the group directory,
+    with a trailing slash (or empty at the top)
+    Returns NO_MATCH, MATCH_NAME, or MATCH_PATTERN'''
+
+    if NAMES is None:
+        compile_rules()
+
+    if name in NAMES:
+        return MATCH_NAME
+
+    if NAME_REGEX is not None and NAME_REGEX.match(name):
+        return MATCH_PATTERN
+
+    if PATH_REGEX is not None and PATH_REGEX.match(rel_dir + name):
+        return MATCH_PATTERN
+
+    return NO_MATCH
+
+
+# EOB
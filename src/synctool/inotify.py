@@ -0,0 +1,133 @@
+#
+#   synctool.inotify.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''minimal binding to the Linux inotify API, using ctypes'''
+
+import os
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+# event masks, from <sys/inotify.h>
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+
+IN_CLOEXEC = 02000000
+
+# struct inotify_event: int wd; uint32 mask, cookie, len; char name[]
+EVENT_FORMAT = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_FORMAT)
+
+# buffer size for reading events
+READ_SIZE = 64 * 1024
+
+LIBC = None
+
+
+def _libc():
+    '''Returns handle to the C library
+    Raises OSError if inotify is not supported'''
+
+    global LIBC
+
+    if LIBC is None:
+        libname = ctypes.util.find_library('c')
+        if not libname:
+            raise OSError(errno.ENOSYS, 'C library not found')
+
+        libc = ctypes.CDLL(libname, use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify not supported')
+
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                           ctypes.c_uint32]
+        LIBC = libc
+
+    return LIBC
+
+
+def _error():
+    '''Returns OSError for the last failed call'''
+
+    err = ctypes.get_errno()
+    return OSError(err, os.strerror(err))
+
+
+class Inotify(object):
+    '''an inotify instance'''
+
+    def __init__(self):
+        '''Raises OSError on error'''
+
+        self.libc = _libc()
+        self.fd = self.libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            raise _error()
+
+    def fileno(self):
+        '''Returns file descriptor, for use with select()'''
+
+        return self.fd
+
+    def add_watch(self, path, mask):
+        '''Returns watch descriptor
+        Raises OSError on error'''
+
+        wd = self.libc.inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            raise _error()
+
+        return wd
+
+    def rm_watch(self, wd):
+        '''remove watch'''
+
+        # it fails if the watch is already gone, which is fine
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read(self):
+        '''read pending events; blocks if there are none
+        Returns list of tuples: (wd, mask, name)
+        name is an empty string for events on the watched dir itself'''
+
+        data = os.read(self.fd, READ_SIZE)
+
+        events = []
+        offset = 0
+        while offset + EVENT_SIZE <= len(data):
+            wd, mask, _, name_len = struct.unpack_from(EVENT_FORMAT, data,
+                                                       offset)
+            offset += EVENT_SIZE
+            name = data[offset:offset + name_len].rstrip('\0')
+            offset += name_len
+            events.append((wd, mask, name))
+
+        return events
+
+    def close(self):
+        '''close the inotify instance'''
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+# EOB
@@ -0,0 +1,440 @@
+#
+#   synctool.install.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''install files atomically
+
+    A file is copied to a temporary file in the destination directory,
+    which gets the owner, mode and timestamp of the source, and is then
+    renamed into place. The destination is never seen half-written.
+    The copy is done by the kernel when possible: first try to clone
+    the file (reflink), then copy_file_range(), then sendfile().
+    Only when all of those fail, the data is copied by reading and
+    writing it.
+    Installed files are not fsync'ed one by one; flush() syncs all of
+    them, and their directories, in one go at the end of the run.
+
+    Large files (see delta_size) may be rewritten by delta instead:
+    the destination is cloned and only the blocks that differ from the
+    source are written into the clone, which is then renamed into place
+    like any other installed file. If the file system can not clone,
+    the file is copied in full.
+'''
+
+import os
+import sys
+import stat
+import time
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import tempfile
+
+from synctool.lib import verbose, stderr
+import synctool.param
+
+# ioctl for cloning a file (reflink), from <linux/fs.h>
+FICLONE = 0x40049409
+
+POSIX_FADV_DONTNEED = 4
+
+# data of files this large is dropped from the page cache once copied
+LARGE_FILE = 64 * 1024 * 1024
+
+# max bytes per copy_file_range() or sendfile() call
+CHUNK_SIZE = 1024 * 1024 * 1024
+
+# I/O size when copying by reading and writing
+IO_SIZE = 1024 * 1024
+
+# block size for delta rewrites
+DELTA_BLOCK = 128 * 1024
+
+# errors that mean: this method of copying does not work here
+UNSUPPORTED = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+               errno.ENOTTY, errno.EBADF, errno.EPERM)
+
+# handle to the C library; False if it can not be used
+LIBC = None
+
+# methods that do not work, as found out during this run
+BROKEN = set()
+
+# devices (st_dev) on which files can not be cloned
+NO_CLONE = set()
+
+# files and directories that were changed and need to be synced
+PENDING_FILES = []
+PENDING_DIRS = set()
+
+# number of files copied by each method
+STATS = {}
+
+
+def _libc():
+    '''Returns handle to the C library, or False if not usable'''
+
+    global LIBC
+
+    if LIBC is None:
+        LIBC = False
+
+        if not sys.platform.startswith('linux'):
+            return LIBC
+
+        libname = ctypes.util.find_library('c')
+        if not libname:
+            return LIBC
+
+        try:
+            libc = ctypes.CDLL(libname, use_errno=True)
+        except OSError:
+            return LIBC
+
+        for name, argtypes in (
+                ('copy_file_range', [ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_int, ctypes.c_void_p,
+                                     ctypes.c_size_t, ctypes.c_uint]),
+                ('sendfile', [ctypes.c_int, ctypes.c_int, ctypes.c_void_p,
+                              ctypes.c_size_t]),
+                ('posix_fadvise', [ctypes.c_int, ctypes.c_int64,
+                                   ctypes.c_int64, ctypes.c_int])):
+            try:
+                func = getattr(libc, name)
+            except AttributeError:
+                # older libc; this method is not available
+                BROKEN.add(name)
+                continue
+
+            func.argtypes = argtypes
+            if name == 'posix_fadvise':
+                func.restype = ctypes.c_int
+            else:
+                func.restype = ctypes.c_ssize_t
+
+        LIBC = libc
+
+    return LIBC
+
+
+def _reflink(src_fd, dest_fd):
+    '''clone the file
+    Returns True on success'''
+
+    try:
+        fcntl.ioctl(dest_fd, FICLONE, src_fd)
+    except IOError as err:
+        if err.errno in UNSUPPORTED:
+            return False
+
+        raise
+
+    return True
+
+
+def _kernel_copy(method, src_fd, dest_fd):
+    '''copy data from the current offsets until end of file, using
+    copy_file_range() or sendfile()
+    Returns True on success, False if the method does not work
+    Raises OSError on error'''
+
+    libc = _libc()
+    if not libc or method in BROKEN:
+        return False
+
+    func = getattr(libc, method)
+    copied = 0
+
+    while True:
+        if method == 'copy_file_range':
+            n = func(src_fd, None, dest_fd, None, CHUNK_SIZE, 0)
+        else:
+            n = func(dest_fd, src_fd, None, CHUNK_SIZE)
+
+        if n == 0:
+            return True
+
+        if n < 0:
+            err = ctypes.get_errno()
+            if err == errno.EINTR:
+                continue
+
+            if copied == 0 and err in UNSUPPORTED:
+                # it may work for other files, but try it only once
+                BROKEN.add(method)
+                return False
+
+            raise OSError(err, os.strerror(err))
+
+        copied += n
+
+
+def _user_copy(src_fd, dest_fd):
+    '''copy data by reading and writing it'''
+
+    while True:
+        data = os.read(src_fd, IO_SIZE)
+        if not data:
+            break
+
+        while data:
+            n = os.write(dest_fd, data)
+            data = data[n:]
+
+
+def _fadvise_dontneed(fd):
+    '''drop data of file from the page cache'''
+
+    libc = _libc()
+    if libc and not 'posix_fadvise' in BROKEN:
+        libc.posix_fadvise(fd, 0, 0, POSIX_FADV_DONTNEED)
+
+
+def copy_data(src_fd, dest_fd, size):
+    '''copy contents of file src_fd to empty file dest_fd
+    size is the size of the source, for use as a hint
+    Returns the name of the method used
+    Raises OSError or IOError on error'''
+
+    if size > 0 and _reflink(src_fd, dest_fd):
+        method = 'reflink'
+    elif _kernel_copy('copy_file_range', src_fd, dest_fd):
+        method = 'copy_file_range'
+    elif _kernel_copy('sendfile', src_fd, dest_fd):
+        method = 'sendfile'
+    else:
+        _user_copy(src_fd, dest_fd)
+        method = 'read/write'
+
+    STATS[method] = STATS.get(method, 0) + 1
+
+    if size >= LARGE_FILE:
+        # do not keep both copies of a large file in the page cache
+        _fadvise_dontneed(src_fd)
+
+    return method
+
+
+def _set_meta(fd, statbuf):
+    '''set owner and mode of open file'''
+
+    # chown first, because it clears setuid bits
+    if os.geteuid() == 0:
+        os.fchown(fd, statbuf.uid, statbuf.gid)
+
+    os.fchmod(fd, statbuf.mode & 07777)
+
+
+def _patch(src_fd, old_fd, out_fd, size):
+    '''write the blocks of src_fd that differ from old_fd to out_fd
+    out_fd holds the same data as old_fd
+    Returns number of bytes written'''
+
+    written = 0
+    offset = 0
+    while offset < size:
+        data = os.read(src_fd, DELTA_BLOCK)
+        if not data:
+            break
+
+        if os.read(old_fd, DELTA_BLOCK) != data:
+            os.lseek(out_fd, offset, os.SEEK_SET)
+            while data:
+                n = os.write(out_fd, data)
+                data = data[n:]
+                written += n
+
+        offset += DELTA_BLOCK
+
+    os.ftruncate(out_fd, size)
+    return written
+
+
+def _delta_clone(src_fd, dest_path, statbuf):
+    '''clone dest_path into a temp file, patch it, and rename it
+    into place
+    Returns number of bytes written, or None if cloning is not possible
+    Raises OSError or IOError on error'''
+
+    dest_dir = os.path.dirname(dest_path)
+
+    old_fd = os.open(dest_path, os.O_RDONLY)
+    try:
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=dest_dir, prefix='.' +
+                                              os.path.basename(dest_path) +
+                                              '.')
+        try:
+            try:
+                if not _reflink(old_fd, tmp_fd):
+                    written = None
+                else:
+                    written = _patch(src_fd, old_fd, tmp_fd, statbuf.size)
+                    _set_meta(tmp_fd, statbuf)
+            finally:
+                os.close(tmp_fd)
+
+            if written is None:
+                os.unlink(tmp_path)
+                return None
+
+            os.utime(tmp_path, (time.time(), statbuf.mtime))
+            os.rename(tmp_path, dest_path)
+
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+            raise
+
+    finally:
+        if statbuf.size >= LARGE_FILE:
+            _fadvise_dontneed(old_fd)
+        os.close(old_fd)
+
+    return written
+
+
+def _delta_install(src_path, dest_path, statbuf):
+    '''rewrite only the blocks of dest_path that differ from src_path,
+    in a clone of dest_path that is renamed into place
+    Returns method name, or None if it can not be done
+    Raises OSError or IOError on error'''
+
+    try:
+        dest_stat = os.lstat(dest_path)
+    except OSError:
+        return None
+
+    if not stat.S_ISREG(dest_stat.st_mode):
+        return None
+
+    if dest_stat.st_dev in NO_CLONE:
+        return None
+
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        written = _delta_clone(src_fd, dest_path, statbuf)
+        if written is None:
+            # without a clone, all data must be written anyway
+            verbose('  can not clone files on the file system of %s' %
+                    dest_path)
+            NO_CLONE.add(dest_stat.st_dev)
+            return None
+
+        if statbuf.size >= LARGE_FILE:
+            _fadvise_dontneed(src_fd)
+
+    finally:
+        os.close(src_fd)
+
+    STATS['delta'] = STATS.get('delta', 0) + 1
+    return 'delta, wrote %d of %d bytes' % (written, statbuf.size)
+
+
+def _pending(dest_path, statbuf):
+    '''remember installed file for flush()'''
+
+    if synctool.param.FSYNC:
+        PENDING_FILES.append((dest_path, statbuf.size >= LARGE_FILE))
+        PENDING_DIRS.add(os.path.dirname(dest_path))
+
+
+def install_file(src_path, dest_path, statbuf):
+    '''copy src_path to dest_path with the owner, mode and
+    modification time in statbuf (a SyncStat of src_path)
+    The owner is set only when running as root
+    Raises OSError or IOError on error'''
+
+    if (synctool.param.DELTA_SIZE > 0 and
+            statbuf.size >= synctool.param.DELTA_SIZE * 1024 * 1024):
+        method = _delta_install(src_path, dest_path, statbuf)
+        if method is not None:
+            verbose('  installed %s (%s)' % (dest_path, method))
+            _pending(dest_path, statbuf)
+            return
+
+    dest_dir = os.path.dirname(dest_path)
+
+    src_fd = os.open(src_path, os.O_RDONLY)
+    try:
+        (tmp_fd, tmp_path) = tempfile.mkstemp(dir=dest_dir, prefix='.' +
+                                              os.path.basename(dest_path) +
+                                              '.')
+        try:
+            try:
+                method = copy_data(src_fd, tmp_fd, statbuf.size)
+                _set_meta(tmp_fd, statbuf)
+            finally:
+                os.close(tmp_fd)
+
+            os.utime(tmp_path, (time.time(), statbuf.mtime))
+            os.rename(tmp_path, dest_path)
+
+        except:
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+            raise
+
+    finally:
+        os.close(src_fd)
+
+    verbose('  installed %s (%s)' % (dest_path, method))
+    _pending(dest_path, statbuf)
+
+
+def flush():
+    '''sync all installed files and their directories to disk'''
+
+    if not PENDING_FILES:
+        return
+
+    verbose('syncing %d installed files' % len(PENDING_FILES))
+
+    for path, large in PENDING_FILES:
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            # it is gone already
+            continue
+
+        try:
+            os.fsync(fd)
+            if large:
+                # it is on disk now; the page cache need not keep it
+                _fadvise_dontneed(fd)
+        except OSError as err:
+            stderr('error: fsync(%s) failed: %s' % (path, err.strerror))
+        finally:
+            os.close(fd)
+
+    for path in sorted(PENDING_DIRS):
+        try:
+            fd = os.open(path, os.O_RDONLY)
+        except OSError:
+            continue
+
+        try:
+            os.fsync(fd)
+        except OSError:
+            # not all filesystems can sync a directory
+            pass
+        finally:
+            os.close(fd)
+
+    del PENDING_FILES[:]
+    PENDING_DIRS.clear()
+
+
+# EOB
@@ -0,0 +1,296 @@
+#
+#   synctool.iobudget.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''limit the impact of comparing files on a busy node
+
+    Reads done for comparing files (see synctool.compare) are charged
+    to a budget of bytes and reads per second. When the budget is used
+    up, the reading thread sleeps until there is budget again; nothing
+    is skipped, so the outcome of a run does not change, it only takes
+    longer.
+    Optionally, the client runs with idle I/O priority and a low CPU
+    priority, and pages of large files that were not in the page cache
+    before they were read are dropped from the cache afterwards.
+'''
+
+import os
+import re
+import sys
+import time
+import mmap
+import ctypes
+import ctypes.util
+import threading
+
+from synctool.lib import verbose
+import synctool.lib
+import synctool.param
+
+# the budget may be used up to one second ahead
+# TOKENS are what is left of it: [bytes, reads]
+TOKENS = [0.0, 0.0]
+LAST_TIME = 0.0
+BUDGET_LOCK = threading.Lock()
+
+# statistics
+BYTES_READ = 0
+READS = 0
+# wall time during which at least one thread was sleeping
+THROTTLED = 0.0
+# number of threads that are sleeping, and since when
+SLEEPING = 0
+SLEEP_START = 0.0
+
+# only check the page cache for files this large
+DROP_SIZE = 4 * 1024 * 1024
+
+PAGE_SIZE = mmap.PAGESIZE
+
+POSIX_FADV_SEQUENTIAL = 2
+POSIX_FADV_WILLNEED = 3
+POSIX_FADV_DONTNEED = 4
+
+# ioprio_set() syscall numbers per machine type
+IOPRIO_SET = {'x86_64': 251, 'i386': 289, 'i686': 289, 'aarch64': 30,
+              'armv7l': 314, 'ppc64': 273, 'ppc64le': 273}
+IOPRIO_GET = {'x86_64': 252, 'i386': 290, 'i686': 290, 'aarch64': 31,
+              'armv7l': 315, 'ppc64': 274, 'ppc64le': 274}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_SHIFT = 13
+IOPRIO_CLASS_IDLE = 3
+
+# priorities before going idle: (ioprio, nice), or None
+SAVED_PRIORITY = None
+
+# handle to the C library; False if it can not be used
+LIBC = None
+
+
+def _libc():
+    '''Returns handle to the C library, or False if not usable'''
+
+    global LIBC
+
+    if LIBC is None:
+        LIBC = False
+
+        if not sys.platform.startswith('linux'):
+            return LIBC
+
+        libname = ctypes.util.find_library('c')
+        if not libname:
+            return LIBC
+
+        try:
+            libc = ctypes.CDLL(libname, use_errno=True)
+            libc.mmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                  ctypes.c_int, ctypes.c_int, ctypes.c_int,
+                                  ctypes.c_int64]
+            libc.mmap.restype = ctypes.c_void_p
+            libc.munmap.argtypes = [ctypes.c_void_p, ctypes.c_size_t]
+            libc.mincore.argtypes = [ctypes.c_void_p, ctypes.c_size_t,
+                                     ctypes.c_char_p]
+            libc.posix_fadvise.argtypes = [ctypes.c_int, ctypes.c_int64,
+                                           ctypes.c_int64, ctypes.c_int]
+            libc.syscall.restype = ctypes.c_long
+        except (OSError, AttributeError):
+            return LIBC
+
+        LIBC = libc
+
+    return LIBC
+
+
+def _ioprio(value=None):
+    '''get or set I/O priority of this process
+    Returns the priority, or -1 on error'''
+
+    libc = _libc()
+    machine = os.uname()[4]
+    if not libc or not machine in IOPRIO_SET:
+        return -1
+
+    if value is None:
+        return libc.syscall(IOPRIO_GET[machine], IOPRIO_WHO_PROCESS, 0)
+
+    return libc.syscall(IOPRIO_SET[machine], IOPRIO_WHO_PROCESS, 0, value)
+
+
+def start():
+    '''start using the budget
+    This sets the priority of the process if configured to do so'''
+
+    global LAST_TIME, SAVED_PRIORITY
+
+    LAST_TIME = time.time()
+    TOKENS[0] = synctool.param.COMPARE_MAX_READ * 1024.0 * 1024.0
+    TOKENS[1] = float(synctool.param.COMPARE_MAX_IOPS)
+
+    if synctool.param.COMPARE_IDLE and SAVED_PRIORITY is None:
+        SAVED_PRIORITY = (_ioprio(), os.nice(0))
+
+        if _ioprio(IOPRIO_CLASS_IDLE << IOPRIO_CLASS_SHIFT) < 0:
+            verbose('failed to set idle I/O priority')
+
+        os.nice(19 - SAVED_PRIORITY[1])
+
+
+def stop():
+    '''restore priority of the process and report statistics'''
+
+    global SAVED_PRIORITY
+
+    if SAVED_PRIORITY is not None:
+        ioprio, niceness = SAVED_PRIORITY
+        SAVED_PRIORITY = None
+
+        if ioprio >= 0:
+            _ioprio(ioprio)
+
+        try:
+            os.nice(niceness - os.nice(0))
+        except OSError:
+            # only root may raise the priority again
+            pass
+
+    if THROTTLED > 0.0:
+        msg = ('compare read %.1f MB in %d reads, throttled for %.1f s' %
+               (BYTES_READ / (1024.0 * 1024.0), READS, THROTTLED))
+        verbose(msg)
+        synctool.lib.log(msg)
+
+
+def charge(nbytes, nreads=1):
+    '''charge reads to the budget
+    Sleeps if the budget is used up'''
+
+    global BYTES_READ, READS, LAST_TIME, SLEEPING, SLEEP_START
+
+    if nbytes <= 0:
+        return
+
+    max_bytes = synctool.param.COMPARE_MAX_READ * 1024.0 * 1024.0
+    max_reads = float(synctool.param.COMPARE_MAX_IOPS)
+
+    with BUDGET_LOCK:
+        BYTES_READ += nbytes
+        READS += nreads
+
+        if not max_bytes and not max_reads:
+            return
+
+        now = time.time()
+        elapsed = now - LAST_TIME
+        LAST_TIME = now
+
+        delay = 0.0
+        for idx, used, limit in ((0, nbytes, max_bytes),
+                                 (1, nreads, max_reads)):
+            if not limit:
+                continue
+
+            TOKENS[idx] = min(TOKENS[idx] + elapsed * limit, limit) - used
+            if TOKENS[idx] < 0.0:
+                delay = max(delay, -TOKENS[idx] / limit)
+
+        if delay <= 0.0:
+            return
+
+        # with parallel compares, threads sleep at the same time;
+        # count the time only once
+        if SLEEPING == 0:
+            SLEEP_START = now
+        SLEEPING += 1
+
+    try:
+        time.sleep(delay)
+    finally:
+        _wake_up()
+
+
+def _wake_up():
+    '''a thread is done sleeping'''
+
+    global THROTTLED, SLEEPING
+
+    with BUDGET_LOCK:
+        SLEEPING -= 1
+        if SLEEPING == 0:
+            THROTTLED += time.time() - SLEEP_START
+
+
+def uncached(fd, size):
+    '''Returns list of (offset, length) ranges of the open file that are
+    not in the page cache, or None if it is not known
+    Returns None unless compare_drop_cache is enabled'''
+
+    if not synctool.param.COMPARE_DROP_CACHE or size < DROP_SIZE:
+        return None
+
+    libc = _libc()
+    if not libc:
+        return None
+
+    # mincore() does not touch the pages, but do not map beyond the end
+    # of a file that was truncated since it was stat'ed
+    try:
+        size = min(size, os.fstat(fd).st_size)
+    except OSError:
+        return None
+
+    if size < DROP_SIZE:
+        return None
+
+    addr = libc.mmap(None, size, mmap.PROT_READ, mmap.MAP_SHARED, fd, 0)
+    if addr is None or addr == ctypes.c_void_p(-1).value:
+        return None
+
+    try:
+        vec = ctypes.create_string_buffer((size + PAGE_SIZE - 1) / PAGE_SIZE)
+        if libc.mincore(addr, size, vec) != 0:
+            return None
+    finally:
+        libc.munmap(addr, size)
+
+    # pages that are not resident have a zero byte in the vector
+    return [(m.start() * PAGE_SIZE, (m.end() - m.start()) * PAGE_SIZE)
+            for m in re.finditer('\x00+', vec.raw)]
+
+
+def sequential(fd):
+    '''hint that the open file will be read sequentially
+    This makes the kernel read ahead further'''
+
+    libc = _libc()
+    if libc:
+        libc.posix_fadvise(fd, 0, 0, POSIX_FADV_SEQUENTIAL)
+
+
+def read_ahead(fd, offset, length):
+    '''hint that the range of the open file will be read soon
+    The kernel starts reading it in the background'''
+
+    libc = _libc()
+    if libc:
+        libc.posix_fadvise(fd, offset, length, POSIX_FADV_WILLNEED)
+
+
+def drop(fd, ranges):
+    '''drop ranges of the open file from the page cache'''
+
+    if not ranges:
+        return
+
+    libc = _libc()
+    for offset, length in ranges:
+        libc.posix_fadvise(fd, offset, length, POSIX_FADV_DONTNEED)
+
+
+# EOB
@@ -14,11 +14,7 @@ import os
 import sys
 import subprocess
 import shlex
-import time
 import syslog
-import signal
-import multiprocessing
-import Queue
 
 import synctool.param
 
@@ -311,22 +307,26 @@ def run_with_nodename(cmd_arr, nodename):
 
     with f:
         for line in f:
-            line = line.rstrip()
-
-            # if output is a log line, pass it to the master's syslog
-            if line[:15] == '%synctool-log% ':
-                if line[15:] == '--':
-                    pass
-                else:
-                    _masterlog('%s: %s' % (nodename, line[15:]))
-            else:
-                # pass output on; simply use 'print' rather than 'stdout()'
-                if OPT_NODENAME:
-                    print '%s: %s' % (nodename, line)
-                else:
-                    # do not prepend the nodename of this node to the output
-                    # if option --no-nodename was given
-                    print line
+            output_with_nodename(line.rstrip(), nodename)
+
+
+def output_with_nodename(line, nodename):
+    '''show line of output of a command run for nodename'''
+
+    # if output is a log line, pass it to the master's syslog
+    if line[:15] == '%synctool-log% ':
+        if line[15:] == '--':
+            pass
+        else:
+            _masterlog('%s: %s' % (nodename, line[15:]))
+    else:
+        # pass output on; simply use 'print' rather than 'stdout()'
+        if OPT_NODENAME:
+            print '%s: %s' % (nodename, line)
+        else:
+            # do not prepend the nodename of this node to the output
+            # if option --no-nodename was given
+            print line
 
 
 def shell_command(cmd):
@@ -521,71 +521,4 @@ def prepare_path(path):
     return path
 
 
-def multiprocess(fn, work):
-    '''run a function in parallel'''
-
-    # Thanks go to Bryce Boe
-    # http://www.bryceboe.com/2010/08/26/ \
-    #   python-multiprocessing-and-keyboardinterrupt/
-
-    if synctool.param.SLEEP_TIME != 0:
-        synctool.param.NUM_PROC = 1
-
-    # make a work queue
-    jobq = multiprocessing.Queue()
-    for item in work:
-        jobq.put(item)
-
-    # start NUMPROC worker processes
-    pool = []
-    i = 0
-    while i < synctool.param.NUM_PROC:
-        p = multiprocessing.Process(target=_worker, args=(fn, jobq))
-        pool.append(p)
-        p.start()
-        i += 1
-
-    try:
-        for p in pool:
-            p.join()
-
-    except KeyboardInterrupt:
-        # user hit Ctrl-C
-        # terminate all workers
-        for p in pool:
-            p.terminate()
-            p.join()
-
-        # re-raise KeyboardInterrupt, for __main__ to catch
-        raise
-
-
-def _worker(fn, jobq):
-    '''fn is the worker function to call
-    jobq is a multiprocessing.Queue of function arguments
-    If --zzz was given, sleep after finishing the work
-    No return value is passed back'''
-
-    # ignore interrupts, ignore Ctrl-C
-    # the Ctrl-C will be caught by the parent process
-    signal.signal(signal.SIGINT, signal.SIG_IGN)
-
-    while not jobq.empty():
-        try:
-            arg = jobq.get(block=False)
-        except Queue.Empty:
-            break
-
-        else:
-            fn(arg)
-
-            if synctool.param.SLEEP_TIME > 0:
-                time.sleep(synctool.param.SLEEP_TIME)
-
-
-if __name__ == '__main__':
-    # __main__ is needed because of multiprocessing module
-    pass
-
-
 # EOB
@@ -0,0 +1,239 @@
+#
+#   synctool.listing.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''list directories of the overlay tree ahead of time, using a pool
+of threads
+
+    On a network filesystem, walking the overlay tree mostly means
+    waiting for directory listings. When visiting the overlay, the group
+    directories are handed to the pool, which lists them and all of their
+    subdirectories concurrently. The walk itself still goes through the
+    groups one by one, in order of importance, and picks up the listings
+    from the pool; so the selected entries and the order in which they
+    are visited do not change.
+    The pool skips the directories that the walk skips: ignored ones,
+    and those with the extension of a group that is not ours. A
+    directory is queued before its parent is marked as listed, so the
+    walk never lists a directory that the pool is about to list.
+    The pool only reads directories; it never prints messages. Errors
+    are passed on to the walk, which handles them as before.
+    When the walk skips directories that are known to be in sync (see
+    synctool.dirstate), the pool does not list the directories that the
+    master saw no change to, only their subdirectories. It takes the
+    fingerprint of a directory before listing it.
+'''
+
+import os
+import stat
+import threading
+import Queue
+
+import synctool.dirent
+import synctool.dirstate
+import synctool.ignore
+import synctool.param
+
+# queue of listings for the pool
+JOB_QUEUE = None
+THREADS = []
+
+# LISTINGS[path] -> Listing
+LISTINGS = {}
+
+# the groups of this node, for skipping directories of other groups
+MY_GROUPS = None
+
+# whether the walk skips directories that are known to be in sync
+SKIP_DIRS = False
+
+
+class Listing(object):
+    '''a directory listing job'''
+
+    __slots__ = ('path', 'rel_dir', 'entries', 'error', 'done')
+
+    def __init__(self, path, rel_dir):
+        self.path = path
+        # path relative to the group dir, with a trailing slash
+        self.rel_dir = rel_dir
+        self.entries = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        '''list the directory
+        Returns list of (path, rel_dir) of the subdirectories that
+        the walk will enter'''
+
+        if SKIP_DIRS:
+            synctool.dirstate.dir_fingerprint(self.path)
+
+        try:
+            self.entries = synctool.dirent.listdir(self.path)
+        except OSError as err:
+            # leave it to the main thread to report the error
+            self.error = err
+            return []
+
+        subdirs = []
+        for name, d_type in self.entries:
+            if not _wanted(self.rel_dir, name):
+                continue
+
+            path = os.path.join(self.path, name)
+
+            if d_type == synctool.dirent.DT_UNKNOWN:
+                try:
+                    if not stat.S_ISDIR(os.lstat(path).st_mode):
+                        continue
+                except OSError:
+                    continue
+
+            elif d_type != synctool.dirent.DT_DIR:
+                continue
+
+            subdirs.append((path, self.rel_dir + name + os.sep))
+
+        return subdirs
+
+
+def _wanted(rel_dir, name):
+    '''Returns True if the walk may enter directory name
+    This mirrors the checks in overlay._walk_subtree()'''
+
+    if synctool.ignore.match(rel_dir, name) != synctool.ignore.NO_MATCH:
+        return False
+
+    if synctool.param.IGNORE_DOTDIRS and name[0] == '.':
+        return False
+
+    ext = os.path.splitext(name)[1]
+    if ext[:2] == '._' and len(ext) > 2 and ext != '._template':
+        if not ext[2:] in MY_GROUPS:
+            return False
+
+    return True
+
+
+def _submit(queue, path, rel_dir):
+    '''submit directory for listing'''
+
+    if SKIP_DIRS:
+        subdirs = synctool.dirstate.unchanged_subdirs(path)
+        if subdirs is not None:
+            # the walk is likely to skip it; only list the subdirectories
+            for name in subdirs:
+                _submit(queue, os.path.join(path, name),
+                        rel_dir + name + os.sep)
+            return
+
+    listing = Listing(path, rel_dir)
+    LISTINGS[path] = listing
+    queue.put(listing)
+
+
+def _worker(queue):
+    '''thread main function'''
+
+    while True:
+        listing = queue.get()
+        if listing is None:
+            break
+
+        try:
+            subdirs = listing.run()
+
+            # queue the subdirectories before the walk gets to them
+            if queue is JOB_QUEUE:
+                for path, rel_dir in subdirs:
+                    _submit(queue, path, rel_dir)
+        finally:
+            listing.done.set()
+
+        if queue is not JOB_QUEUE:
+            # the pool was stopped
+            break
+
+
+def start(dirs, num_threads, skip_dirs=False):
+    '''start the pool and let it list the trees under dirs
+    skip_dirs is True when the walk skips directories
+    that are known to be in sync'''
+
+    global JOB_QUEUE, MY_GROUPS, SKIP_DIRS
+
+    if num_threads <= 1 or not dirs:
+        return
+
+    # compile the rules now; the threads only use them
+    synctool.ignore.compile_rules()
+    MY_GROUPS = set(synctool.param.MY_GROUPS)
+    SKIP_DIRS = skip_dirs
+
+    JOB_QUEUE = Queue.Queue()
+    for path in dirs:
+        _submit(JOB_QUEUE, path, '')
+
+    for _ in xrange(num_threads):
+        t = threading.Thread(target=_worker, args=(JOB_QUEUE,))
+        t.daemon = True
+        t.start()
+        THREADS.append(t)
+
+
+def stop():
+    '''stop the pool'''
+
+    global JOB_QUEUE
+
+    if JOB_QUEUE is None:
+        return
+
+    queue = JOB_QUEUE
+    JOB_QUEUE = None
+
+    # drop any listings that did not start yet
+    while True:
+        try:
+            queue.get_nowait()
+        except Queue.Empty:
+            break
+
+    for _ in THREADS:
+        queue.put(None)
+
+    for t in THREADS:
+        while t.is_alive():
+            t.join(1.0)
+
+    del THREADS[:]
+    LISTINGS.clear()
+
+
+def listdir(path):
+    '''Returns list of tuples: (name, type), like synctool.dirent.listdir()
+    The listing is taken from the pool if it has it
+    Raises OSError on error'''
+
+    listing = LISTINGS.pop(path, None)
+    if listing is None:
+        return synctool.dirent.listdir(path)
+
+    # wait with a timeout, or else signals are not delivered
+    while not listing.done.is_set():
+        listing.done.wait(1.0)
+
+    if listing.error is not None:
+        raise listing.error
+
+    return listing.entries
+
+
+# EOB
@@ -17,13 +17,28 @@ import shlex
 import getopt
 import subprocess
 
+import synctool.checkpoint
 import synctool.config
+import synctool.digest
+import synctool.dirstate
+import synctool.drift
+import synctool.install
+import synctool.iobudget
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, terse, unix_out, prettypath
 from synctool.main.wrapper import catch_signals
+import synctool.manifest
 import synctool.overlay
 import synctool.param
+import synctool.pathset
+import synctool.plan
+from synctool.pathset import PathSet
+import synctool.postqueue
+import synctool.prefetch
+import synctool.purge
+import synctool.saved
 import synctool.syncstat
+import synctool.tmplcache
 
 # hardcoded name because otherwise we get "synctool_client.py"
 PROGNAME = 'synctool-client'
@@ -34,7 +49,31 @@ ACTION_DIFF = 1
 ACTION_ERASE_SAVED = 2
 ACTION_REFERENCE = 3
 
-SINGLE_FILES = []
+SINGLE_FILES = PathSet()
+
+# use manifest made by the master
+OPT_MANIFEST = False
+
+# use the tree hash made by the master
+OPT_TREE_HASH = False
+
+# number of threads for comparing files
+OPT_JOBS = 1
+
+# time budget in seconds for checking the overlay tree; None is no limit
+OPT_TIME_BUDGET = None
+
+# position in the overlay order; see synctool.checkpoint
+CURSOR = None
+
+# record a plan in a dry run, or apply it with --fix; see synctool.plan
+OPT_PLAN = False
+OPT_APPLY_PLAN = False
+
+# for --erase-saved: number of backups to keep per path,
+# and only erase backups older than this many days
+OPT_KEEP_SAVED = 0
+OPT_SAVED_OLDER_THAN = 0
 
 
 def generate_template(obj, post_dict):
@@ -82,6 +121,19 @@ def generate_template(obj, post_dict):
 
     generator = post_dict[template]
 
+    cache_key = None
+    if synctool.param.TEMPLATE_CACHE:
+        cache_key = synctool.tmplcache.make_key(obj.src_path, generator,
+                                                newname)
+        if cache_key and synctool.tmplcache.restore(cache_key, newname):
+            verbose('using cached output %s' % newname)
+
+            # modify the object; set new src and dest filenames
+            # later, visit() will call obj.make(), which will make full paths
+            obj.src_path = newname
+            obj.dest_path = os.path.basename(obj.dest_path)
+            return True
+
     # chdir to source directory
     # Note: the change dir is not really needed
     # but the documentation promises that .post scripts run in
@@ -123,6 +175,9 @@ def generate_template(obj, post_dict):
     else:
         verbose('found generated output %s' % newname)
 
+        if cache_key and not have_error:
+            synctool.tmplcache.store(cache_key, newname)
+
     os.umask(077)
 
     # chdir back to original location
@@ -145,64 +200,8 @@ def generate_template(obj, post_dict):
     return True
 
 
-def run_command(cmd):
-    '''run a shell command'''
-
-    # a command can have arguments
-    arr = shlex.split(cmd)
-    cmdfile = arr[0]
-
-    statbuf = synctool.syncstat.SyncStat(cmdfile)
-    if not statbuf.exists():
-        stderr('error: command %s not found' % prettypath(cmdfile))
-        return
-
-    if not statbuf.is_exec():
-        stderr("warning: file '%s' is not executable" % prettypath(cmdfile))
-        return
-
-    # run the shell command
-    synctool.lib.shell_command(cmd)
-
-
-def run_command_in_dir(dest_dir, cmd):
-    '''change directory to dest_dir, and run the shell command'''
-
-    verbose('  os.chdir(%s)' % dest_dir)
-    unix_out('cd %s' % dest_dir)
-
-    cwd = os.getcwd()
-
-    # if dry run, the target directory may not exist yet
-    # (mkdir has not been called for real, for a dry run)
-    if synctool.lib.DRY_RUN:
-        run_command(cmd)
-
-        verbose('  os.chdir(%s)' % cwd)
-        unix_out('cd %s' % cwd)
-        unix_out('')
-        return
-
-    try:
-        os.chdir(dest_dir)
-    except OSError as err:
-        stderr('error changing directory to %s: %s' % (dest_dir,
-                                                       err.strerror))
-    else:
-        run_command(cmd)
-
-        verbose('  os.chdir(%s)' % cwd)
-        unix_out('cd %s' % cwd)
-        unix_out('')
-
-        try:
-            os.chdir(cwd)
-        except OSError as err:
-            stderr('error changing directory to %s: %s' % (cwd, err.strerror))
-
-
 def _run_post(obj, post_script):
-    '''run the .post script that goes with the object'''
+    '''queue the .post script that goes with the object'''
 
     if synctool.lib.NO_POST:
         return
@@ -210,18 +209,12 @@ def _run_post(obj, post_script):
     if not post_script:
         return
 
-    # temporarily restore original umask
-    # so the script runs with the umask set by the sysadmin
-    os.umask(synctool.param.ORIG_UMASK)
-
     if obj.dest_stat.is_dir():
         # run in the directory itself
-        run_command_in_dir(obj.dest_path, post_script)
+        synctool.postqueue.add(post_script, obj.dest_path)
     else:
         # run in the directory where the file is
-        run_command_in_dir(os.path.dirname(obj.dest_path), post_script)
-
-    os.umask(077)
+        synctool.postqueue.add(post_script, os.path.dirname(obj.dest_path))
 
 
 def purge_files():
@@ -258,6 +251,10 @@ def purge_files():
                 # do not recurse into this dir any deeper
                 del subdirs[:]
 
+    if not synctool.param.PURGE_RSYNC:
+        synctool.purge.purge(paths, OPT_JOBS)
+        return
+
     cmd_rsync, opts_string = _make_rsync_purge_cmd()
 
     # call rsync to copy the purge dirs
@@ -362,23 +359,101 @@ def _run_rsync_purge(cmd_arr):
             stdout('%s mismatch (purge)' % prettypath(path))
 
 
+def _check(obj):
+    '''check SyncObject, unless it is known to be in sync
+    Returns pair: updated, metadata_updated'''
+
+    if synctool.param.DIR_STATE and synctool.dirstate.unchanged(obj):
+        synctool.dirstate.skip(obj)
+        if synctool.plan.RECORDING:
+            synctool.plan.record(obj, [])
+        return False, False
+
+    if synctool.plan.applying():
+        actions = synctool.plan.lookup(obj)
+        synctool.plan.count(actions is not None)
+        if actions is not None:
+            updated, meta_updated = obj.fix(actions, report=True)
+        else:
+            updated, meta_updated = obj.check()
+
+    elif synctool.plan.RECORDING:
+        actions = obj.diff()
+        synctool.plan.record(obj, actions)
+        updated, meta_updated = obj.fix(actions)
+
+    else:
+        updated, meta_updated = obj.check()
+
+    if (updated or meta_updated) and not synctool.lib.DRY_RUN:
+        synctool.prefetch.changed()
+
+    if synctool.param.DIR_STATE and not (updated or meta_updated):
+        synctool.dirstate.record(obj)
+
+    return updated, meta_updated
+
+
+def _skip_callback(obj, post_dict, dir_changed, *args):
+    '''pass over object that is not checked in this run
+    Returns pair: True (continue), False (not updated)'''
+
+    if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+        # do not generate it
+        obj.ov_type = synctool.overlay.OV_IGNORE
+        return True, False
+
+    if (synctool.param.DIR_STATE and
+            not synctool.checkpoint.priority(obj.dest_path)):
+        synctool.dirstate.carry(obj)
+
+    if (obj.src_stat.is_dir() and dir_changed and
+            obj.dest_path in post_dict):
+        # some entries in it were checked and updated
+        _run_post(obj, post_dict[obj.dest_path])
+
+    return True, False
+
+
+def _priority_callback(obj, post_dict, dir_changed, *args):
+    '''check objects under the priority paths only
+    Returns pair: True (continue), updated (data or metadata)'''
+
+    if not synctool.checkpoint.priority(obj.dest_path):
+        if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+            # do not generate it now
+            obj.ov_type = synctool.overlay.OV_IGNORE
+        return True, False
+
+    return _overlay_callback(obj, post_dict, dir_changed, *args)
+
+
 def _overlay_callback(obj, post_dict, dir_changed, *args):
     '''compare files and run post-script if needed
     Returns pair: True (continue), updated (data or metadata)'''
 
+    if synctool.prefetch.active():
+        synctool.prefetch.adopt(obj)
+
+    if CURSOR is not None and not CURSOR.wanted(obj):
+        return _skip_callback(obj, post_dict, dir_changed, *args)
+
     if obj.ov_type == synctool.overlay.OV_TEMPLATE:
-        return generate_template(obj, post_dict), False
+        ok = generate_template(obj, post_dict)
+        # the script may have changed anything
+        synctool.prefetch.changed()
+        return ok, False
 
     verbose('checking %s' % obj.print_src())
 
     if obj.src_stat.is_dir():
-        updated, meta_updated = obj.check()
+        updated, meta_updated = _check(obj)
         if (dir_changed or updated) and obj.dest_path in post_dict:
             _run_post(obj, post_dict[obj.dest_path])
 
         return True, updated | meta_updated
 
-    updated, meta_updated = obj.check()
+    updated, meta_updated = _check(obj)
     if updated and obj.dest_path in post_dict:
         _run_post(obj, post_dict[obj.dest_path])
         return True, True
@@ -386,10 +461,79 @@ def _overlay_callback(obj, post_dict, dir_changed, *args):
     return True, updated | meta_updated
 
 
+def _lookahead(objs):
+    '''let the pool check the SyncObjects ahead of the walk'''
+
+    for obj in objs:
+        if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+            # templates are generated first
+            continue
+
+        if CURSOR is not None and (not CURSOR.resumed or CURSOR.stopped or
+                                   synctool.checkpoint.priority(
+                                       obj.dest_path)):
+            # it is not checked in this run
+            continue
+
+        # an entry in the plan was compared by the dry run
+        synctool.prefetch.submit(obj, not (synctool.plan.applying() and
+                                           obj.dest_path in
+                                           synctool.plan.PLAN))
+
+
+def _start_dirstate():
+    '''set up synctool.dirstate for a run over all entries'''
+
+    tree_hash = None
+    if OPT_TREE_HASH:
+        tree_hash = synctool.manifest.load_tree_hash()
+
+    # the recorded directories depend on how the overlay is resolved
+    context = (synctool.manifest.settings(),
+               list(synctool.param.MY_GROUPS),
+               sorted(synctool.param.ALL_GROUPS),
+               synctool.overlay.MANIFEST is not None)
+    synctool.dirstate.start(context, tree_hash)
+
+
 def overlay_files():
     '''run the overlay function'''
 
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR, _overlay_callback)
+    # a run that checks part of the entries can not tell
+    # whether all entries of a directory are in sync
+    synctool.overlay.SKIP_DIRS = (synctool.param.DIR_STATE and
+                                  not synctool.checkpoint.active())
+
+    try:
+        _overlay_files()
+    finally:
+        synctool.overlay.SKIP_DIRS = False
+
+
+def _overlay_files():
+    '''walk the overlay tree'''
+
+    global CURSOR
+
+    if synctool.checkpoint.active():
+        if synctool.param.PRIORITY_PATHS:
+            synctool.overlay.visit(synctool.param.OVERLAY_DIR,
+                                   _priority_callback)
+
+        # the budget is for the regular entries only
+        synctool.checkpoint.start_clock()
+        CURSOR = synctool.checkpoint.Cursor()
+
+    synctool.prefetch.start(OPT_JOBS)
+    if synctool.prefetch.active():
+        synctool.overlay.LOOKAHEAD = _lookahead
+
+    try:
+        synctool.overlay.visit(synctool.param.OVERLAY_DIR, _overlay_callback)
+    finally:
+        CURSOR = None
+        synctool.overlay.LOOKAHEAD = None
+        synctool.prefetch.stop()
 
 
 def _delete_callback(obj, post_dict, dir_changed, *args):
@@ -429,37 +573,103 @@ def delete_files():
     synctool.overlay.visit(synctool.param.DELETE_DIR, _delete_callback)
 
 
-def _erase_saved_callback(obj, post_dict, dir_changed, *args):
-    '''erase *.saved backup files'''
+def _find_saved_callback(obj, post_dict, dir_changed, *args):
+    '''add *.saved backup files to the index'''
 
     if obj.ov_type == synctool.overlay.OV_TEMPLATE:
-        return generate_template(obj, post_dict), False
+        # do not generate it
+        obj.ov_type = synctool.overlay.OV_IGNORE
 
     if obj.src_stat.is_dir():
-        # run .post script on changed directory
-        if dir_changed and obj.dest_path in post_dict:
-            _run_post(obj, post_dict[obj.dest_path])
+        return True, False
 
-        return True, dir_changed
+    index = args[0]
+    saved = obj.dest_path + '.saved'
+    if not saved in index:
+        statbuf = synctool.syncstat.SyncStat(saved)
+        if statbuf.exists():
+            index[saved] = (int(statbuf.mtime), obj.dest_path)
+
+    return True, False
 
-    obj.dest_path += '.saved'
-    obj.dest_stat = synctool.syncstat.SyncStat(obj.dest_path)
 
-    # .saved directories will be removed, but only when they are empty
+def _saved_post_callback(obj, post_dict, dir_changed, *args):
+    '''run .post script of directories in which backups were erased'''
 
-    if obj.dest_stat.exists():
-        vnode = obj.vnode_dest_obj()
-        vnode.harddelete()
-        return True, True
+    if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+        obj.ov_type = synctool.overlay.OV_IGNORE
+        return True, False
+
+    changed_dirs = args[0]
+    if (obj.dest_path in changed_dirs and obj.dest_path in post_dict and
+            obj.src_stat.is_dir()):
+        _run_post(obj, post_dict[obj.dest_path])
 
     return True, False
 
 
+def _select_single_saved(index):
+    '''Returns the part of the index that has backups of SINGLE_FILES
+    The user may also give the name of the backup itself'''
+
+    wanted = set()
+    selected = {}
+    for backup, (made, path) in index.items():
+        if (path in wanted or _match_single(path) or
+                _match_single(backup)):
+            wanted.add(path)
+            selected[backup] = (made, path)
+
+    return selected
+
+
 def erase_saved():
     '''List and delete *.saved backup files'''
 
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR, _erase_saved_callback)
-    synctool.overlay.visit(synctool.param.DELETE_DIR, _erase_saved_callback)
+    complete, index = synctool.saved.load()
+    if not complete:
+        # look for backups made before there was an index
+        if len(SINGLE_FILES) > 0:
+            for d in (synctool.param.OVERLAY_DIR, synctool.param.DELETE_DIR):
+                synctool.overlay.visit_paths(d, SINGLE_FILES,
+                                             _find_saved_callback, index)
+        else:
+            verbose('looking for backup files in the overlay tree')
+            for d in (synctool.param.OVERLAY_DIR, synctool.param.DELETE_DIR):
+                synctool.overlay.visit(d, _find_saved_callback, index)
+            complete = True
+
+    if len(SINGLE_FILES) > 0:
+        selected = _select_single_saved(index)
+        for filename in SINGLE_FILES:
+            verbose('no backup files of %s' % filename)
+    else:
+        selected = index
+
+    changed_dirs = set()
+    for backup in synctool.saved.expired(selected, OPT_KEEP_SAVED,
+                                         OPT_SAVED_OLDER_THAN * 24 * 3600):
+        obj = synctool.object.SyncObject(backup, backup)
+        if obj.dest_stat.exists():
+            # .saved directories will be removed, but only when they are empty
+            vnode = obj.vnode_dest_obj()
+            vnode.harddelete()
+
+            path = index[backup][1]
+            if backup == path + '.saved':
+                changed_dirs.add(os.path.dirname(path))
+
+        if not synctool.lib.DRY_RUN and not os.path.lexists(backup):
+            del index[backup]
+
+    synctool.saved.save(index, complete)
+
+    if changed_dirs:
+        # run .post scripts on changed directories
+        changed_dirs = PathSet(changed_dirs)
+        for d in (synctool.param.OVERLAY_DIR, synctool.param.DELETE_DIR):
+            synctool.overlay.visit_paths(d, changed_dirs,
+                                         _saved_post_callback, changed_dirs)
 
 
 def visit_purge_single(callback):
@@ -471,7 +681,7 @@ def visit_purge_single(callback):
     purge_groups = os.listdir(synctool.param.PURGE_DIR)
 
     # use a copy of SINGLE_FILES, because the callback will remove items
-    for dest in SINGLE_FILES[:]:
+    for dest in list(SINGLE_FILES):
         filepath = dest
         if filepath[0] == os.sep:
             filepath = filepath[1:]
@@ -495,16 +705,7 @@ def visit_purge_single(callback):
 def _match_single(path):
     '''Returns True if (terse) path is in SINGLE_FILES, else False'''
 
-    if path in SINGLE_FILES:
-        SINGLE_FILES.remove(path)
-        return True
-
-    idx = synctool.lib.terse_match_many(path, SINGLE_FILES)
-    if idx >= 0:
-        del SINGLE_FILES[idx]
-        return True
-
-    return False
+    return SINGLE_FILES.take(path)
 
 
 def _single_overlay_callback(obj, post_dict, updated, *args):
@@ -605,8 +806,8 @@ def single_files():
     '''check/update a list of single files'''
 
     changed_dict = {}
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR,
-                           _single_overlay_callback, changed_dict)
+    synctool.overlay.visit_paths(synctool.param.OVERLAY_DIR, SINGLE_FILES,
+                                 _single_overlay_callback, changed_dict)
 
     # For files that were not found, look in the purge/ tree
     # Any overlay-ed files have already been removed from SINGLE_FILES
@@ -622,75 +823,8 @@ def single_files():
         # there are still single files left
         # maybe they are in the delete tree?
         changed_dict = {}
-        synctool.overlay.visit(synctool.param.DELETE_DIR,
-                               _single_delete_callback, changed_dict)
-
-        # run any .post scripts on updated directories
-        # (it's really correct to do this twice; once overlay/, once delete/)
-        for path in changed_dict:
-            obj, post_script = changed_dict[path]
-            _run_post(obj, post_script)
-
-    for filename in SINGLE_FILES:
-        stderr('%s is not in the overlay tree' % filename)
-
-
-def _single_erase_saved_callback(obj, post_dict, updated, *args):
-    '''do 'erase saved' function for single files'''
-
-    if obj.ov_type == synctool.overlay.OV_TEMPLATE:
-        return generate_template(obj, post_dict), False
-
-    go_on = True
-
-    if _match_single(obj.dest_path):
-        is_dest = True
-    else:
-        is_dest = False
-
-    # maybe the user supplied a '.saved' filename
-    filename = obj.dest_path + '.saved'
-    if filename in SINGLE_FILES:
-        SINGLE_FILES.remove(filename)
-        is_saved = True
-    else:
-        is_saved = False
-
-    if is_dest or is_saved:
-        _, updated = _erase_saved_callback(obj, post_dict, False, *args)
-        if updated:
-            # register .post on the parent dir, if it has a .post script
-            obj.dest_path = os.path.dirname(obj.dest_path)
-            obj.dest_stat = synctool.syncstat.SyncStat(obj.dest_path)
-
-            if obj.dest_path in post_dict:
-                changed_dict = args[0]
-                changed_dict[obj.dest_path] = (obj, post_dict[obj.dest_path])
-
-        if not SINGLE_FILES:
-            return False, updated
-
-    return go_on, updated
-
-
-def single_erase_saved():
-    '''erase single backup files'''
-
-    changed_dict = {}
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR,
-                           _single_erase_saved_callback, changed_dict)
-
-    # run any .post scripts on updated directories
-    for path in changed_dict:
-        obj, post_script = changed_dict[path]
-        _run_post(obj, post_script)
-
-    if len(SINGLE_FILES) > 0:
-        # there are still single files left
-        # maybe they are in the delete tree?
-        changed_dict = {}
-        synctool.overlay.visit(synctool.param.DELETE_DIR,
-                               _single_erase_saved_callback, changed_dict)
+        synctool.overlay.visit_paths(synctool.param.DELETE_DIR, SINGLE_FILES,
+                                     _single_delete_callback, changed_dict)
 
         # run any .post scripts on updated directories
         # (it's really correct to do this twice; once overlay/, once delete/)
@@ -727,7 +861,8 @@ def _reference_callback(obj, post_dict, dir_changed, *args):
 def reference_files():
     '''show which source file in the repository synctool uses'''
 
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR, _reference_callback)
+    synctool.overlay.visit_paths(synctool.param.OVERLAY_DIR, SINGLE_FILES,
+                                 _reference_callback)
 
     # look in the purge/ tree, too
     visit_purge_single(_reference_callback)
@@ -767,7 +902,8 @@ def _diff_callback(obj, post_dict, dir_changed, *args):
 def diff_files():
     '''display a diff of the single files'''
 
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR, _diff_callback)
+    synctool.overlay.visit_paths(synctool.param.OVERLAY_DIR, SINGLE_FILES,
+                                 _diff_callback)
 
     # look in the purge/ tree, too
     visit_purge_single(_diff_callback)
@@ -846,9 +982,21 @@ def usage():
     print '''  -d, --diff=FILE       Show diff for file
   -1, --single=PATH     Update a single file
   -r, --ref=PATH        Show which source file synctool chooses
+      --files-from=FILE Read paths for --single, --diff, --ref
+                        or --erase-saved from FILE ('-' is stdin)
   -e, --erase-saved     Erase *.saved backup files
+      --keep-saved=NUM  Keep the newest NUM backups of each file
+      --saved-older-than=DAYS
+                        Only erase backups older than DAYS days
   -f, --fix             Perform updates (otherwise, do dry-run)
       --no-post         Do not run any .post scripts
+  -j, --jobs=NUM        Number of threads for comparing files
+      --time-budget=SECS
+                        Stop checking after SECS seconds; the next
+                        run continues where this one stopped
+      --plan            Save the changes found by this dry run
+      --apply-plan      Apply the changes saved by --plan without
+                        checking again what did not change since
   -F, --fullpath        Show full paths instead of shortened ones
   -T, --terse           Show terse, shortened paths
       --color           Use colored output (only for terse mode)
@@ -865,17 +1013,21 @@ Note that synctool does a dry run unless you specify --fix
 def get_options():
     '''parse command-line options'''
 
-    global SINGLE_FILES
+    global SINGLE_FILES, OPT_MANIFEST, OPT_TREE_HASH, OPT_JOBS
+    global OPT_TIME_BUDGET
+    global OPT_PLAN, OPT_APPLY_PLAN, OPT_KEEP_SAVED, OPT_SAVED_OLDER_THAN
 
     # check for dangerous common typo's on the command-line
     be_careful_with_getopt()
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'hc:d:1:r:efFTvq',
-            ['help', 'conf=', 'diff=', 'single=', 'ref=',
-            'erase-saved', 'fix', 'no-post', 'fullpath',
-            'terse', 'color', 'no-color', 'masterlog', 'nodename=',
-            'verbose', 'quiet', 'unix', 'version'])
+        opts, args = getopt.getopt(sys.argv[1:], 'hc:d:1:r:efj:FTvq',
+            ['help', 'conf=', 'diff=', 'single=', 'ref=', 'files-from=',
+            'erase-saved', 'keep-saved=', 'saved-older-than=', 'fix',
+            'no-post', 'jobs=', 'time-budget=',
+            'plan', 'apply-plan', 'fullpath', 'terse', 'color', 'no-color',
+            'masterlog', 'nodename=', 'manifest', 'tree-hash', 'verbose',
+            'quiet', 'unix', 'version'])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
         usage()
@@ -929,13 +1081,14 @@ def get_options():
     errors = 0
 
     action = ACTION_DEFAULT
-    SINGLE_FILES = []
+    SINGLE_FILES = PathSet()
 
     # these are only used for checking the validity of option combinations
     opt_diff = False
     opt_single = False
     opt_reference = False
     opt_erase_saved = False
+    opt_retention = False
     opt_upload = False
     opt_suffix = False
     opt_fix = False
@@ -955,6 +1108,40 @@ def get_options():
             synctool.lib.NO_POST = True
             continue
 
+        if opt in ('-j', '--jobs'):
+            try:
+                OPT_JOBS = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if OPT_JOBS < 1:
+                print 'invalid value for jobs'
+                sys.exit(1)
+
+            continue
+
+        if opt == '--time-budget':
+            try:
+                OPT_TIME_BUDGET = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if OPT_TIME_BUDGET < 1:
+                print 'invalid value for time budget'
+                sys.exit(1)
+
+            continue
+
+        if opt == '--plan':
+            OPT_PLAN = True
+            continue
+
+        if opt == '--apply-plan':
+            OPT_APPLY_PLAN = True
+            continue
+
         if opt == '--color':
             synctool.param.COLORIZE = True
             continue
@@ -985,6 +1172,16 @@ def get_options():
             synctool.param.NODENAME = arg
             continue
 
+        if opt == '--manifest':
+            # used by the master; it has made a manifest for us
+            OPT_MANIFEST = True
+            continue
+
+        if opt == '--tree-hash':
+            # used by the master; our repository matches its tree hash
+            OPT_TREE_HASH = True
+            continue
+
         if opt in ('-d', '--diff'):
             opt_diff = True
             action = ACTION_DIFF
@@ -997,8 +1194,7 @@ def get_options():
                 stderr('please supply a full destination path')
                 sys.exit(1)
 
-            if not filename in SINGLE_FILES:
-                SINGLE_FILES.append(filename)
+            SINGLE_FILES.add(filename)
             continue
 
         if opt in ('-1', '--single'):
@@ -1012,8 +1208,7 @@ def get_options():
                 stderr('please supply a full destination path')
                 sys.exit(1)
 
-            if not filename in SINGLE_FILES:
-                SINGLE_FILES.append(filename)
+            SINGLE_FILES.add(filename)
             continue
 
         if opt in ('-r', '--ref', '--reference'):
@@ -1028,8 +1223,25 @@ def get_options():
                 stderr('please supply a full destination path')
                 sys.exit(1)
 
-            if not filename in SINGLE_FILES:
-                SINGLE_FILES.append(filename)
+            SINGLE_FILES.add(filename)
+            continue
+
+        if opt == '--files-from':
+            # without other action, these are updated like --single
+            try:
+                paths = synctool.pathset.read_paths(arg)
+            except IOError as err:
+                stderr('error: failed to read %s: %s' % (arg, err.strerror))
+                sys.exit(1)
+
+            for path in paths:
+                filename = synctool.lib.strip_path(path)
+                if not filename or filename[0] != '/':
+                    stderr("%s: please supply full destination paths, "
+                           "not '%s'" % (arg, path))
+                    sys.exit(1)
+
+                SINGLE_FILES.add(filename)
             continue
 
         if opt in ('-e', '--erase-saved'):
@@ -1037,6 +1249,24 @@ def get_options():
             action = ACTION_ERASE_SAVED
             continue
 
+        if opt in ('--keep-saved', '--saved-older-than'):
+            try:
+                value = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if value < 0:
+                print 'invalid value for %s' % opt
+                sys.exit(1)
+
+            opt_retention = True
+            if opt == '--keep-saved':
+                OPT_KEEP_SAVED = value
+            else:
+                OPT_SAVED_OLDER_THAN = value
+            continue
+
         stderr("unknown command line option '%s'" % opt)
         errors += 1
 
@@ -1046,6 +1276,31 @@ def get_options():
 
     option_combinations(opt_diff, opt_single, opt_reference, opt_erase_saved,
                         opt_upload, opt_suffix, opt_fix)
+
+    if OPT_TIME_BUDGET is not None and (action != ACTION_DEFAULT or
+                                        len(SINGLE_FILES) > 0):
+        stderr('option --time-budget can only be used for a full run')
+        sys.exit(1)
+
+    if opt_retention and not opt_erase_saved:
+        stderr('options --keep-saved and --saved-older-than can only be '
+               'used with --erase-saved')
+        sys.exit(1)
+
+    if OPT_PLAN or OPT_APPLY_PLAN:
+        if action != ACTION_DEFAULT or len(SINGLE_FILES) > 0:
+            stderr('options --plan and --apply-plan can only be used '
+                   'for a full run')
+            sys.exit(1)
+
+        if OPT_PLAN and opt_fix:
+            stderr('option --plan can only be used for a dry run')
+            sys.exit(1)
+
+        if OPT_APPLY_PLAN and not opt_fix:
+            stderr('option --apply-plan requires --fix')
+            sys.exit(1)
+
     return action
 
 
@@ -1115,6 +1370,9 @@ def main():
         verbose('my hostname: %s' % synctool.param.HOSTNAME)
         verbose('rootdir: %s' % synctool.param.ROOTDIR)
 
+    if OPT_MANIFEST:
+        synctool.manifest.load()
+
     os.environ['SYNCTOOL_NODE'] = synctool.param.NODENAME
     os.environ['SYNCTOOL_ROOT'] = synctool.param.ROOTDIR
 
@@ -1122,6 +1380,8 @@ def main():
     unix_out('')
     os.umask(077)
 
+    synctool.iobudget.start()
+
     if action == ACTION_DIFF:
         diff_files()
 
@@ -1129,19 +1389,64 @@ def main():
         reference_files()
 
     elif action == ACTION_ERASE_SAVED:
-        if len(SINGLE_FILES) > 0:
-            single_erase_saved()
-        else:
-            erase_saved()
+        erase_saved()
 
     elif len(SINGLE_FILES) > 0:
         single_files()
 
     else:
+        if synctool.param.DIR_STATE:
+            synctool.drift.start()
+            _start_dirstate()
+
+        if OPT_TIME_BUDGET is not None:
+            synctool.checkpoint.start(OPT_TIME_BUDGET)
+            # .post scripts that the previous run did not get to
+            for run_dir, cmd in synctool.checkpoint.PENDING:
+                synctool.postqueue.add(cmd, run_dir)
+
+        if OPT_PLAN:
+            synctool.plan.RECORDING = True
+        elif OPT_APPLY_PLAN:
+            synctool.plan.load()
+
         purge_files()
         overlay_files()
         delete_files()
 
+        if OPT_PLAN:
+            synctool.plan.save()
+        elif not synctool.checkpoint.partial():
+            # a run that stopped early leaves the plan for the next run
+            synctool.plan.finish()
+
+        if synctool.param.TEMPLATE_CACHE:
+            synctool.tmplcache.cleanup()
+
+        # the state is only valid when the installed files are on disk
+        synctool.install.flush()
+
+        # the dirty paths of synctool-watch are only accounted for
+        # when all entries were checked
+        if (synctool.param.DIR_STATE and synctool.dirstate.save() and
+                not synctool.checkpoint.partial()):
+            synctool.drift.finish()
+
+    synctool.install.flush()
+
+    # .post scripts run with normal priority
+    synctool.iobudget.stop()
+
+    if not synctool.lib.NO_POST:
+        synctool.checkpoint.save(synctool.postqueue.pending())
+
+    # run the .post scripts of any updates
+    synctool.postqueue.run()
+
+    synctool.checkpoint.save([])
+
+    synctool.digest.save()
+
     unix_out('# EOB')
 
 # EOB
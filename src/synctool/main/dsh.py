@@ -17,11 +17,13 @@ import shlex
 
 import synctool.aggr
 import synctool.config
+import synctool.executor
 import synctool.lib
 from synctool.lib import verbose, unix_out
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
 import synctool.param
+import synctool.rollout
 import synctool.unbuffered
 
 # hardcoded name because otherwise we get "dsh.py"
@@ -75,11 +77,13 @@ def run_dsh(address_list, remote_cmd_arr):
 
     REMOTE_CMD_ARR = remote_cmd_arr
 
-    synctool.lib.multiprocess(worker_ssh, address_list)
+    synctool.executor.run(worker_ssh, address_list,
+                          NODESET.get_nodename_from_address)
 
 
 def worker_ssh(addr):
-    '''worker process: sync script and run ssh+command to the node'''
+    '''sync script and run ssh+command to the node
+    Yields the commands to run'''
 
     # Note that this func even runs ssh to the local node if
     # the master is also managed by synctool
@@ -101,7 +105,7 @@ def worker_ssh(addr):
         cmd_arr.append('--')
         cmd_arr.append('%s' % REMOTE_CMD_ARR[0])
         cmd_arr.append('%s:%s' % (addr, REMOTE_CMD_ARR[0]))
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+        yield synctool.executor.Command(cmd_arr, nodename)
 
     cmd_str = ' '.join(REMOTE_CMD_ARR)
 
@@ -118,7 +122,7 @@ def worker_ssh(addr):
     unix_out(' '.join(ssh_cmd_arr))
 
     # execute ssh+remote command and show output with the nodename
-    synctool.lib.run_with_nodename(ssh_cmd_arr, nodename)
+    yield synctool.executor.Command(ssh_cmd_arr, nodename)
 
 
 def check_cmd_config():
@@ -158,6 +162,13 @@ def usage():
   -o, --options=SSH_OPTIONS   Set additional options for ssh
   -N, --numproc=NUM           Set number of concurrent procs
   -z, --zzz=NUM               Sleep NUM seconds between each run
+      --wave=LIST             Do these nodes and groups first; may be
+                              given more than once for more waves
+      --wave-success=PERCENT  Start the next wave when PERCENT of the
+                              nodes of a wave succeeded; stop if fewer
+      --max-per-group=GROUPS:NUM
+                              Do at most NUM nodes of each group at once
+      --start-rate=NUM        Start at most NUM nodes per second
       --no-nodename           Do not prepend nodename to output
       --unix                  Output actions as unix shell commands
   -v, --verbose               Be verbose
@@ -180,7 +191,8 @@ def get_options():
         opts, args = getopt.getopt(sys.argv[1:], 'hc:vn:g:x:X:ao:qN:z:',
             ['help', 'conf=', 'verbose', 'node=', 'group=', 'exclude=',
             'exclude-group=', 'aggregate', 'options=', 'no-nodename',
-            'unix', 'skip-rsync', 'quiet', 'numproc=', 'zzz='])
+            'unix', 'skip-rsync', 'quiet', 'numproc=', 'zzz=', 'wave=',
+            'max-per-group=', 'start-rate=', 'wave-success='])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
@@ -258,6 +270,8 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides adaptive_num_proc
+            synctool.param.ADAPTIVE_NUM_PROC = False
             continue
 
         if opt in ('-z', '--zzz'):
@@ -275,11 +289,34 @@ def get_options():
             if not synctool.param.SLEEP_TIME:
                 # (temporarily) set to -1 to indicate we want
                 # to run serialized
-                # synctool.lib.multiprocess() will use this
+                # synctool.executor.run() will use this
                 synctool.param.SLEEP_TIME = -1
 
             continue
 
+        if opt == '--wave':
+            synctool.rollout.add_wave(arg)
+            continue
+
+        if opt == '--max-per-group':
+            if not synctool.rollout.add_group_limit(arg):
+                print ('%s: invalid value for max-per-group; '
+                       'expected GROUPS:NUM' % PROGNAME)
+                sys.exit(1)
+            continue
+
+        if opt == '--start-rate':
+            if not synctool.rollout.set_start_rate(arg):
+                print '%s: invalid value for start rate' % PROGNAME
+                sys.exit(1)
+            continue
+
+        if opt == '--wave-success':
+            if not synctool.rollout.set_wave_success(arg):
+                print '%s: invalid value for wave success' % PROGNAME
+                sys.exit(1)
+            continue
+
         if opt in ('-a', '--aggregate'):
             OPT_AGGREGATE = True
             continue
@@ -342,6 +379,12 @@ def main():
         print 'no valid nodes specified'
         sys.exit(1)
 
+    if not synctool.rollout.check():
+        sys.exit(1)
+
     run_dsh(address_list, cmd_args)
 
+    if synctool.rollout.STOPPED:
+        sys.exit(1)
+
 # EOB
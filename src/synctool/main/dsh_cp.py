@@ -16,7 +16,9 @@ import getopt
 import shlex
 
 import synctool.aggr
+import synctool.bandwidth
 import synctool.config
+import synctool.executor
 import synctool.lib
 from synctool.lib import stdout, stderr, unix_out
 from synctool.main.wrapper import catch_signals
@@ -91,11 +93,24 @@ def run_remote_copy(address_list, files):
 
     FILES_STR = ' '.join(sourcelist)    # only used for printing
 
-    synctool.lib.multiprocess(worker_dsh_cp, address_list)
+    # count the copies, for sharing the bandwidth
+    num_copies = 0
+    if not synctool.lib.DRY_RUN:
+        for addr in address_list:
+            nodename = NODESET.get_nodename_from_address(addr)
+            if nodename != synctool.param.NODENAME:
+                num_copies += 1
+
+    synctool.bandwidth.setup(num_copies)
+
+    synctool.executor.run(worker_dsh_cp, address_list)
+
+    synctool.bandwidth.report()
 
 
 def worker_dsh_cp(addr):
-    '''do remote copy to node'''
+    '''do remote copy to node
+    Yields the commands to run'''
 
     nodename = NODESET.get_nodename_from_address(addr)
     if nodename == synctool.param.NODENAME:
@@ -119,7 +134,8 @@ def worker_dsh_cp(addr):
     unix_out(' '.join(dsh_cp_cmd_arr))
 
     if not synctool.lib.DRY_RUN:
-        synctool.lib.run_with_nodename(dsh_cp_cmd_arr, nodename)
+        yield synctool.bandwidth.rsync_command(dsh_cp_cmd_arr, nodename)
+        synctool.bandwidth.done(nodename)
 
 
 def check_cmd_config():
@@ -148,6 +164,8 @@ def usage():
       --no-nodename           Do not prepend nodename to output
   -N, --numproc=NUM           Set number of concurrent procs
   -z, --zzz=NUM               Sleep NUM seconds between each run
+      --bandwidth=MBPS        Let all copies together use at most
+                              MBPS megabytes per second
       --unix                  Output actions as unix shell commands
   -v, --verbose               Be verbose
   -a, --aggregate             Condense output; list nodes per change
@@ -173,7 +191,7 @@ def get_options():
         opts, args = getopt.getopt(sys.argv[1:], 'hc:n:g:x:X:o:pN:z:vqaf',
             ['help', 'conf=', 'node=', 'group=', 'exclude=', 'exclude-group=',
              'options=', 'purge', 'no-nodename', 'numproc=', 'zzz=',
-             'unix', 'verbose', 'quiet', 'aggregate', 'fix'])
+             'bandwidth=', 'unix', 'verbose', 'quiet', 'aggregate', 'fix'])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
 #        usage()
@@ -260,6 +278,8 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides adaptive_num_proc
+            synctool.param.ADAPTIVE_NUM_PROC = False
             continue
 
         if opt in ('-z', '--zzz'):
@@ -277,11 +297,25 @@ def get_options():
             if not synctool.param.SLEEP_TIME:
                 # (temporarily) set to -1 to indicate we want
                 # to run serialized
-                # synctool.lib.multiprocess() will use this
+                # synctool.executor.run() will use this
                 synctool.param.SLEEP_TIME = -1
 
             continue
 
+        if opt == '--bandwidth':
+            try:
+                synctool.param.RSYNC_BANDWIDTH = float(arg)
+            except ValueError:
+                print ("%s: option '%s' requires a numeric value" %
+                       (PROGNAME, opt))
+                sys.exit(1)
+
+            if synctool.param.RSYNC_BANDWIDTH < 0:
+                print '%s: invalid value for bandwidth' % PROGNAME
+                sys.exit(1)
+
+            continue
+
         if opt == '--unix':
             synctool.lib.UNIX_CMD = True
             continue
@@ -11,14 +11,14 @@
 '''ping the synctool nodes'''
 
 import sys
-import subprocess
 import getopt
 import shlex
 
 import synctool.aggr
 import synctool.config
+import synctool.executor
 import synctool.lib
-from synctool.lib import verbose, stderr, unix_out
+from synctool.lib import verbose, unix_out
 from synctool.main.wrapper import catch_signals
 import synctool.nodeset
 import synctool.param
@@ -43,7 +43,7 @@ def ping_nodes(address_list):
 
     MAX_DISPLAY_LEN = _max_nodename_len(address_list)
 
-    synctool.lib.multiprocess(ping_node, address_list)
+    synctool.executor.run(ping_node, address_list)
 
 
 def _max_nodename_len(address_list):
@@ -59,7 +59,8 @@ def _max_nodename_len(address_list):
 
 
 def ping_node(addr):
-    '''ping a single node'''
+    '''ping a single node
+    Yields the command to run'''
 
     node = NODESET.get_nodename_from_address(addr)
     verbose('pinging %s' % node)
@@ -67,48 +68,43 @@ def ping_node(addr):
 
     packets_received = 0
 
-    # execute ping command and show output with the nodename
+    # execute ping command and collect its output
     cmd = '%s %s' % (synctool.param.PING_CMD, addr)
     cmd_arr = shlex.split(cmd)
 
-    try:
-        f = subprocess.Popen(cmd_arr, shell=False, bufsize=4096,
-                stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
-    except OSError as err:
-        stderr('failed to run command %s: %s' % (cmd_arr[0], err.strerror))
-        return False
-
-    with f:
-        for line in f:
-            line = line.strip()
-
-            # argh, we have to parse output here
-            #
-            # on BSD, ping says something like:
-            # "2 packets transmitted, 0 packets received, 100.0% packet loss"
-            #
-            # on Linux, ping says something like:
-            # "2 packets transmitted, 0 received, 100.0% packet loss, " \
-            # "time 1001ms"
-
-            arr = line.split()
-            if len(arr) > 3 and (arr[1] == 'packets' and
-                                 arr[2] == 'transmitted,'):
-                try:
-                    packets_received = int(arr[3])
-                except ValueError:
-                    pass
-
-                break
-
-            # some ping implementations say "hostname is alive"
-            # or "hostname is unreachable"
-            elif len(arr) == 3 and arr[1] == 'is':
-                if arr[2] == 'alive':
-                    packets_received = 100
-
-                elif arr[2] == 'unreachable':
-                    packets_received = -1
+    lines = []
+    yield synctool.executor.Command(cmd_arr, node, lines.append)
+
+    for line in lines:
+        line = line.strip()
+
+        # argh, we have to parse output here
+        #
+        # on BSD, ping says something like:
+        # "2 packets transmitted, 0 packets received, 100.0% packet loss"
+        #
+        # on Linux, ping says something like:
+        # "2 packets transmitted, 0 received, 100.0% packet loss, " \
+        # "time 1001ms"
+
+        arr = line.split()
+        if len(arr) > 3 and (arr[1] == 'packets' and
+                             arr[2] == 'transmitted,'):
+            try:
+                packets_received = int(arr[3])
+            except ValueError:
+                pass
+
+            break
+
+        # some ping implementations say "hostname is alive"
+        # or "hostname is unreachable"
+        elif len(arr) == 3 and arr[1] == 'is':
+            if arr[2] == 'alive':
+                packets_received = 100
+
+            elif arr[2] == 'unreachable':
+                packets_received = -1
 
     if packets_received > 0:
         print '%-*s  up' % (MAX_DISPLAY_LEN, node)
@@ -247,6 +243,8 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides adaptive_num_proc
+            synctool.param.ADAPTIVE_NUM_PROC = False
             continue
 
         if opt in ('-z', '--zzz'):
@@ -264,7 +262,7 @@ def get_options():
             if not synctool.param.SLEEP_TIME:
                 # (temporarily) set to -1 to indicate we want
                 # to run serialized
-                # synctool.lib.multiprocess() will use this
+                # synctool.executor.run() will use this
                 synctool.param.SLEEP_TIME = -1
 
             continue
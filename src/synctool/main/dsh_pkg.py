@@ -17,6 +17,7 @@ import shlex
 
 import synctool.aggr
 import synctool.config
+import synctool.executor
 import synctool.lib
 from synctool.lib import verbose, stderr, unix_out
 from synctool.main.wrapper import catch_signals
@@ -38,11 +39,12 @@ MASTER_OPTS = None
 def run_remote_pkg(address_list):
     '''run synctool-pkg on the target nodes'''
 
-    synctool.lib.multiprocess(worker_pkg, address_list)
+    synctool.executor.run(worker_pkg, address_list)
 
 
 def worker_pkg(addr):
-    '''runs ssh + synctool-pkg to the nodes in parallel'''
+    '''runs ssh + synctool-pkg to the nodes in parallel
+    Yields the commands to run'''
 
     nodename = NODESET.get_nodename_from_address(addr)
 
@@ -56,7 +58,7 @@ def worker_pkg(addr):
     verbose('running synctool-pkg on node %s' % nodename)
     unix_out(' '.join(cmd_arr))
 
-    synctool.lib.run_with_nodename(cmd_arr, nodename)
+    yield synctool.executor.Command(cmd_arr, nodename)
 
 
 def rearrange_options():
@@ -322,6 +324,8 @@ def get_options():
                 print '%s: invalid value for numproc' % PROGNAME
                 sys.exit(1)
 
+            # a fixed number overrides adaptive_num_proc
+            synctool.param.ADAPTIVE_NUM_PROC = False
             continue
 
         if opt in ('-z', '--zzz'):
@@ -339,7 +343,7 @@ def get_options():
             if not synctool.param.SLEEP_TIME:
                 # (temporarily) set to -1 to indicate we want
                 # to run serialized
-                # synctool.lib.multiprocess() will use this
+                # synctool.executor.run() will use this
                 synctool.param.SLEEP_TIME = -1
 
             continue
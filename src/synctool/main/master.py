@@ -18,13 +18,19 @@ import shlex
 import tempfile
 
 import synctool.aggr
+import synctool.bandwidth
 import synctool.config
+import synctool.executor
+import synctool.history
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, terse, unix_out, prettypath
 from synctool.main.wrapper import catch_signals
+import synctool.manifest
 import synctool.nodeset
 import synctool.overlay
 import synctool.param
+import synctool.pathset
+import synctool.rollout
 import synctool.syncstat
 import synctool.unbuffered
 import synctool.update
@@ -43,24 +49,63 @@ OPT_DOWNLOAD = False
 PASS_ARGS = None
 MASTER_OPTS = None
 
+# paths given with --files-from, and the temp file that
+# feeds them to the nodes
+FILES_FROM = None
+FILES_FROM_FILE = None
+
+# whether the tree hash was made (see synctool.manifest)
+TREE_HASH = False
+
 UPLOAD_FILE = None
 
 
 def run_remote_synctool(address_list):
     '''run synctool on target nodes'''
 
-    synctool.lib.multiprocess(worker_synctool, address_list)
+    # start the nodes that took longest before first
+    synctool.history.load()
+    address_list = synctool.history.order(address_list,
+                                          NODESET.get_nodename_from_address)
+
+    synctool.bandwidth.setup(_num_rsyncs(address_list))
+
+    synctool.executor.run(worker_synctool, address_list,
+                          NODESET.get_nodename_from_address)
+
+    synctool.history.save()
+    synctool.bandwidth.report()
+
+
+def _num_rsyncs(address_list):
+    '''Returns the number of nodes that get an rsync'''
+
+    if OPT_SKIP_RSYNC:
+        return 0
+
+    num = 0
+    for addr in address_list:
+        nodename = NODESET.get_nodename_from_address(addr)
+        if not (nodename == synctool.param.NODENAME or
+                nodename in synctool.param.NO_RSYNC):
+            num += 1
+
+    return num
 
 
 def worker_synctool(addr):
-    '''run rsync of ROOTDIR to the nodes and ssh+synctool, in parallel'''
+    '''run rsync of ROOTDIR to the nodes and ssh+synctool, in parallel
+    Yields the commands to run'''
 
     nodename = NODESET.get_nodename_from_address(addr)
 
     if nodename == synctool.param.NODENAME:
-        run_local_synctool()
+        yield run_local_synctool()
         return
 
+    # exit code of rsync; there is no tree hash for the node without it
+    returncode = None
+
     # rsync ROOTDIR/dirs/ to the node
     # if "it wants it"
     if not (OPT_SKIP_RSYNC or nodename in synctool.param.NO_RSYNC):
@@ -86,7 +131,10 @@ def worker_synctool(addr):
                    synctool.param.ROOTDIR)
             sys.exit(-1)
 
-        synctool.lib.run_with_nodename(cmd_arr, nodename)
+        returncode = yield synctool.bandwidth.rsync_command(
+                                        cmd_arr, nodename,
+                                        synctool.history.PHASE_RSYNC)
+        synctool.bandwidth.done(nodename)
 
         # delete temp file
         try:
@@ -95,6 +143,15 @@ def worker_synctool(addr):
             # silently ignore unlink error
             pass
 
+    # measure how long ssh takes to connect, apart from the client run
+    cmd_arr = shlex.split(synctool.param.SSH_CMD)
+    cmd_arr.extend(['-n', '-o', 'BatchMode=yes', '--', addr, 'true'])
+    probe = synctool.executor.Command(cmd_arr, nodename,
+                                      phase=synctool.history.PHASE_CONNECT)
+    if (yield probe) == synctool.executor.SSH_FAILED:
+        verbose('failed to connect to node %s' % nodename)
+        return
+
     # run 'ssh node synctool_cmd'
     cmd_arr = shlex.split(synctool.param.SSH_CMD)
     cmd_arr.append('--')
@@ -102,22 +159,79 @@ def worker_synctool(addr):
     cmd_arr.extend(shlex.split(synctool.param.SYNCTOOL_CMD))
     cmd_arr.append('--nodename=%s' % nodename)
     cmd_arr.extend(PASS_ARGS)
+    if TREE_HASH and returncode == 0:
+        # the node has the same repository as the tree hash
+        cmd_arr.append('--tree-hash')
 
     verbose('running synctool on node %s' % nodename)
-    unix_out(' '.join(cmd_arr))
+    _unix_out_cmd(cmd_arr)
 
-    synctool.lib.run_with_nodename(cmd_arr, nodename)
+    yield synctool.executor.Command(cmd_arr, nodename,
+                                    phase=synctool.history.PHASE_CLIENT,
+                                    stdin=FILES_FROM_FILE)
 
 
 def run_local_synctool():
-    '''run synctool on the master node itself'''
+    '''run synctool on the master node itself
+    Returns the command to run'''
 
     cmd_arr = shlex.split(synctool.param.SYNCTOOL_CMD) + PASS_ARGS
+    if TREE_HASH:
+        cmd_arr.append('--tree-hash')
 
     verbose('running synctool on node %s' % synctool.param.NODENAME)
-    unix_out(' '.join(cmd_arr))
+    _unix_out_cmd(cmd_arr)
+
+    return synctool.executor.Command(cmd_arr, synctool.param.NODENAME,
+                                     phase=synctool.history.PHASE_CLIENT,
+                                     stdin=FILES_FROM_FILE)
+
+
+def _unix_out_cmd(cmd_arr):
+    '''unix_out the synctool command, with its input'''
+
+    if FILES_FROM_FILE is not None:
+        unix_out('%s < %s' % (' '.join(cmd_arr), FILES_FROM_FILE))
+    else:
+        unix_out(' '.join(cmd_arr))
+
 
-    synctool.lib.run_with_nodename(cmd_arr, synctool.param.NODENAME)
+def write_files_from():
+    '''write the --files-from paths to a temp file,
+    which is fed to synctool on the nodes on stdin'''
+
+    global FILES_FROM_FILE
+
+    try:
+        (fd, filename) = tempfile.mkstemp(prefix='synctool-files-',
+                                          dir=synctool.param.TEMP_DIR)
+    except OSError as err:
+        stderr('failed to create temp file: %s' % err.strerror)
+        sys.exit(-1)
+
+    try:
+        with os.fdopen(fd, 'w') as f:
+            for path in FILES_FROM:
+                f.write(path + '\n')
+    except (IOError, OSError) as err:
+        stderr('failed to write temp file %s: %s' % (filename,
+                                                     err.strerror))
+        sys.exit(-1)
+
+    FILES_FROM_FILE = filename
+
+
+def remove_files_from():
+    '''delete the temp file of --files-from paths'''
+
+    if FILES_FROM_FILE is None:
+        return
+
+    try:
+        os.unlink(FILES_FROM_FILE)
+    except OSError:
+        # silently ignore unlink error
+        pass
 
 
 def rsync_include_filter(nodename):
@@ -144,6 +258,9 @@ def rsync_include_filter(nodename):
         f.write('# synctool rsync filter')
 
         # set mygroups for this nodename
+        # all nodes are handled by this process, so put them back after
+        saved_nodename = synctool.param.NODENAME
+        saved_groups = synctool.param.MY_GROUPS
         synctool.param.NODENAME = nodename
         synctool.param.MY_GROUPS = synctool.config.get_my_groups()
 
@@ -152,7 +269,8 @@ def rsync_include_filter(nodename):
         if not nodename in synctool.param.SLAVES:
             if not (_write_overlay_filter(f) and
                     _write_delete_filter(f) and
-                    _write_purge_filter(f)):
+                    _write_purge_filter(f) and
+                    _write_manifest_filter(f)):
                 # an error occurred;
                 # delete temp file and exit
                 f.close()
@@ -164,12 +282,20 @@ def rsync_include_filter(nodename):
 
                 sys.exit(-1)
 
+        # the state dir holds client-local state (like the digest cache)
+        # protect it from being deleted by rsync --delete
+        f.write('P /var/state/\n'
+                '- /var/state/\n')
+
         # Note: sbin/*.pyc is excluded to keep major differences in
         # Python versions (on master vs. client node) from clashing
         f.write('- /sbin/*.pyc\n'
                 '- /lib/synctool/*.pyc\n'
                 '- /lib/synctool/pkg/*.pyc\n')
 
+    synctool.param.NODENAME = saved_nodename
+    synctool.param.MY_GROUPS = saved_groups
+
     # Note: remind to delete the temp file later
 
     return filename
@@ -242,6 +368,25 @@ def _write_purge_filter(f):
     return True
 
 
+def _write_manifest_filter(f):
+    '''write rsync filter rules for the manifest
+    Returns False on error'''
+
+    name = synctool.manifest.node_manifest()
+    if not (name or TREE_HASH):
+        f.write('- /var/manifest/\n')
+        return True
+
+    f.write('+ /var/manifest/\n')
+    if name:
+        f.write('+ /var/manifest/groups\n'
+                '+ /var/manifest/%s\n' % name)
+    if TREE_HASH:
+        f.write('+ /var/manifest/%s\n' % synctool.manifest.TREE_HASH_FILE)
+    f.write('- /var/manifest/*\n')
+    return True
+
+
 def make_tempdir():
     '''create temporary directory (for storing rsync filter files)'''
 
@@ -400,13 +545,32 @@ def usage():
   -d, --diff=FILE             Show diff for file
   -1, --single=PATH           Update a single file
   -r, --ref=PATH              Show which source file synctool chooses
+      --files-from=FILE       Read paths for --single, --diff, --ref
+                              or --erase-saved from FILE ('-' is stdin)
   -u, --upload=PATH           Pull a remote file into the overlay tree
   -s, --suffix=GROUP          Give group suffix for the uploaded file
   -o, --overlay=GROUP         Upload file to $overlay/group/
   -p, --purge=GROUP           Upload file or directory to $purge/group/
   -e, --erase-saved           Erase *.saved backup files
+      --keep-saved=NUM        Keep the newest NUM backups of each file
+      --saved-older-than=DAYS Only erase backups older than DAYS days
       --no-post               Do not run any .post scripts
   -N, --numproc=NUM           Number of concurrent procs
+      --wave=LIST             Do these nodes and groups first; may be
+                              given more than once for more waves
+      --wave-success=PERCENT  Start the next wave when PERCENT of the
+                              nodes of a wave succeeded; stop if fewer
+      --max-per-group=GROUPS:NUM
+                              Do at most NUM nodes of each group at once
+      --start-rate=NUM        Start at most NUM nodes per second
+      --bandwidth=MBPS        Let all rsyncs together use at most
+                              MBPS megabytes per second
+  -j, --jobs=NUM              Number of threads for comparing files
+      --time-budget=SECS      Stop checking after SECS seconds; the next
+                              run continues where this one stopped
+      --plan                  Save the changes found by this dry run
+      --apply-plan            Apply the changes saved by --plan without
+                              checking again what did not change since
   -F, --fullpath              Show full paths instead of shortened ones
   -T, --terse                 Show terse, shortened paths
       --color                 Use colored output (only for terse mode)
@@ -431,7 +595,7 @@ def get_options():
 
     global PASS_ARGS, OPT_SKIP_RSYNC, OPT_AGGREGATE
     global OPT_CHECK_UPDATE, OPT_DOWNLOAD, MASTER_OPTS
-    global UPLOAD_FILE
+    global UPLOAD_FILE, FILES_FROM
 
     # check for typo's on the command-line;
     # things like "-diff" will trigger "-f" => "--fix"
@@ -439,12 +603,16 @@ def get_options():
 
     try:
         opts, args = getopt.getopt(sys.argv[1:],
-            'hc:vn:g:x:X:d:1:r:u:s:o:p:efN:FTqaS',
+            'hc:vn:g:x:X:d:1:r:u:s:o:p:efN:j:FTqaS',
             ['help', 'conf=', 'verbose', 'node=', 'group=',
             'exclude=', 'exclude-group=', 'diff=', 'single=', 'ref=',
-            'upload=', 'suffix=', 'overlay=', 'purge=', 'erase-saved', 'fix',
-            'no-post', 'numproc=', 'fullpath', 'terse', 'color', 'no-color',
-            'quiet', 'aggregate', 'unix', 'skip-rsync',
+            'files-from=',
+            'upload=', 'suffix=', 'overlay=', 'purge=', 'erase-saved',
+            'keep-saved=', 'saved-older-than=', 'fix',
+            'no-post', 'numproc=', 'wave=', 'max-per-group=', 'start-rate=',
+            'wave-success=', 'bandwidth=', 'jobs=', 'time-budget=', 'plan',
+            'apply-plan', 'fullpath', 'terse', 'color',
+            'no-color', 'quiet', 'aggregate', 'unix', 'skip-rsync',
             'version', 'check-update', 'download'])
     except getopt.GetoptError as reason:
         print '%s: %s' % (PROGNAME, reason)
@@ -468,6 +636,7 @@ def get_options():
     opt_purge = False
     opt_fix = False
     opt_group = False
+    files_from = []
 
     PASS_ARGS = []
     MASTER_OPTS = [ sys.argv[0] ]
@@ -564,6 +733,23 @@ def get_options():
         if opt in ('-r', '--ref'):
             opt_reference = True
 
+        if opt == '--files-from':
+            try:
+                paths = synctool.pathset.read_paths(arg)
+            except IOError as err:
+                stderr('error: failed to read %s: %s' % (arg, err.strerror))
+                sys.exit(1)
+
+            for path in paths:
+                filename = synctool.lib.strip_path(path)
+                if not filename or filename[0] != '/':
+                    stderr("%s: please supply full destination paths, "
+                           "not '%s'" % (arg, path))
+                    sys.exit(1)
+
+                files_from.append(filename)
+            continue
+
         if opt in ('-u', '--upload'):
             opt_upload = True
             UPLOAD_FILE.filename = arg
@@ -587,6 +773,18 @@ def get_options():
         if opt in ('-e', '--erase-saved'):
             opt_erase_saved = True
 
+        if opt in ('--keep-saved', '--saved-older-than'):
+            # passed on to the client; check it here already
+            try:
+                value = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if value < 0:
+                print 'invalid value for %s' % opt
+                sys.exit(1)
+
         if opt in ('-q', '--quiet'):
             synctool.lib.QUIET = True
 
@@ -608,8 +806,68 @@ def get_options():
                 print 'invalid value for numproc'
                 sys.exit(1)
 
+            # a fixed number overrides adaptive_num_proc
+            synctool.param.ADAPTIVE_NUM_PROC = False
+            continue
+
+        if opt == '--bandwidth':
+            try:
+                synctool.param.RSYNC_BANDWIDTH = float(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if synctool.param.RSYNC_BANDWIDTH < 0:
+                print 'invalid value for bandwidth'
+                sys.exit(1)
+            continue
+
+        if opt == '--wave':
+            synctool.rollout.add_wave(arg)
             continue
 
+        if opt == '--max-per-group':
+            if not synctool.rollout.add_group_limit(arg):
+                print 'invalid value for max-per-group; expected GROUPS:NUM'
+                sys.exit(1)
+            continue
+
+        if opt == '--start-rate':
+            if not synctool.rollout.set_start_rate(arg):
+                print 'invalid value for start rate'
+                sys.exit(1)
+            continue
+
+        if opt == '--wave-success':
+            if not synctool.rollout.set_wave_success(arg):
+                print 'invalid value for wave success'
+                sys.exit(1)
+            continue
+
+        if opt in ('-j', '--jobs'):
+            # passed on to the client; check it here already
+            try:
+                jobs = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if jobs < 1:
+                print 'invalid value for jobs'
+                sys.exit(1)
+
+        if opt == '--time-budget':
+            # passed on to the client; check it here already
+            try:
+                budget = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if budget < 1:
+                print 'invalid value for time budget'
+                sys.exit(1)
+
         if opt in ('-F', '--fullpath'):
             synctool.param.FULL_PATH = True
             synctool.param.TERSE = False
@@ -671,6 +929,15 @@ def get_options():
             print 'option --suffix and --purge can not be combined'
             sys.exit(1)
 
+    if files_from:
+        # the paths may be many; they go to the client on stdin
+        # rather than on the command-line
+        if not (opt_diff or opt_reference or opt_erase_saved):
+            opt_single = True
+
+        FILES_FROM = files_from
+        PASS_ARGS.append('--files-from=-')
+
     # enable logging at the master node
     PASS_ARGS.append('--masterlog')
 
@@ -686,6 +953,8 @@ def get_options():
 def main():
     '''run the program'''
 
+    global TREE_HASH
+
     synctool.param.init()
 
     sys.stdout = synctool.unbuffered.Unbuffered(sys.stdout)
@@ -736,6 +1005,9 @@ def main():
         print 'no valid nodes specified'
         sys.exit(1)
 
+    if not synctool.rollout.check():
+        sys.exit(1)
+
     if UPLOAD_FILE.filename:
         # upload a file
         if len(address_list) != 1:
@@ -765,8 +1037,27 @@ def main():
                 verbose('--fix specified, applying changes')
 
         make_tempdir()
-        run_remote_synctool(address_list)
+        if FILES_FROM:
+            write_files_from()
+
+        # resolve the overlay tree once for every distinct set of groups
+        nodes = [NODESET.get_nodename_from_address(addr)
+                 for addr in address_list]
+        if synctool.manifest.make_manifests(nodes):
+            PASS_ARGS.append('--manifest')
+
+        # let the nodes know which directories did not change
+        if synctool.param.DIR_STATE:
+            TREE_HASH = synctool.manifest.make_tree_hash()
+
+        try:
+            run_remote_synctool(address_list)
+        finally:
+            remove_files_from()
 
     synctool.lib.closelog()
 
+    if synctool.rollout.STOPPED:
+        sys.exit(1)
+
 # EOB
@@ -0,0 +1,386 @@
+#
+#   synctool.main.watch.py  WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''synctool-watch is a daemon that runs on the target node.
+It keeps track of which destination paths change, so that
+synctool-client needs to check only those'''
+
+import os
+import sys
+import time
+import errno
+import getopt
+import select
+import signal
+
+import synctool.config
+import synctool.drift
+import synctool.inotify
+import synctool.lib
+from synctool.lib import verbose, stderr
+from synctool.main.wrapper import catch_signals
+import synctool.overlay
+import synctool.param
+import synctool.syncstat
+
+# hardcoded name because otherwise we get "synctool_watch.py"
+PROGNAME = 'synctool-watch'
+
+# directories are watched for these events
+WATCH_MASK = (synctool.inotify.IN_MODIFY | synctool.inotify.IN_ATTRIB |
+              synctool.inotify.IN_CLOSE_WRITE |
+              synctool.inotify.IN_MOVED_FROM | synctool.inotify.IN_MOVED_TO |
+              synctool.inotify.IN_CREATE | synctool.inotify.IN_DELETE |
+              synctool.inotify.IN_DELETE_SELF |
+              synctool.inotify.IN_MOVE_SELF | synctool.inotify.IN_ONLYDIR)
+
+# these events mean that the watch is gone
+LOST_MASK = (synctool.inotify.IN_DELETE_SELF |
+             synctool.inotify.IN_MOVE_SELF | synctool.inotify.IN_IGNORED)
+
+# re-read the overlay tree every this many seconds
+OPT_INTERVAL = 300
+
+# when a watch was lost, try again after this many seconds
+RETRY_INTERVAL = 10
+
+OPT_DAEMON = False
+
+# set by SIGHUP
+RESCAN = False
+
+
+class Watcher(object):
+    '''watches the directories that hold destination paths'''
+
+    def __init__(self):
+        '''Raises OSError if inotify is not available'''
+
+        self.inotify = synctool.inotify.Inotify()
+        # wd -> directory
+        self.wds = {}
+        # directory -> wd
+        self.dirs = {}
+        self.next_scan = 0
+
+    def fileno(self):
+        '''Returns file descriptor, for use with select()'''
+
+        return self.inotify.fileno()
+
+    def scan(self):
+        '''read the overlay tree and watch its destination directories'''
+
+        # names of users and groups may have changed since the last pass
+        synctool.syncstat.forget_names()
+
+        dest_dirs = _dest_dirs()
+        changed = False
+
+        for path in self.dirs.keys():
+            if not path in dest_dirs:
+                verbose('no longer watching %s' % path)
+                self._unwatch(path)
+                changed = True
+
+        dirty = []
+        for path in dest_dirs:
+            if path in self.dirs:
+                continue
+
+            try:
+                wd = self.inotify.add_watch(path, WATCH_MASK)
+            except OSError as err:
+                # most likely, the directory does not exist (yet)
+                verbose('can not watch %s: %s' % (path, err.strerror))
+                continue
+
+            if wd in self.wds:
+                # same directory as another path; can not tell them apart
+                verbose('%s is the same directory as %s' % (path,
+                                                            self.wds[wd]))
+                continue
+
+            verbose('watching %s' % path)
+            self.wds[wd] = path
+            self.dirs[path] = wd
+            # changes before now were not seen
+            dirty.append(path)
+            changed = True
+
+        if changed:
+            synctool.drift.update(dirty, sorted(self.dirs.keys()))
+
+        self.next_scan = time.time() + OPT_INTERVAL
+
+    def _unwatch(self, path):
+        '''stop watching directory'''
+
+        wd = self.dirs.pop(path)
+        del self.wds[wd]
+        self.inotify.rm_watch(wd)
+
+    def handle_events(self):
+        '''read and handle pending events'''
+
+        dirty = []
+        lost = False
+
+        for wd, mask, name in self.inotify.read():
+            if mask & synctool.inotify.IN_Q_OVERFLOW:
+                stderr('warning: inotify event queue overflow')
+                dirty.append(synctool.drift.ALL)
+                continue
+
+            path = self.wds.get(wd)
+            if path is None:
+                continue
+
+            if name:
+                dirty.append(os.path.join(path, name))
+                continue
+
+            dirty.append(path)
+
+            if mask & LOST_MASK:
+                verbose('lost watch on %s' % path)
+                self._unwatch(path)
+                lost = True
+
+        if lost:
+            synctool.drift.update(dirty, sorted(self.dirs.keys()))
+            self.next_scan = min(self.next_scan,
+                                 time.time() + RETRY_INTERVAL)
+        elif dirty:
+            synctool.drift.update(dirty)
+
+
+def _collect_callback(obj, post_dict, dir_changed, dest_dirs):
+    '''collect directory of the destination path
+    Returns pair: True (continue), False (not updated)'''
+
+    if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+        # do not generate it; its destination is known anyway
+        obj.ov_type = synctool.overlay.OV_IGNORE
+
+    dest_dirs.add(os.path.dirname(obj.dest_path))
+    return True, False
+
+
+def _dest_dirs():
+    '''Returns set of directories that hold destination paths'''
+
+    dest_dirs = set()
+
+    # keep quiet about what is seen in the overlay tree
+    saved_stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        synctool.overlay.visit(synctool.param.OVERLAY_DIR, _collect_callback,
+                               dest_dirs)
+    finally:
+        sys.stdout.close()
+        sys.stdout = saved_stdout
+
+    return dest_dirs
+
+
+def _sighup_handler(signum, frame):
+    '''SIGHUP makes the watcher re-read the overlay tree'''
+
+    global RESCAN
+
+    RESCAN = True
+
+
+def _sigterm_handler(signum, frame):
+    '''terminate the watcher'''
+
+    sys.exit(0)
+
+
+def daemonize():
+    '''detach from the terminal and run in the background'''
+
+    if os.fork() > 0:
+        os._exit(0)
+
+    os.setsid()
+
+    if os.fork() > 0:
+        os._exit(0)
+
+    os.chdir(os.sep)
+
+    fd = os.open(os.devnull, os.O_RDWR)
+    for i in (0, 1, 2):
+        os.dup2(fd, i)
+
+    if fd > 2:
+        os.close(fd)
+
+
+def watch(watcher):
+    '''main loop of the watcher'''
+
+    global RESCAN
+
+    watcher.scan()
+
+    while True:
+        timeout = max(0, watcher.next_scan - time.time())
+        try:
+            ready, _, _ = select.select([watcher], [], [], timeout)
+        except select.error as err:
+            if err.args[0] != errno.EINTR:
+                raise
+
+            ready = []
+
+        if ready:
+            watcher.handle_events()
+
+        if RESCAN or time.time() >= watcher.next_scan:
+            RESCAN = False
+            watcher.scan()
+
+
+def usage():
+    '''print usage information'''
+
+    print 'usage: %s [options]' % PROGNAME
+    print 'options:'
+    print '  -h, --help            Display this information'
+    print '  -c, --conf=FILE       Use this config file'
+    print ('                        (default: %s)' %
+            synctool.param.DEFAULT_CONF)
+    print '''  -d, --daemon          Run in the background
+  -i, --interval=SECS   Re-read the overlay tree every SECS seconds
+                        (default: %d)
+      --nodename=NAME   Use this nodename
+  -v, --verbose         Be verbose
+      --version         Print current version number
+
+synctool-watch keeps track of changes to destination paths, so that
+synctool-client needs to check only the changed paths
+''' % OPT_INTERVAL
+
+
+def get_options():
+    '''parse command-line options'''
+
+    global OPT_INTERVAL, OPT_DAEMON
+
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'hc:di:v',
+            ['help', 'conf=', 'daemon', 'interval=', 'nodename=',
+            'verbose', 'version'])
+    except getopt.GetoptError as reason:
+        print '%s: %s' % (PROGNAME, reason)
+        usage()
+        sys.exit(1)
+
+    if args != None and len(args) > 0:
+        stderr('error: excessive arguments on command line')
+        sys.exit(1)
+
+    for opt, arg in opts:
+        if opt in ('-h', '--help', '-?'):
+            usage()
+            sys.exit(1)
+
+        if opt in ('-c', '--conf'):
+            synctool.param.CONF_FILE = arg
+            continue
+
+        if opt in ('-d', '--daemon'):
+            OPT_DAEMON = True
+            continue
+
+        if opt in ('-i', '--interval'):
+            try:
+                OPT_INTERVAL = int(arg)
+            except ValueError:
+                print "option '%s' requires a numeric value" % opt
+                sys.exit(1)
+
+            if OPT_INTERVAL < 1:
+                print 'invalid value for interval'
+                sys.exit(1)
+
+            continue
+
+        if opt == '--nodename':
+            synctool.param.NODENAME = arg
+            continue
+
+        if opt in ('-v', '--verbose'):
+            synctool.lib.VERBOSE = True
+            continue
+
+        if opt == '--version':
+            print synctool.param.VERSION
+            sys.exit(0)
+
+    synctool.config.read_config()
+
+
+@catch_signals
+def main():
+    '''run the program'''
+
+    synctool.param.init()
+
+    get_options()
+
+    synctool.config.init_mynodename()
+
+    if not synctool.param.NODENAME:
+        stderr('unable to determine my nodename (%s)' %
+               synctool.param.HOSTNAME)
+        stderr('please check %s' % synctool.param.CONF_FILE)
+        sys.exit(-1)
+
+    if not synctool.param.NODENAME in synctool.param.NODES:
+        stderr("unknown node '%s'" % synctool.param.NODENAME)
+        stderr('please check %s' % synctool.param.CONF_FILE)
+        sys.exit(-1)
+
+    if not synctool.param.DIR_STATE:
+        stderr('error: synctool-watch requires dir_state to be enabled')
+        sys.exit(-1)
+
+    try:
+        watcher = Watcher()
+    except OSError as err:
+        stderr('error: inotify: %s' % err.strerror)
+        sys.exit(-1)
+
+    if synctool.drift.watcher_generation() is not None:
+        stderr('error: synctool-watch is already running')
+        sys.exit(-1)
+
+    if OPT_DAEMON:
+        daemonize()
+
+    if synctool.drift.register() is None:
+        stderr('error: synctool-watch is already running')
+        sys.exit(-1)
+
+    signal.signal(signal.SIGHUP, _sighup_handler)
+    signal.signal(signal.SIGTERM, _sigterm_handler)
+
+    try:
+        watch(watcher)
+    finally:
+        synctool.drift.unregister()
+
+
+# EOB
@@ -0,0 +1,409 @@
+#
+#   synctool.manifest.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''a manifest is the precompiled outcome of the overlay resolution
+
+    Resolving the overlay/ and delete/ trees only depends on the
+    repository and on the (ordered) list of groups of a node. The master
+    resolves the trees once for every distinct group signature and
+    ships the result along with the repository. The client then replays
+    the manifest rather than walking the trees itself.
+
+    The group signature is the node's group list, minus the groups that
+    do not occur anywhere in the repository. So nodes that only differ in
+    groups that are not used in the repository share a single manifest.
+
+    The manifest is a text file with one tab-separated line per entry:
+     tree, ov_type, src, dest, post, dir post, template generator
+    Source paths are relative to the synctool var/ dir.
+
+    The master also makes a hash of every directory in the overlay tree,
+    from the names and stat info of its entries. The treehash file holds
+    a tab-separated line per directory: hash, path.
+'''
+
+import os
+import stat
+import hashlib
+
+import synctool.config
+import synctool.lib
+from synctool.lib import verbose, stderr
+import synctool.overlay
+import synctool.param
+
+MANIFEST_MAGIC = '# synctool manifest'
+
+TREE_HASH_FILE = 'treehash'
+TREE_HASH_MAGIC = '# synctool tree hash'
+
+# groups that are used in the repository; set by make_manifests()
+USED_GROUPS = None
+
+
+def used_groups():
+    '''Returns set of groups that occur in the overlay/ and delete/ trees'''
+
+    used = set(['all'])
+
+    for tree in (synctool.param.OVERLAY_DIR, synctool.param.DELETE_DIR):
+        if not os.path.isdir(tree):
+            continue
+
+        # the group dirs
+        used |= set(os.listdir(tree))
+
+        # the group extensions
+        for _, subdirs, files in os.walk(tree):
+            for name in subdirs + files:
+                _, ext = os.path.splitext(name)
+                if ext[:2] == '._':
+                    used.add(ext[2:])
+
+    return used & synctool.param.ALL_GROUPS
+
+
+def signature(groups, used):
+    '''Returns the group signature: only the groups that are in use'''
+
+    return [g for g in groups if g in used]
+
+
+def manifest_name(sig):
+    '''Returns the filename of the manifest for this group signature'''
+
+    return hashlib.md5(' '.join(sig)).hexdigest()
+
+
+def settings():
+    '''Returns string describing config settings that
+    influence the outcome of the overlay resolution'''
+
+    arr = ['%d%d%d' % (synctool.param.REQUIRE_EXTENSION,
+                       synctool.param.IGNORE_DOTFILES,
+                       synctool.param.IGNORE_DOTDIRS)]
+    arr.extend(sorted(synctool.param.IGNORE_FILES))
+    arr.extend(synctool.param.IGNORE_FILES_WITH_WILDCARDS)
+    arr.extend(synctool.param.IGNORE_PATHS)
+    return ' '.join(arr)
+
+
+def _relpath(path):
+    '''Returns path relative to VAR_DIR'''
+
+    if not path:
+        return ''
+
+    return path[synctool.param.VAR_LEN:]
+
+
+def _abspath(path):
+    '''Returns full path for path relative to VAR_DIR'''
+
+    if not path:
+        return None
+
+    return os.path.join(synctool.param.VAR_DIR, path)
+
+
+def _intern(path):
+    '''Returns interned path, or None'''
+
+    if path is None:
+        return None
+
+    return intern(path)
+
+
+def _record_callback(obj, post_dict, dir_changed, entries, tree):
+    '''callback for visit(); records the entries in the manifest'''
+
+    generator = None
+    if obj.ov_type == synctool.overlay.OV_TEMPLATE:
+        template = os.path.join(os.path.dirname(obj.src_path),
+                                os.path.basename(obj.dest_path) +
+                                '._template')
+        generator = post_dict.get(template)
+        # the template is generated on the client, not here
+        # setting OV_IGNORE keeps visit() from registering the output
+        ov_type = obj.ov_type
+        obj.ov_type = synctool.overlay.OV_IGNORE
+    else:
+        ov_type = obj.ov_type
+
+    entries.append((tree, ov_type, _relpath(obj.src_path), obj.dest_path,
+                    _relpath(post_dict.get(obj.dest_path)),
+                    _relpath(post_dict.get(os.path.dirname(obj.dest_path))),
+                    _relpath(generator)))
+    return True, False
+
+
+def _write_manifest(filename, sig, entries):
+    '''write manifest file
+    Returns False on error'''
+
+    for entry in entries:
+        for field in entry[2:]:
+            if '\t' in field or '\n' in field:
+                # can not represent this in a manifest
+                verbose('not writing manifest: unsupported filename %s' %
+                        field)
+                return False
+
+    tmp_filename = filename + '.tmp'
+    try:
+        f = open(tmp_filename, 'w')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    with f:
+        f.write('%s\n' % MANIFEST_MAGIC)
+        f.write('groups\t%s\n' % ' '.join(sig))
+        f.write('settings\t%s\n' % settings())
+        for entry in entries:
+            f.write('%s\t%d\t%s\n' % (entry[0], entry[1],
+                                      '\t'.join(entry[2:])))
+
+    try:
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        stderr('failed to rename %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    return True
+
+
+def make_manifests(nodes):
+    '''make manifests for these nodes (on the master node)
+    Returns False on error'''
+
+    global USED_GROUPS
+
+    if not synctool.lib.mkdir_p(synctool.param.MANIFEST_DIR):
+        return False
+
+    USED_GROUPS = used_groups()
+
+    filename = os.path.join(synctool.param.MANIFEST_DIR, 'groups')
+    try:
+        f = open(filename, 'w')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (filename, err.strerror))
+        USED_GROUPS = None
+        return False
+
+    with f:
+        f.write('%s\n' % ' '.join(sorted(USED_GROUPS)))
+
+    orig_my_groups = synctool.param.MY_GROUPS
+
+    done = set()
+    errors = 0
+    for node in nodes:
+        sig = signature(synctool.config.get_groups(node), USED_GROUPS)
+        name = manifest_name(sig)
+        if name in done:
+            continue
+
+        done.add(name)
+
+        verbose('making manifest for groups %s' % ' '.join(sig))
+
+        synctool.param.MY_GROUPS = sig
+
+        entries = []
+        synctool.overlay.visit(synctool.param.OVERLAY_DIR, _record_callback,
+                               entries, 'o')
+        synctool.overlay.visit(synctool.param.DELETE_DIR, _record_callback,
+                               entries, 'd')
+
+        if not _write_manifest(os.path.join(synctool.param.MANIFEST_DIR,
+                                            name), sig, entries):
+            errors += 1
+
+    synctool.param.MY_GROUPS = orig_my_groups
+
+    if errors > 0:
+        USED_GROUPS = None
+        return False
+
+    return True
+
+
+def node_manifest():
+    '''Returns filename of the manifest for MY_GROUPS
+    or None if no manifests were made'''
+
+    if USED_GROUPS is None:
+        return None
+
+    return manifest_name(signature(synctool.param.MY_GROUPS, USED_GROUPS))
+
+
+def load():
+    '''load the manifest for this node (on the client)
+    When a valid manifest is found, synctool.overlay.visit() will
+    replay it rather than walking the trees
+    Returns True on success, False if not'''
+
+    filename = os.path.join(synctool.param.MANIFEST_DIR, 'groups')
+    try:
+        f = open(filename)
+    except IOError:
+        verbose('no manifest available')
+        return False
+
+    with f:
+        used = set(f.readline().split())
+
+    sig = signature(synctool.param.MY_GROUPS, used)
+    filename = os.path.join(synctool.param.MANIFEST_DIR, manifest_name(sig))
+    try:
+        f = open(filename)
+    except IOError:
+        verbose('no manifest available for groups %s' % ' '.join(sig))
+        return False
+
+    trees = {'o': synctool.param.OVERLAY_DIR,
+             'd': synctool.param.DELETE_DIR}
+    manifest = {synctool.param.OVERLAY_DIR: [],
+                synctool.param.DELETE_DIR: []}
+
+    with f:
+        if (f.readline().rstrip('\n') != MANIFEST_MAGIC or
+            f.readline().rstrip('\n') != 'groups\t' + ' '.join(sig)):
+            verbose('manifest %s does not match my groups' % filename)
+            return False
+
+        if f.readline().rstrip('\n') != 'settings\t' + settings():
+            verbose('manifest %s does not match my config' % filename)
+            return False
+
+        for line in f:
+            arr = line.rstrip('\n').split('\t')
+            if len(arr) != 7 or not arr[0] in trees:
+                stderr('error: invalid manifest %s' % filename)
+                return False
+
+            # the .post scripts repeat for all entries in a directory;
+            # share the strings
+            manifest[trees[arr[0]]].append((int(arr[1]),
+                                            _abspath(arr[2]), arr[3],
+                                            _intern(_abspath(arr[4])),
+                                            _intern(_abspath(arr[5])),
+                                            _intern(_abspath(arr[6]))))
+
+    verbose('using manifest %s' % filename)
+    synctool.overlay.MANIFEST = manifest
+    return True
+
+
+def _dir_hash(path, dirs):
+    '''hash the entries of directory path and of its subdirectories
+    dirs is a list that the (path, hash) pairs are appended to
+    Raises OSError on error'''
+
+    md5 = hashlib.md5()
+    subdirs = []
+    for name in sorted(os.listdir(path)):
+        fullpath = os.path.join(path, name)
+        statbuf = os.lstat(fullpath)
+        if stat.S_ISDIR(statbuf.st_mode):
+            # a change within the subdirectory is not a change in here
+            md5.update('%s %d\n' % (name, statbuf.st_ino))
+            subdirs.append(fullpath)
+        else:
+            md5.update('%s %d %o %d %d %d %r %r\n' % (name, statbuf.st_ino,
+                                                      statbuf.st_mode,
+                                                      statbuf.st_uid,
+                                                      statbuf.st_gid,
+                                                      statbuf.st_size,
+                                                      statbuf.st_mtime,
+                                                      statbuf.st_ctime))
+
+    dirs.append((path, md5.hexdigest()))
+
+    for subdir in subdirs:
+        _dir_hash(subdir, dirs)
+
+
+def make_tree_hash():
+    '''hash the directories of the overlay tree (on the master node)
+    The client takes these to know which source directories did not
+    change, see synctool.dirstate
+    Returns False on error'''
+
+    if not synctool.lib.mkdir_p(synctool.param.MANIFEST_DIR):
+        return False
+
+    dirs = []
+    try:
+        _dir_hash(synctool.param.OVERLAY_DIR, dirs)
+    except OSError as err:
+        stderr('error: failed to hash %s: %s' % (err.filename, err.strerror))
+        return False
+
+    filename = os.path.join(synctool.param.MANIFEST_DIR, TREE_HASH_FILE)
+    tmp_filename = filename + '.tmp'
+    try:
+        f = open(tmp_filename, 'w')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    with f:
+        f.write('%s\n' % TREE_HASH_MAGIC)
+        for path, digest in dirs:
+            path = _relpath(path)
+            if '\t' in path or '\n' in path:
+                # leave it out; it will not be skipped
+                continue
+
+            f.write('%s\t%s\n' % (digest, path))
+
+    try:
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        stderr('failed to rename %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    return True
+
+
+def load_tree_hash():
+    '''load the directory hashes that the master made (on the client)
+    Returns dict: TREE_HASH[src_dir] -> hash, or None'''
+
+    filename = os.path.join(synctool.param.MANIFEST_DIR, TREE_HASH_FILE)
+    try:
+        f = open(filename)
+    except IOError:
+        verbose('no tree hash available')
+        return None
+
+    tree_hash = {}
+    with f:
+        if f.readline().rstrip('\n') != TREE_HASH_MAGIC:
+            verbose('ignoring invalid tree hash %s' % filename)
+            return None
+
+        for line in f:
+            arr = line.rstrip('\n').split('\t')
+            if len(arr) != 2:
+                verbose('ignoring invalid tree hash %s' % filename)
+                return None
+
+            tree_hash[_abspath(arr[1])] = arr[0]
+
+    return tree_hash
+
+
+# EOB
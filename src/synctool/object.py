@@ -13,17 +13,36 @@
 import os
 import stat
 import time
-import shutil
-import hashlib
 
+import synctool.compare
+import synctool.digest
+import synctool.install
 import synctool.lib
 from synctool.lib import verbose, stdout, stderr, terse, unix_out, log
 from synctool.lib import dryrun_msg, prettypath
 import synctool.param
+import synctool.prefetch
+import synctool.saved
 import synctool.syncstat
 
-# size for doing I/O while checksumming files
-IO_SIZE = 16 * 1024
+# actions found by SyncObject.diff()
+ACT_CREATE = 'create'
+ACT_TYPE = 'type'
+ACT_UPDATE = 'update'
+ACT_OWNER = 'owner'
+ACT_MODE = 'mode'
+
+
+def _link_over(path, newpath):
+    '''hard link path to newpath, replacing newpath if it exists
+    Raises OSError on error'''
+
+    try:
+        os.unlink(newpath)
+    except OSError:
+        pass
+
+    os.link(path, newpath)
 
 
 class VNode(object):
@@ -47,18 +66,19 @@ class VNode(object):
     def move_saved(self):
         '''move existing entry to .saved'''
 
-        verbose(dryrun_msg('saving %s as %s.saved' % (self.name, self.name)))
-        unix_out('mv %s %s.saved' % (self.name, self.name))
+        saved = synctool.saved.backup_path(self.name)
+
+        verbose(dryrun_msg('saving %s as %s' % (self.name, saved)))
+        unix_out('mv %s %s' % (self.name, saved))
 
         if not synctool.lib.DRY_RUN:
-            verbose('  os.rename(%s, %s.saved)' % (self.name, self.name))
+            verbose('  os.rename(%s, %s)' % (self.name, saved))
             try:
-                os.rename(self.name, '%s.saved' % self.name)
+                synctool.saved.save_with(os.rename, self.name)
             except OSError as err:
-                stderr('failed to save %s as %s.saved : %s' % (self.name,
-                                                               self.name,
-                                                               err.strerror))
-                terse(synctool.lib.TERSE_FAIL, 'save %s.saved' % self.name)
+                stderr('failed to save %s as %s : %s' % (self.name, saved,
+                                                         err.strerror))
+                terse(synctool.lib.TERSE_FAIL, 'save %s' % saved)
 
 
     def harddelete(self):
@@ -117,6 +137,13 @@ class VNode(object):
         return True
 
 
+    def report(self, src_path, dest_stat):
+        '''report that the content differs, without comparing it again
+        For most types, comparing is cheap and prints the message'''
+
+        self.compare(src_path, dest_stat)
+
+
     def create(self):
         '''create a new entry'''
         pass
@@ -203,19 +230,23 @@ class VNodeFile(VNode):
         Return True if the same'''
 
         if self.stat.size != dest_stat.size:
-            if synctool.lib.DRY_RUN:
-                stdout('%s mismatch (file size)' % self.name)
-            else:
-                stdout('%s updated (file size mismatch)' % self.name)
-            terse(synctool.lib.TERSE_SYNC, self.name)
-            unix_out('# updating file %s' % self.name)
+            self._size_mismatch()
             return False
 
-        return self._compare_checksums(src_path)
+        if synctool.prefetch.active():
+            same = synctool.prefetch.result(src_path, self.stat, self.name,
+                                            dest_stat)
+            if same is not None:
+                if not same:
+                    self._checksum_mismatch()
+                return same
+
+        return self._compare_checksums(src_path, dest_stat)
 
 
-    def _compare_checksums(self, src_path):
-        '''compare checksum of src_path and dest: self.name
+    def _compare_checksums(self, src_path, dest_stat):
+        '''compare contents of src_path and dest: self.name
+        using the digest cache if it is enabled
         Return True if the same'''
 
         try:
@@ -225,9 +256,6 @@ class VNodeFile(VNode):
             # return True because we can't fix an error in src_path
             return True
 
-        sum1 = hashlib.md5()
-        sum2 = hashlib.md5()
-
         with f1:
             try:
                 f2 = open(self.name, 'rb')
@@ -237,59 +265,116 @@ class VNodeFile(VNode):
                 return False
 
             with f2:
-                ended = False
-                while not ended and (sum1.digest() == sum2.digest()):
-                    try:
-                        data1 = f1.read(IO_SIZE)
-                    except IOError as err:
-                        stderr('error reading file %s: %s' % (src_path,
-                                                              err.strerror))
-                        return False
-
-                    if not data1:
-                        ended = True
+                try:
+                    if synctool.digest.enabled():
+                        same = synctool.digest.compare(f1, self.stat, f2,
+                                                       dest_stat)
                     else:
-                        sum1.update(data1)
+                        same = synctool.compare.compare_files(f1, f2,
+                                                              self.stat.size)
+                except IOError as err:
+                    stderr('error reading file %s: %s' % (err.filename,
+                                                          err.strerror))
+                    return False
 
-                    try:
-                        data2 = f2.read(IO_SIZE)
-                    except IOError as err:
-                        stderr('error reading file %s: %s' % (self.name,
-                                                              err.strerror))
-                        return False
+        if not same:
+            self._checksum_mismatch()
+            return False
 
-                    if not data2:
-                        ended = True
-                    else:
-                        sum2.update(data2)
+        return True
 
-        if sum1.digest() != sum2.digest():
-            if synctool.lib.DRY_RUN:
-                stdout('%s mismatch (MD5 checksum)' % self.name)
-            else:
-                stdout('%s updated (MD5 mismatch)' % self.name)
 
-            unix_out('# updating file %s' % self.name)
-            terse(synctool.lib.TERSE_SYNC, self.name)
-            return False
+    def report(self, src_path, dest_stat):
+        '''report that the file differs, without comparing it again'''
+
+        if self.stat.size != dest_stat.size:
+            self._size_mismatch()
+        else:
+            self._checksum_mismatch()
+
+
+    def _size_mismatch(self):
+        '''report that the file size differs'''
+
+        if synctool.lib.DRY_RUN:
+            stdout('%s mismatch (file size)' % self.name)
+        else:
+            stdout('%s updated (file size mismatch)' % self.name)
+        terse(synctool.lib.TERSE_SYNC, self.name)
+        unix_out('# updating file %s' % self.name)
 
-        return True
+
+    def _checksum_mismatch(self):
+        '''report that the checksum differs'''
+
+        if synctool.lib.DRY_RUN:
+            stdout('%s mismatch (MD5 checksum)' % self.name)
+        else:
+            stdout('%s updated (MD5 mismatch)' % self.name)
+
+        unix_out('# updating file %s' % self.name)
+        terse(synctool.lib.TERSE_SYNC, self.name)
+
+
+    def fix(self):
+        '''install the file
+        It is written under a temporary name with the right owner and
+        permissions, and then renamed into place'''
+
+        if self.exists:
+            if os.path.isdir(self.name):
+                # a file can not be renamed over a directory
+                if synctool.param.BACKUP_COPIES:
+                    self.move_saved()
+                else:
+                    stderr('%s is in the way' % self.name)
+                    terse(synctool.lib.TERSE_FAIL, self.name)
+                    return
+
+            elif synctool.param.BACKUP_COPIES:
+                self.link_saved()
+
+        self.mkdir_basepath()
+        self.create()
+
+
+    def link_saved(self):
+        '''keep existing file as .saved
+        It is linked rather than moved, so that the file does not
+        disappear before the new one is in place'''
+
+        saved = synctool.saved.backup_path(self.name)
+
+        verbose(dryrun_msg('saving %s as %s' % (self.name, saved)))
+        unix_out('ln -f %s %s' % (self.name, saved))
+
+        if not synctool.lib.DRY_RUN:
+            verbose('  os.link(%s, %s)' % (self.name, saved))
+            try:
+                synctool.saved.save_with(_link_over, self.name)
+            except OSError as err:
+                stderr('failed to save %s as %s : %s' % (self.name, saved,
+                                                         err.strerror))
+                terse(synctool.lib.TERSE_FAIL, 'save %s' % saved)
 
 
     def create(self):
-        '''copy file'''
+        '''copy file, setting owner and permissions'''
 
         if not self.exists:
             terse(synctool.lib.TERSE_NEW, self.name)
 
         verbose(dryrun_msg('  copy %s %s' % (self.src_path, self.name)))
         unix_out('cp %s %s' % (self.src_path, self.name))
+        unix_out('chown %s.%s %s' % (self.stat.ascii_uid(),
+                                     self.stat.ascii_gid(), self.name))
+        unix_out('chmod 0%o %s' % (self.stat.mode & 07777, self.name))
 
         if not synctool.lib.DRY_RUN:
             try:
-                # copy file
-                shutil.copy(self.src_path, self.name)
-            except IOError as err:
+                synctool.install.install_file(self.src_path, self.name,
+                                              self.stat)
+            except (IOError, OSError) as err:
                 stderr('failed to copy %s to %s: %s' %
                        (prettypath(self.src_path), self.name, err.strerror))
                 terse(synctool.lib.TERSE_FAIL, self.name)
@@ -490,11 +575,6 @@ class VNodeFifo(VNode):
 class VNodeChrDev(VNode):
     '''vnode for a character device file'''
 
-    def __init__(self, filename, syncstat_obj, exists, src_stat):
-        super(VNodeChrDev, self).__init__(filename, syncstat_obj, exists)
-        self.src_stat = src_stat
-
-
     def typename(self):
         '''return file type as human readable string'''
         return 'character device file'
@@ -506,18 +586,10 @@ class VNodeChrDev(VNode):
         if not self.exists:
             return False
 
-        # dest_stat is a SyncStat object and it's useless here
-        # I need a real, fresh statbuf that includes st_rdev field
-        try:
-            dest_stat = os.lstat(self.name)
-        except OSError as err:
-            stderr('error checking %s : %s' % (self.name, err.strerror))
-            return False
-
-        src_major = os.major(self.src_stat.st_rdev)
-        src_minor = os.minor(self.src_stat.st_rdev)
-        dest_major = os.major(dest_stat.st_rdev)
-        dest_minor = os.minor(dest_stat.st_rdev)
+        src_major = os.major(self.stat.rdev)
+        src_minor = os.minor(self.stat.rdev)
+        dest_major = os.major(dest_stat.rdev)
+        dest_minor = os.minor(dest_stat.rdev)
         if src_major != dest_major or src_minor != dest_minor:
             stdout('%s should have major,minor %d,%d but has %d,%d' %
                    (self.name, src_major, src_minor, dest_major, dest_minor))
@@ -531,8 +603,8 @@ class VNodeChrDev(VNode):
     def create(self):
         '''make a character device file'''
 
-        major = os.major(self.src_stat.st_rdev)
-        minor = os.minor(self.src_stat.st_rdev)
+        major = os.major(self.stat.rdev)
+        minor = os.minor(self.stat.rdev)
 
         verbose(dryrun_msg('  os.mknod(%s, CHR %d,%d)' % (self.name, major,
                                                           minor)))
@@ -542,7 +614,7 @@ class VNodeChrDev(VNode):
         if not synctool.lib.DRY_RUN:
             try:
                 os.mknod(self.name,
-                         (self.src_stat.st_mode & 0777) | stat.S_IFCHR,
+                         (self.stat.mode & 0777) | stat.S_IFCHR,
                          os.makedev(major, minor))
             except OSError as err:
                 stderr('failed to create device %s : %s' % (self.name,
@@ -553,11 +625,6 @@ class VNodeChrDev(VNode):
 class VNodeBlkDev(VNode):
     '''vnode for a block device file'''
 
-    def __init__(self, filename, syncstat_obj, exists, src_stat):
-        super(VNodeBlkDev, self).__init__(filename, syncstat_obj, exists)
-        self.src_stat = src_stat
-
-
     def typename(self):
         '''return file type as human readable string'''
         return 'block device file'
@@ -569,18 +636,10 @@ class VNodeBlkDev(VNode):
         if not self.exists:
             return False
 
-        # dest_stat is a SyncStat object and it's useless here
-        # I need a real, fresh statbuf that includes st_rdev field
-        try:
-            dest_stat = os.lstat(self.name)
-        except OSError as err:
-            stderr('error checking %s : %s' % (self.name, err.strerror))
-            return False
-
-        src_major = os.major(self.src_stat.st_rdev)
-        src_minor = os.minor(self.src_stat.st_rdev)
-        dest_major = os.major(dest_stat.st_rdev)
-        dest_minor = os.minor(dest_stat.st_rdev)
+        src_major = os.major(self.stat.rdev)
+        src_minor = os.minor(self.stat.rdev)
+        dest_major = os.major(dest_stat.rdev)
+        dest_minor = os.minor(dest_stat.rdev)
         if src_major != dest_major or src_minor != dest_minor:
             stdout('%s should have major,minor %d,%d but has %d,%d' %
                 (self.name, src_major, src_minor, dest_major, dest_minor))
@@ -594,8 +653,8 @@ class VNodeBlkDev(VNode):
     def create(self):
         '''make a block device file'''
 
-        major = os.major(self.src_stat.st_rdev)
-        minor = os.minor(self.src_stat.st_rdev)
+        major = os.major(self.stat.rdev)
+        minor = os.minor(self.stat.rdev)
 
         verbose(dryrun_msg('  os.mknod(%s, BLK %d,%d)' % (self.name, major,
                                                           minor)))
@@ -605,7 +664,7 @@ class VNodeBlkDev(VNode):
         if not synctool.lib.DRY_RUN:
             try:
                 os.mknod(self.name,
-                         (self.src_stat.st_mode & 0777) | stat.S_IFBLK,
+                         (self.stat.mode & 0777) | stat.S_IFBLK,
                          os.makedev(major, minor))
             except OSError as err:
                 stderr('failed to create device %s : %s' % (self.name,
@@ -618,6 +677,9 @@ class SyncObject(object):
     and the destination path (target file on the system).
     The SyncObject caches any stat info'''
 
+    # there is one SyncObject per entry in the overlay tree, so keep it small
+    __slots__ = ('src_path', 'dest_path', 'ov_type', '_src_stat', '_dest_stat')
+
     def __init__(self, src_name, dest_name, ov_type=0):
         '''src_name is simple filename without leading path
         dest_name is the src_name without group extension
@@ -629,20 +691,52 @@ class SyncObject(object):
         self.src_path = src_name
         self.dest_path = dest_name
         self.ov_type = ov_type
-        self.src_stat = self.dest_stat = None
+        self._src_stat = self._dest_stat = None
 
     def make(self, src_dir, dest_dir):
-        '''make() fills in the full paths and stat structures'''
+        '''make() fills in the full paths
+        The source and destination are not stat'ed until
+        src_stat and dest_stat are used'''
 
         self.src_path = os.path.join(src_dir, self.src_path)
-        self.src_stat = synctool.syncstat.SyncStat(self.src_path)
+        self._src_stat = None
         self.dest_path = os.path.join(dest_dir, self.dest_path)
-        self.dest_stat = synctool.syncstat.SyncStat(self.dest_path)
+        self._dest_stat = None
+
+    def _get_src_stat(self):
+        '''Returns SyncStat of the source'''
+
+        if self._src_stat is None:
+            self._src_stat = synctool.syncstat.SyncStat(self.src_path)
+
+        return self._src_stat
+
+    def _set_src_stat(self, statbuf):
+        '''set SyncStat of the source'''
+
+        self._src_stat = statbuf
+
+    src_stat = property(_get_src_stat, _set_src_stat)
+
+    def _get_dest_stat(self):
+        '''Returns SyncStat of the destination'''
+
+        if self._dest_stat is None:
+            self._dest_stat = synctool.syncstat.SyncStat(self.dest_path)
+
+        return self._dest_stat
+
+    def _set_dest_stat(self, statbuf):
+        '''set SyncStat of the destination'''
+
+        self._dest_stat = statbuf
+
+    dest_stat = property(_get_dest_stat, _set_dest_stat)
 
     def print_src(self):
         '''pretty print my source path'''
 
-        if self.src_stat and self.src_stat.is_dir():
+        if self.src_stat.is_dir():
             return prettypath(self.src_path) + os.sep
 
         return prettypath(self.src_path)
@@ -655,23 +749,58 @@ class SyncObject(object):
         and fix it when not a dry run
         Return pair: updated, metadata_updated'''
 
+        return self.fix(self.diff())
+
+    def diff(self):
+        '''find the differences between src and dest
+        Returns list of actions (ACT_xxx) that fix them'''
+
         # src_path is under $overlay/
         # dest_path is in the filesystem
 
-        vnode = None
-
         if not self.dest_stat.exists():
-            stdout('%s does not exist' % self.dest_path)
-            log('creating %s' % self.dest_path)
-            vnode = self.vnode_obj()
-            vnode.fix()
-            return True, False
+            return [ACT_CREATE]
 
         src_type = self.src_stat.filetype()
         dest_type = self.dest_stat.filetype()
         if src_type != dest_type:
             # entry is of a different file type
+            return [ACT_TYPE]
+
+        vnode = self.vnode_obj()
+        if not vnode.compare(self.src_path, self.dest_stat):
+            # content is different; change the entire object
+            return [ACT_UPDATE]
+
+        actions = []
+        if ((self.src_stat.uid != self.dest_stat.uid) or
+            (self.src_stat.gid != self.dest_stat.gid)):
+            actions.append(ACT_OWNER)
+
+        if self.src_stat.mode != self.dest_stat.mode:
+            actions.append(ACT_MODE)
+
+        return actions
+
+    def fix(self, actions, report=False):
+        '''carry out the actions found by diff()
+        If report is True, the difference in content is reported here
+        rather than by comparing (used when applying a plan)
+        Return pair: updated, metadata_updated'''
+
+        if not actions:
+            return False, False
+
+        if actions[0] == ACT_CREATE:
+            stdout('%s does not exist' % self.dest_path)
+            log('creating %s' % self.dest_path)
             vnode = self.vnode_obj()
+            vnode.fix()
+            return True, False
+
+        vnode = self.vnode_obj()
+
+        if actions[0] == ACT_TYPE:
             stdout('%s should be a %s' % (self.dest_path, vnode.typename()))
             terse(synctool.lib.TERSE_WARNING, 'wrong type %s' %
                                                self.dest_path)
@@ -679,18 +808,16 @@ class SyncObject(object):
             vnode.fix()
             return True, False
 
-        vnode = self.vnode_obj()
-        if not vnode.compare(self.src_path, self.dest_stat):
-            # content is different; change the entire object
+        if actions[0] == ACT_UPDATE:
+            if report:
+                vnode.report(self.src_path, self.dest_stat)
             log('updating %s' % self.dest_path)
             vnode.fix()
             return True, False
 
-        # check ownership and permissions
-        # rectify if needed
+        # fix ownership and permissions
         meta_updated = False
-        if ((self.src_stat.uid != self.dest_stat.uid) or
-            (self.src_stat.gid != self.dest_stat.gid)):
+        if ACT_OWNER in actions:
             stdout('%s should have owner %s.%s (%d.%d), '
                    'but has %s.%s (%d.%d)' % (self.dest_path,
                    self.src_stat.ascii_uid(),
@@ -710,7 +837,7 @@ class SyncObject(object):
             vnode.set_owner()
             meta_updated = True
 
-        if self.src_stat.mode != self.dest_stat.mode:
+        if ACT_MODE in actions:
             stdout('%s should have mode %04o, but has %04o' %
                    (self.dest_path, self.src_stat.mode & 07777,
                     self.dest_stat.mode & 07777))
@@ -752,12 +879,10 @@ class SyncObject(object):
             return VNodeFifo(self.dest_path, self.src_stat, exists)
 
         if self.src_stat.is_chardev():
-            return VNodeChrDev(self.dest_path, self.src_stat, exists,
-                               os.stat(self.src_path))
+            return VNodeChrDev(self.dest_path, self.src_stat, exists)
 
         if self.src_stat.is_blockdev():
-            return VNodeBlkDev(self.dest_path, self.src_stat, exists,
-                               os.stat(self.src_path))
+            return VNodeBlkDev(self.dest_path, self.src_stat, exists)
 
         # error, can not handle file type of src_path
         return None
@@ -789,12 +914,10 @@ class SyncObject(object):
             return VNodeFifo(self.dest_path, self.src_stat, exists)
 
         if self.dest_stat.is_chardev():
-            return VNodeChrDev(self.dest_path, self.src_stat, exists,
-                               os.stat(self.src_path))
+            return VNodeChrDev(self.dest_path, self.src_stat, exists)
 
         if self.dest_stat.is_blockdev():
-            return VNodeBlkDev(self.dest_path, self.src_stat, exists,
-                               os.stat(self.src_path))
+            return VNodeBlkDev(self.dest_path, self.src_stat, exists)
 
         # error, can not handle file type of src_path
         return None
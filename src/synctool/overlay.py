@@ -35,9 +35,13 @@
 '''
 
 import os
-import fnmatch
+import collections
 
+import synctool.dirent
+import synctool.dirstate
+import synctool.ignore
 import synctool.lib
+import synctool.listing
 from synctool.lib import verbose, stderr, terse, prettypath
 import synctool.object
 from synctool.object import SyncObject
@@ -51,10 +55,63 @@ OV_TEMPLATE_POST = 3
 OV_NO_EXT = 4
 OV_IGNORE = 5
 
+# precompiled overlay resolution, see synctool.manifest
+# MANIFEST[overlay] -> [ list of entries ]
+MANIFEST = None
 
-def _sort_by_importance(item1, item2):
-    '''item is a tuple (x, importance)'''
-    return cmp(item1[1], item2[1])
+
+# sort order of object types in a directory: .post scripts first,
+# then template generators, then templates, then all others
+# This order is important
+TYPE_ORDER = {OV_POST: 0, OV_TEMPLATE_POST: 1, OV_TEMPLATE: 2}
+
+# directories that lead to the paths given to visit_paths()
+# None means: visit all directories
+WANTED_DIRS = None
+
+# the group directory that is being walked
+GROUP_DIR = None
+
+# skip source directories that synctool.dirstate knows to be in sync
+# the client sets this for the regular walk of the overlay tree
+SKIP_DIRS = False
+
+# number of errors reported about names in the overlay tree
+ERRORS = 0
+
+# function that is called with a list of SyncObjects before they are
+# passed to the callback, so that work can be done for them ahead of
+# time (see synctool.prefetch); the objects of a directory are passed
+# at once, and the entries of a manifest LOOKAHEAD_SIZE in advance
+LOOKAHEAD = None
+LOOKAHEAD_SIZE = 256
+
+# GROUP_IMPORTANCE[group] -> index of group in MY_GROUPS
+GROUP_IMPORTANCE = {}
+GROUP_LIST = None
+
+
+def _importance(group):
+    '''Returns importance of group, or -1 if it is not one of my groups'''
+
+    global GROUP_LIST
+
+    if GROUP_LIST is not synctool.param.MY_GROUPS:
+        # (re)build the dict; the master changes MY_GROUPS
+        # when it makes manifests for other nodes
+        GROUP_LIST = synctool.param.MY_GROUPS
+        GROUP_IMPORTANCE.clear()
+        for index, name in enumerate(GROUP_LIST):
+            if not name in GROUP_IMPORTANCE:
+                GROUP_IMPORTANCE[name] = index
+
+    return GROUP_IMPORTANCE.get(group, -1)
+
+
+def _sort_key(item):
+    '''Returns sort key for tuple (SyncObject, importance, is_dir)'''
+
+    return TYPE_ORDER.get(item[0].ov_type, 3), item[1]
 
 
 def _toplevel(overlay):
@@ -63,16 +120,15 @@ def _toplevel(overlay):
     arr = []
     for entry in os.listdir(overlay):
         fullpath = os.path.join(overlay, entry)
-        try:
-            importance = synctool.param.MY_GROUPS.index(entry)
-        except ValueError:
+        importance = _importance(entry)
+        if importance < 0:
             verbose('%s/ is not one of my groups, skipping' %
                     prettypath(fullpath))
             continue
 
         arr.append((fullpath, importance))
 
-    arr.sort(_sort_by_importance)
+    arr.sort(key=lambda x: x[1])
 
     # return list of only the directory names
     return [x[0] for x in arr]
@@ -89,6 +145,8 @@ def _split_extension(filename, src_dir):
     src_dir is passed for the purpose of printing error messages
     Returns tuple: SyncObject, importance'''
 
+    global ERRORS
+
     (name, ext) = os.path.splitext(filename)
     if not ext:
         return SyncObject(filename, name, OV_NO_EXT), _group_all()
@@ -112,9 +170,8 @@ def _split_extension(filename, src_dir):
     if ext == 'template':
         return SyncObject(filename, name, OV_TEMPLATE), _group_all()
 
-    try:
-        importance = synctool.param.MY_GROUPS.index(ext)
-    except ValueError:
+    importance = _importance(ext)
+    if importance < 0:
         if not ext in synctool.param.ALL_GROUPS:
             src_path = os.path.join(src_dir, filename)
             if synctool.param.TERSE:
@@ -122,6 +179,7 @@ def _split_extension(filename, src_dir):
                                                 src_path)
             else:
                 stderr('unknown group on %s, skipped' % prettypath(src_path))
+            ERRORS += 1
             return None, -1
 
         # it is not one of my groups
@@ -146,44 +204,65 @@ def _split_extension(filename, src_dir):
     return SyncObject(filename, name), importance
 
 
-def _sort_by_importance_post_first(item1, item2):
-    '''sort by importance, but always put .post scripts first'''
-
-    # after the .post scripts come ._template.post scripts
-    # then come regular files
-    # This order is important
-
-    obj1, importance1 = item1
-    obj2, importance2 = item2
+def _walk_dir(obj, duplicates, post_dict, callback, *args):
+    '''walk the subtree of directory obj, and run callback on
+    the directory itself
+    Returns False for quick exit'''
+
+    if WANTED_DIRS is not None and not obj.dest_path in WANTED_DIRS:
+        # none of the wanted paths are in there
+        updated = False
+    else:
+        if not obj.dest_path in duplicates:
+            # stat the dir before its entries are fixed, which may
+            # create it; the callback must see that it did not exist
+            obj.dest_stat.exists()
+
+        # if there is a .post script on this dir, pass it on
+        subdir_post_dict = {}
+        if obj.dest_path in post_dict:
+            subdir_post_dict[obj.dest_path] = post_dict[obj.dest_path]
+
+        ok, updated = _walk_subtree(obj.src_path, obj.dest_path,
+                                    duplicates, subdir_post_dict,
+                                    callback, *args)
+        if not ok:
+            return False
 
-    if obj1.ov_type == OV_POST:
-        if obj2.ov_type == OV_POST:
-            return cmp(importance1, importance2)
+    if obj.dest_path in duplicates:
+        # there already was a more important source for this dir
+        return True
 
-        return -1
+    duplicates.add(obj.dest_path)
 
-    if obj2.ov_type == OV_POST:
-        return 1
+    # run callback on the directory itself
+    ok, _ = callback(obj, post_dict, updated, *args)
+    return ok
 
-    if obj1.ov_type == OV_TEMPLATE_POST:
-        if obj2.ov_type == OV_TEMPLATE_POST:
-            return cmp(importance1, importance2)
 
-        return -1
+def _skip_subtree(src_dir, dest_dir, rec, duplicates, post_dict, callback,
+                  *args):
+    '''skip the entries of src_dir, which are known to be in sync,
+    but do walk its subdirectories
+    Returns pair of booleans: ok, dir was updated'''
 
-    if obj2.ov_type == OV_TEMPLATE_POST:
-        return 1
+    posts, subdirs = synctool.dirstate.skip_dir(src_dir, rec, duplicates)
 
-    if obj1.ov_type == OV_TEMPLATE:
-        if obj2.ov_type == OV_TEMPLATE:
-            return cmp(importance1, importance2)
+    # the subdirectories may have .post scripts in here
+    for key, src_path in posts:
+        if not key in post_dict:
+            post_dict[key] = src_path
 
-        return -1
+    for name in subdirs:
+        obj, _ = _split_extension(name, src_dir)
+        if not obj:
+            continue
 
-    if obj2.ov_type == OV_TEMPLATE:
-        return 1
+        obj.make(src_dir, dest_dir)
+        if not _walk_dir(obj, duplicates, post_dict, callback, *args):
+            return False, False
 
-    return cmp(importance1, importance2)
+    return True, False
 
 
 def _walk_subtree(src_dir, dest_dir, duplicates, post_dict, callback, *args):
@@ -194,46 +273,78 @@ def _walk_subtree(src_dir, dest_dir, duplicates, post_dict, callback, *args):
 
 #    verbose('_walk_subtree(%s)' % src_dir)
 
+    if SKIP_DIRS:
+        rec = synctool.dirstate.dir_unchanged(src_dir, dest_dir, duplicates)
+        if rec is not None:
+            return _skip_subtree(src_dir, dest_dir, rec, duplicates,
+                                 post_dict, callback, *args)
+
+        synctool.dirstate.dir_fingerprint(src_dir)
+
+    # directory in the repository relative to the group dir
+    # (with group extensions), for matching path patterns
+    rel_dir = src_dir[len(GROUP_DIR):].lstrip(os.sep)
+    if rel_dir:
+        rel_dir += os.sep
+
+    errors = ERRORS
+
     arr = []
-    for entry in os.listdir(src_dir):
-        if entry in synctool.param.IGNORE_FILES:
+    for entry, d_type in synctool.listing.listdir(src_dir):
+        # check any ignored files before any group extension is examined
+        ignored = synctool.ignore.match(rel_dir, entry)
+        if ignored == synctool.ignore.MATCH_NAME:
             verbose('ignoring %s' % prettypath(os.path.join(src_dir, entry)))
             continue
 
-        # check any ignored files with wildcards
-        # before any group extension is examined
-        wildcard_match = False
-        for wildcard_entry in synctool.param.IGNORE_FILES_WITH_WILDCARDS:
-            if fnmatch.fnmatchcase(entry, wildcard_entry):
-                wildcard_match = True
-                verbose('ignoring %s (pattern match)' %
-                        prettypath(os.path.join(src_dir, entry)))
-                break
-
-        if wildcard_match:
+        if ignored == synctool.ignore.MATCH_PATTERN:
+            verbose('ignoring %s (pattern match)' %
+                    prettypath(os.path.join(src_dir, entry)))
             continue
 
         obj, importance = _split_extension(entry, src_dir)
         if not obj:
             continue
 
-        arr.append((obj, importance))
+        if d_type == synctool.dirent.DT_UNKNOWN:
+            # find out later, when it is needed
+            is_dir = None
+        else:
+            is_dir = (d_type == synctool.dirent.DT_DIR)
+
+        arr.append((obj, importance, is_dir))
 
     # sort with .post scripts first
     # this ensures that post_dict will have the required script when needed
-    arr.sort(_sort_by_importance_post_first)
+    arr.sort(key=_sort_key)
+
+    for obj, _, _ in arr:
+        # Note: make() does not stat anything yet
+        obj.make(src_dir, dest_dir)
+
+    if LOOKAHEAD is not None:
+        LOOKAHEAD([x[0] for x in arr
+                   if not (x[0].ov_type in (OV_POST, OV_TEMPLATE_POST) or
+                           x[0].dest_path in duplicates)])
 
     dir_changed = False
 
-    for obj, importance in arr:
-        obj.make(src_dir, dest_dir)
+    # what is found in this directory, for synctool.dirstate
+    # it is recorded only when all of its entries are in sync
+    clean = (ERRORS == errors)
+    files = []
+    shadowed = []
+    posts = []
+    subdirs = []
 
+    for obj, importance, is_dir in arr:
         if obj.ov_type == OV_POST:
             # register the .post script and continue
             if obj.dest_path in post_dict:
                 continue
 
             post_dict[obj.dest_path] = obj.src_path
+            posts.append((obj.dest_path, obj.src_path))
             continue
 
         if obj.ov_type == OV_TEMPLATE_POST:
@@ -245,36 +356,22 @@ def _walk_subtree(src_dir, dest_dir, duplicates, post_dict, callback, *args):
                 continue
 
             post_dict[obj.dest_path] = obj.src_path
+            posts.append((obj.dest_path, obj.src_path))
             continue
 
-        if obj.src_stat.is_dir():
+        if is_dir is None:
+            is_dir = obj.src_stat.is_dir()
+
+        if is_dir:
             if synctool.param.IGNORE_DOTDIRS:
                 name = os.path.basename(obj.src_path)
                 if name[0] == '.':
                     verbose('ignoring dotdir %s' % obj.print_src())
                     continue
 
-            # if there is a .post script on this dir, pass it on
-            subdir_post_dict = {}
-            if obj.dest_path in post_dict:
-                subdir_post_dict[obj.dest_path] = post_dict[obj.dest_path]
-
-            ok, updated = _walk_subtree(obj.src_path, obj.dest_path,
-                                        duplicates, subdir_post_dict,
-                                        callback, *args)
-            if not ok:
-                # quick exit
-                return False, dir_changed
-
-            if obj.dest_path in duplicates:
-                # there already was a more important source for this dir
-                continue
-
-            duplicates.add(obj.dest_path)
+            subdirs.append(os.path.basename(obj.src_path))
 
-            # run callback on the directory itself
-            ok, _ = callback(obj, post_dict, updated, *args)
-            if not ok:
+            if not _walk_dir(obj, duplicates, post_dict, callback, *args):
                 # quick exit
                 return False, dir_changed
 
@@ -292,14 +389,23 @@ def _walk_subtree(src_dir, dest_dir, duplicates, post_dict, callback, *args):
                                                 obj.src_path)
             else:
                 stderr('no group extension on %s, skipped' % obj.print_src())
+            clean = False
             continue
 
         if obj.dest_path in duplicates:
             # there already was a more important source for this destination
+            shadowed.append(obj.dest_path)
             continue
 
         duplicates.add(obj.dest_path)
 
+        if obj.ov_type == OV_TEMPLATE:
+            # templates are generated in every run
+            clean = False
+        else:
+            files.append((os.path.basename(obj.src_path),
+                          os.path.basename(obj.dest_path)))
+
         ok, updated = callback(obj, post_dict, False, *args)
         if not ok:
             # quick exit
@@ -320,23 +426,226 @@ def _walk_subtree(src_dir, dest_dir, duplicates, post_dict, callback, *args):
                 # quick exit
                 return False, dir_changed
 
+        elif SKIP_DIRS and not synctool.dirstate.in_sync(obj.dest_path):
+            clean = False
+
         dir_changed |= updated
 
+    if SKIP_DIRS and clean:
+        synctool.dirstate.record_dir(src_dir, dest_dir, files, shadowed,
+                                     posts, subdirs)
+
     return True, dir_changed
 
 
+def _skip_manifest_dir(src_dir, dest_dir, entries):
+    '''check whether the entries of src_dir are known to be in sync
+    entries is the list of (src name, dest name) in the manifest
+    Returns set of names of the entries to skip, or None'''
+
+    rec = synctool.dirstate.dir_unchanged(src_dir, dest_dir, entries=entries)
+    if rec is None:
+        synctool.dirstate.dir_fingerprint(src_dir)
+        return None
+
+    _, subdirs = synctool.dirstate.skip_dir(src_dir, rec)
+
+    # the subdirectories are visited as usual
+    return set([x[0] for x in entries]) - set(subdirs)
+
+
+def _manifest_objects(entries, found):
+    '''Yields tuple: SyncObject, entry, this_dir for the entries of
+    a manifest that are to be visited
+    this_dir is the list in found for the source directory, or None'''
+
+    if SKIP_DIRS:
+        # the entries by source directory
+        by_dir = {}
+        for entry in entries:
+            src_dir, name = os.path.split(entry[1])
+            if not src_dir in by_dir:
+                by_dir[src_dir] = []
+            by_dir[src_dir].append((name, os.path.basename(entry[2])))
+
+    # skipped[src_dir] -> set of names of the entries to skip, or None
+    skipped = {}
+
+    for entry in entries:
+        ov_type, src_path, dest_path = entry[:3]
+        src_dir, src_name = os.path.split(src_path)
+        dest_dir, dest_name = os.path.split(dest_path)
+
+        if WANTED_DIRS is not None and not dest_dir in WANTED_DIRS:
+            continue
+
+        this_dir = None
+        if SKIP_DIRS:
+            if not src_dir in skipped:
+                skipped[src_dir] = _skip_manifest_dir(src_dir, dest_dir,
+                                                      by_dir[src_dir])
+                if skipped[src_dir] is None:
+                    found[src_dir] = [dest_dir, [], [], True]
+
+            if skipped[src_dir] is None:
+                this_dir = found[src_dir]
+            elif src_name in skipped[src_dir]:
+                continue
+
+        obj = SyncObject(src_name, dest_name, ov_type)
+        obj.make(src_dir, dest_dir)
+        yield obj, entry, this_dir
+
+
+def _lookahead(items):
+    '''Yields the items, after passing their SyncObjects to LOOKAHEAD
+    up to LOOKAHEAD_SIZE items in advance'''
+
+    window = collections.deque()
+    for item in items:
+        LOOKAHEAD([item[0]])
+        window.append(item)
+        if len(window) > LOOKAHEAD_SIZE:
+            yield window.popleft()
+
+    while window:
+        yield window.popleft()
+
+
+def _visit_manifest(entries, callback, *args):
+    '''replay the entries of a manifest
+    This calls the callback in the same order and with the same
+    arguments as _walk_subtree() would'''
+
+    # dir_changed by source directory
+    changed = {}
+
+    # found[src_dir] -> [dest_dir, files, subdirs, clean]
+    # like in _walk_subtree(), for synctool.dirstate
+    found = {}
+
+    objects = _manifest_objects(entries, found)
+    if LOOKAHEAD is not None:
+        objects = _lookahead(objects)
+
+    for obj, entry, this_dir in objects:
+        (ov_type, src_path, dest_path, post, dir_post, generator) = entry
+        src_dir, src_name = os.path.split(src_path)
+        dest_dir, dest_name = os.path.split(dest_path)
+
+        if not obj.src_stat.exists():
+            stderr('error: manifest is out of date: %s does not exist' %
+                   obj.print_src())
+            if this_dir is not None:
+                this_dir[3] = False
+            continue
+
+        # reconstruct the relevant part of the post_dict
+        post_dict = {}
+        if dir_post:
+            post_dict[dest_dir] = dir_post
+        if post:
+            post_dict[dest_path] = post
+        if generator:
+            post_dict[os.path.join(src_dir, dest_name + '._template')] = \
+                generator
+
+        if obj.src_stat.is_dir():
+            if this_dir is not None:
+                this_dir[2].append(src_name)
+
+            ok, _ = callback(obj, post_dict, changed.pop(src_path, False),
+                             *args)
+            if not ok:
+                # quick exit
+                return
+
+            continue
+
+        if this_dir is not None:
+            if ov_type == OV_TEMPLATE:
+                this_dir[3] = False
+            else:
+                this_dir[1].append((src_name, dest_name))
+
+        ok, updated = callback(obj, post_dict, False, *args)
+        if not ok:
+            # quick exit
+            return
+
+        if obj.ov_type == OV_IGNORE:
+            # OV_IGNORE may be set by templates that didn't finish
+            continue
+
+        if obj.ov_type == OV_TEMPLATE:
+            # a new file was generated
+            # call callback on the generated file
+            obj.ov_type = OV_REG
+            obj.make(src_dir, dest_dir)
+
+            ok, updated = callback(obj, post_dict, False, *args)
+            if not ok:
+                # quick exit
+                return
+
+        elif (this_dir is not None and
+              not synctool.dirstate.in_sync(dest_path)):
+            this_dir[3] = False
+
+        if updated:
+            changed[src_dir] = True
+
+    for src_dir, (dest_dir, files, subdirs, clean) in found.items():
+        if clean:
+            synctool.dirstate.record_dir(src_dir, dest_dir, files, (), (),
+                                         subdirs)
+
+
 def visit(overlay, callback, *args):
     '''visit all entries in the overlay tree
     overlay is either synctool.param.OVERLAY_DIR or synctool.param.DELETE_DIR
     callback will called with arguments: (SyncObject, post_dict)
     callback must return a two booleans: ok, updated'''
 
+    global GROUP_DIR
+
+    if MANIFEST is not None and overlay in MANIFEST:
+        _visit_manifest(MANIFEST[overlay], callback, *args)
+        return
+
     duplicates = set()
 
-    for d in _toplevel(overlay):
-        ok, _ = _walk_subtree(d, os.sep, duplicates, {}, callback, *args)
-        if not ok:
-            # quick exit
-            break
+    groups = _toplevel(overlay)
+
+    if WANTED_DIRS is None:
+        # list the group directories concurrently
+        synctool.listing.start(groups, synctool.param.LIST_THREADS,
+                               SKIP_DIRS)
+
+    try:
+        for d in groups:
+            GROUP_DIR = d
+            ok, _ = _walk_subtree(d, os.sep, duplicates, {}, callback,
+                                  *args)
+            if not ok:
+                # quick exit
+                break
+    finally:
+        GROUP_DIR = None
+        synctool.listing.stop()
+
+
+def visit_paths(overlay, paths, callback, *args):
+    '''like visit(), but only descend into directories that lead to
+    the destination paths in paths, which is a PathSet
+    Other entries may still be passed to the callback'''
+
+    global WANTED_DIRS
+
+    WANTED_DIRS = paths.dirs()
+    try:
+        visit(overlay, callback, *args)
+    finally:
+        WANTED_DIRS = None
 
 # EOB
@@ -34,6 +34,8 @@ DELETE_DIR = None
 DELETE_LEN = 0
 PURGE_DIR = None
 PURGE_LEN = 0
+MANIFEST_DIR = None
+STATE_DIR = None
 SCRIPT_DIR = None
 TEMP_DIR = '/tmp/synctool'
 HOSTNAME = None
@@ -52,10 +54,18 @@ PKG_CMD = None
 PACKAGE_MANAGER = None
 
 NUM_PROC = 16       # use sensible default
+NUM_POST_PROC = 1   # run .post scripts one at a time
 SLEEP_TIME = 0
 
+# adapt the number of concurrent nodes between these bounds
+ADAPTIVE_NUM_PROC = False
+MIN_NUM_PROC = 4
+MAX_NUM_PROC = 64
+MAX_LOAD = None     # default is the number of CPUs
+
 REQUIRE_EXTENSION = True
 BACKUP_COPIES = True
+BACKUP_DIR = None   # keep backup copies here rather than next to the file
 SYSLOGGING = True
 FULL_PATH = False
 TERSE = False
@@ -63,6 +73,21 @@ IGNORE_DOTFILES = False
 IGNORE_DOTDIRS = False
 IGNORE_FILES = set()
 IGNORE_FILES_WITH_WILDCARDS = []
+IGNORE_PATHS = []
+DIGEST_CACHE = True
+DIGEST_CACHE_SIZE = 100000
+TEMPLATE_CACHE = False
+DIR_STATE = True
+PURGE_RSYNC = False
+FSYNC = True
+DELTA_SIZE = 0      # in megabytes; 0 means off
+LIST_THREADS = 1    # threads for listing the overlay tree
+COMPARE_MAX_READ = 0        # MB/s; 0 means no limit
+COMPARE_MAX_IOPS = 0        # reads per second; 0 means no limit
+COMPARE_IDLE = False
+COMPARE_DROP_CACHE = False
+PRIORITY_PATHS = []
+TEMPLATE_ENV = []
 
 # default_nodeset parameter in the config file
 # warning: config.make_default_nodeset() is only called by commands that are
@@ -120,6 +145,11 @@ ALL_GROUPS = None
 # set of nodes that don't want an rsync copy
 NO_RSYNC = set()
 
+# bandwidth in MB/s for all rsyncs together; 0 means no limit
+RSYNC_BANDWIDTH = 0
+# BWLIMITS[node] -> MB/s for the rsync to the node
+BWLIMITS = {}
+
 # colorize output
 COLORIZE = True
 COLORIZE_FULL_LINE = False
@@ -160,7 +190,8 @@ def init():
 
     global ROOTDIR, CONF_FILE
     global VAR_DIR, VAR_LEN, OVERLAY_DIR, OVERLAY_LEN, DELETE_DIR, DELETE_LEN
-    global PURGE_DIR, PURGE_LEN, SCRIPT_DIR, ORIG_UMASK
+    global PURGE_DIR, PURGE_LEN, MANIFEST_DIR, STATE_DIR, SCRIPT_DIR
+    global ORIG_UMASK
 
     base = os.path.abspath(os.path.dirname(sys.argv[0]))
     if not base:
@@ -178,6 +209,8 @@ def init():
     DELETE_LEN = len(DELETE_DIR) + 1
     PURGE_DIR = os.path.join(VAR_DIR, 'purge')
     PURGE_LEN = len(PURGE_DIR) + 1
+    MANIFEST_DIR = os.path.join(VAR_DIR, 'manifest')
+    STATE_DIR = os.path.join(VAR_DIR, 'state')
     SCRIPT_DIR = os.path.join(ROOTDIR, 'scripts')
 
     # the following only makes sense for synctool-client, but OK
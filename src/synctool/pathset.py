@@ -0,0 +1,141 @@
+#
+#   synctool.pathset.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''set of destination paths given on the command-line
+
+    Paths are looked up in a dict. Terse paths (like "//etc/.../file")
+    are indexed by their last component, so that only the few terse
+    paths that end in the same name are matched against a path.
+'''
+
+import os
+import sys
+
+import synctool.lib
+
+
+def _is_terse(path):
+    '''Returns True if path is a terse path'''
+
+    return path[:2] == os.sep + os.sep
+
+
+def _terse_key(path):
+    '''Returns index key for terse path'''
+
+    name = os.path.basename(path)
+    if not name or name == '...':
+        # can not index this one; it is matched against all paths
+        return None
+
+    return name
+
+
+class PathSet(object):
+    '''set of paths, kept in the order in which they were added'''
+
+    def __init__(self, paths=None):
+        # PATHS[path] -> sequence number
+        self.paths = {}
+        # TERSE[last component] -> [ list of terse paths ]
+        self.terse = {}
+        self.seq = 0
+
+        if paths:
+            for path in paths:
+                self.add(path)
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __iter__(self):
+        return iter(sorted(self.paths, key=self.paths.get))
+
+    def add(self, path):
+        '''add path to the set'''
+
+        if path in self.paths:
+            return
+
+        self.paths[path] = self.seq
+        self.seq += 1
+
+        if _is_terse(path):
+            key = _terse_key(path)
+            if not key in self.terse:
+                self.terse[key] = []
+            self.terse[key].append(path)
+
+    def remove(self, path):
+        '''remove path from the set'''
+
+        del self.paths[path]
+
+        if _is_terse(path):
+            key = _terse_key(path)
+            self.terse[key].remove(path)
+            if not self.terse[key]:
+                del self.terse[key]
+
+    def take(self, path):
+        '''if path (or a terse path matching it) is in the set,
+        remove it
+        Returns True if it was in the set'''
+
+        if path in self.paths:
+            self.remove(path)
+            return True
+
+        if not self.terse:
+            return False
+
+        for key in (os.path.basename(path), None):
+            for terse_path in self.terse.get(key, ()):
+                if synctool.lib.terse_match(terse_path, path):
+                    self.remove(terse_path)
+                    return True
+
+        return False
+
+    def dirs(self):
+        '''Returns set of directories that lead to the paths,
+        or None if that is not known because there are terse paths'''
+
+        if self.terse:
+            return None
+
+        dirs = set([os.sep])
+        for path in self.paths:
+            path = os.path.dirname(path)
+            while not path in dirs:
+                dirs.add(path)
+                path = os.path.dirname(path)
+
+        return dirs
+
+
+def read_paths(filename):
+    '''read paths from file, one per line; '-' reads from stdin
+    Returns list of paths
+    Raises IOError on error'''
+
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename) as f:
+            lines = f.read().splitlines()
+
+    return [line.strip() for line in lines if line.strip()]
+
+
+# EOB
@@ -0,0 +1,190 @@
+#
+#   synctool.plan.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''change plans: the changes found by a dry run, for use by a later --fix
+
+    A dry run with --plan records for every entry of the overlay tree
+    the actions that it found were needed (see SyncObject.diff()),
+    together with the stat fingerprints of the source and destination.
+    A --fix run with --apply-plan carries out those actions without
+    comparing the files again, provided the fingerprints still match.
+    Entries that changed since the dry run are checked in full, as are
+    entries that are not in the plan.
+    The plan is removed after it has been applied.
+'''
+
+import os
+import time
+import marshal
+
+from synctool.lib import verbose, stderr
+import synctool.dirstate
+import synctool.lib
+import synctool.param
+
+PLAN_FILE = 'plan'
+PLAN_VERSION = 1
+
+# True when recording a plan in this run
+RECORDING = False
+
+# the plan being applied, or None
+# PLAN[dest_path] -> (src_path, src_fingerprint, dest_fp, actions)
+# dest_fp is None if the destination did not exist
+PLAN = None
+
+# the plan as found in this run
+NEW_PLAN = {}
+
+# statistics
+APPLIED = 0
+CHECKED = 0
+
+
+def _plan_filename():
+    '''Returns full path to the plan file'''
+
+    return os.path.join(synctool.param.STATE_DIR, PLAN_FILE)
+
+
+def _fingerprints(obj):
+    '''Returns pair: fingerprints of source and destination of obj'''
+
+    if obj.dest_stat.exists():
+        dest_fp = synctool.dirstate.fingerprint(obj.dest_stat)
+    else:
+        dest_fp = None
+
+    return synctool.dirstate.fingerprint(obj.src_stat), dest_fp
+
+
+def applying():
+    '''Returns True if applying a plan'''
+
+    return PLAN is not None
+
+
+def record(obj, actions):
+    '''record the actions that SyncObject obj needs'''
+
+    src_fp, dest_fp = _fingerprints(obj)
+    NEW_PLAN[obj.dest_path] = (obj.src_path, src_fp, dest_fp, actions)
+
+
+def save():
+    '''write the plan of this run
+    Returns True if the plan was saved'''
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return False
+
+    filename = _plan_filename()
+    tmp_filename = filename + '.tmp'
+    try:
+        f = open(tmp_filename, 'wb')
+    except IOError as err:
+        stderr('failed to write %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    with f:
+        marshal.dump((PLAN_VERSION, synctool.param.NODENAME, time.time(),
+                      NEW_PLAN), f)
+
+    try:
+        os.rename(tmp_filename, filename)
+    except OSError as err:
+        stderr('failed to rename %s: %s' % (tmp_filename, err.strerror))
+        return False
+
+    verbose('saved plan of %d entries' % len(NEW_PLAN))
+    return True
+
+
+def load():
+    '''load the plan to apply
+    Returns True if there is a plan'''
+
+    global PLAN
+
+    filename = _plan_filename()
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        stderr('warning: no plan found; checking all entries')
+        return False
+
+    with f:
+        try:
+            version, nodename, made, plan = marshal.load(f)
+        except (EOFError, ValueError, TypeError):
+            stderr('ignoring invalid plan file %s' % filename)
+            return False
+
+    if version != PLAN_VERSION:
+        stderr('ignoring plan file %s of another version' % filename)
+        return False
+
+    if nodename != synctool.param.NODENAME:
+        stderr('ignoring plan file %s of node %s' % (filename, nodename))
+        return False
+
+    verbose('applying plan of %d entries, made %s' %
+            (len(plan), time.strftime('%Y/%m/%d %H:%M:%S',
+                                      time.localtime(made))))
+    PLAN = plan
+    return True
+
+
+def lookup(obj):
+    '''Returns list of planned actions for SyncObject obj,
+    or None if it is not in the plan or changed since'''
+
+    try:
+        src_path, src_fp, dest_fp, actions = PLAN[obj.dest_path]
+    except KeyError:
+        return None
+
+    if src_path != obj.src_path:
+        return None
+
+    if (src_fp, dest_fp) != _fingerprints(obj):
+        return None
+
+    return actions
+
+
+def count(applied):
+    '''count entry as applied from the plan or checked in full'''
+
+    global APPLIED, CHECKED
+
+    if applied:
+        APPLIED += 1
+    else:
+        CHECKED += 1
+
+
+def finish():
+    '''report on the plan and remove it'''
+
+    if PLAN is None:
+        return
+
+    verbose('plan: %d entries applied, %d entries checked' %
+            (APPLIED, CHECKED))
+
+    filename = _plan_filename()
+    try:
+        os.unlink(filename)
+    except OSError as err:
+        stderr('failed to remove %s: %s' % (filename, err.strerror))
+
+
+# EOB
@@ -0,0 +1,243 @@
+#
+#   synctool.postqueue.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''queue of .post scripts to run
+
+    .post scripts are not run right away; they are queued, and run
+    when all updates are done. A script is run only once for a
+    directory, no matter how many changed files triggered it.
+    Scripts run one after another, in the order in which they were
+    triggered. When NUM_POST_PROC is more than one, scripts for
+    different directories may run in parallel; scripts for the same
+    directory still run one after another, in trigger order.
+'''
+
+import os
+import sys
+import time
+import shlex
+import threading
+import subprocess
+
+import synctool.lib
+from synctool.lib import verbose, stdout, stderr, terse, unix_out
+from synctool.lib import prettypath
+import synctool.param
+import synctool.syncstat
+
+# list of (run_dir, cmd) in the order in which they were triggered
+QUEUE = []
+
+# set of (script, run_dir) that are already queued
+SEEN = set()
+
+# used for printing output of parallel running commands
+OUTPUT_LOCK = threading.Lock()
+
+
+def add(cmd, run_dir):
+    '''queue command to run in directory'''
+
+    # a command can have arguments
+    arr = shlex.split(cmd)
+    # scripts may be symlinks to a shared script
+    key = (os.path.realpath(arr[0]), ' '.join(arr[1:]), run_dir)
+    if key in SEEN:
+        verbose('%s for %s already queued' % (prettypath(cmd), run_dir))
+        return
+
+    SEEN.add(key)
+    QUEUE.append((run_dir, cmd))
+
+
+def pending():
+    '''Returns list of (run_dir, cmd) of all queued commands'''
+
+    return QUEUE[:]
+
+
+def _by_dir():
+    '''Returns list of (run_dir, [ list of commands ])
+    in the order in which the dirs were first triggered'''
+
+    dirs = {}
+    order = []
+    for run_dir, cmd in QUEUE:
+        if not run_dir in dirs:
+            dirs[run_dir] = []
+            order.append((run_dir, dirs[run_dir]))
+
+        dirs[run_dir].append(cmd)
+
+    return order
+
+
+def _check_command(cmd):
+    '''check that the command exists and is executable
+    Returns True if OK'''
+
+    cmdfile = shlex.split(cmd)[0]
+
+    statbuf = synctool.syncstat.SyncStat(cmdfile)
+    if not statbuf.exists():
+        stderr('error: command %s not found' % prettypath(cmdfile))
+        return False
+
+    if not statbuf.is_exec():
+        stderr("warning: file '%s' is not executable" % prettypath(cmdfile))
+        return False
+
+    return True
+
+
+def _announce(cmd, run_dir):
+    '''print what command is going to run'''
+
+    if synctool.lib.DRY_RUN:
+        not_str = 'not '
+    else:
+        not_str = ''
+
+    cmdfile = shlex.split(cmd)[0]
+
+    if not synctool.lib.QUIET:
+        stdout('%srunning command %s' % (not_str, prettypath(cmd)))
+
+    verbose(synctool.lib.dryrun_msg('  os.system(%s) in %s' %
+                                    (prettypath(cmd), run_dir)))
+    unix_out('cd %s' % run_dir)
+    unix_out('# run command %s' % cmdfile)
+    unix_out(cmd)
+    unix_out('')
+    terse(synctool.lib.TERSE_EXEC, cmdfile)
+
+
+def _run_command(cmd, run_dir, capture):
+    '''run a shell command in directory
+    When capture is True, the output is returned rather than printed
+    Returns pair: output, elapsed time'''
+
+    if capture:
+        out = subprocess.PIPE
+        err_out = subprocess.STDOUT
+    else:
+        out = err_out = None
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    t0 = time.time()
+    try:
+        proc = subprocess.Popen(cmd, shell=True, cwd=run_dir, stdout=out,
+                                stderr=err_out, close_fds=True)
+    except OSError as err:
+        return ("failed to run shell command '%s' : %s\n" %
+                (prettypath(cmd), err.strerror), 0.0)
+
+    output, _ = proc.communicate()
+
+    if not capture:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+    return output, time.time() - t0
+
+
+def _run_serial(cmd, run_dir):
+    '''run a queued command, with its output going straight to stdout'''
+
+    _announce(cmd, run_dir)
+    if synctool.lib.DRY_RUN:
+        return
+
+    output, elapsed = _run_command(cmd, run_dir, False)
+    if output:
+        # it's an error message
+        stderr(output.rstrip('\n'))
+
+    verbose('  %s finished in %.2f seconds' % (prettypath(cmd), elapsed))
+
+
+def _run_dir(run_dir, cmds):
+    '''run the queued commands for directory, capturing their output'''
+
+    for cmd in cmds:
+        output, elapsed = _run_command(cmd, run_dir, True)
+
+        # print the output in one go
+        with OUTPUT_LOCK:
+            _announce(cmd, run_dir)
+            if output:
+                sys.stdout.write(output)
+                if output[-1] != '\n':
+                    sys.stdout.write('\n')
+
+            verbose('  %s finished in %.2f seconds' % (prettypath(cmd),
+                                                       elapsed))
+            sys.stdout.flush()
+
+
+def _worker(dirs, lock):
+    '''thread main function: run commands for the dirs'''
+
+    while True:
+        with lock:
+            if not dirs:
+                break
+
+            run_dir, cmds = dirs.pop(0)
+
+        _run_dir(run_dir, cmds)
+
+
+def run():
+    '''run all queued commands'''
+
+    if not QUEUE:
+        return
+
+    if synctool.lib.NO_POST:
+        return
+
+    # check the commands first, so that any errors are printed
+    # in an orderly fashion
+    QUEUE[:] = [(run_dir, cmd) for run_dir, cmd in QUEUE
+                if _check_command(cmd)]
+
+    # temporarily restore original umask
+    # so the scripts run with the umask set by the sysadmin
+    os.umask(synctool.param.ORIG_UMASK)
+
+    dirs = _by_dir()
+    num_proc = min(synctool.param.NUM_POST_PROC, len(dirs))
+
+    if synctool.lib.DRY_RUN or num_proc <= 1:
+        for run_dir, cmd in QUEUE:
+            _run_serial(cmd, run_dir)
+    else:
+        lock = threading.Lock()
+        threads = []
+        for _ in xrange(num_proc):
+            t = threading.Thread(target=_worker, args=(dirs, lock))
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for t in threads:
+            # join with a timeout, or else signals are not delivered
+            while t.is_alive():
+                t.join(1.0)
+
+    os.umask(077)
+
+    del QUEUE[:]
+    SEEN.clear()
+
+
+# EOB
@@ -0,0 +1,253 @@
+#
+#   synctool.prefetch.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''check entries ahead of time, using a pool of threads
+
+    While the client walks the overlay tree, the entries of every
+    directory are submitted to the pool before they are checked in the
+    usual order (see synctool.overlay.LOOKAHEAD). The pool stats the
+    source and the destination, and compares the contents of files of
+    the same size. When the client gets to an entry, adopt() hands it
+    the stats from the pool, so the owner and mode checks need no
+    system calls, and VNodeFile.compare() picks up the result of the
+    compare.
+    The pool only reads; it never changes anything and it does not
+    print messages. The stats are used only when the client did not
+    change anything since the pool took them (see changed()); a compare
+    result is used only when both the source and the destination are
+    unchanged since; otherwise the work is simply done again.
+'''
+
+import threading
+import Queue
+
+import synctool.compare
+import synctool.digest
+import synctool.dirstate
+from synctool.lib import verbose
+import synctool.param
+import synctool.syncstat
+
+# number of threads; 1 means don't use the pool
+NUM_JOBS = 1
+
+# queue of jobs for the pool
+JOB_QUEUE = None
+THREADS = []
+
+# JOBS[dest_path] -> Job that was submitted
+JOBS = {}
+# RESULTS[dest_path] -> Job with a compare result, after adopt()
+RESULTS = {}
+
+# count of changes made by the client; see changed()
+GENERATION = 0
+
+# statistics
+USED = 0
+WASTED = 0
+
+
+class Job(object):
+    '''a job for the pool: stat an entry, and compare its contents'''
+
+    def __init__(self, src_path, dest_path, compare):
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.compare = compare
+        self.src_stat = self.dest_stat = None
+        self.src_key = self.dest_key = None
+        # the stats are valid if GENERATION did not change since
+        self.generation = None
+        # result is True (same), False (different) or None
+        # (not compared, or error)
+        self.result = None
+        self.done = threading.Event()
+
+    def run(self):
+        '''stat the entry, and compare the files'''
+
+        self.generation = GENERATION
+        self.src_stat = synctool.syncstat.SyncStat(self.src_path)
+        self.dest_stat = synctool.syncstat.SyncStat(self.dest_path)
+
+        if not (self.compare and self.src_stat.is_file() and
+                self.dest_stat.is_file() and
+                self.src_stat.size == self.dest_stat.size):
+            # nothing to compare
+            return
+
+        # the job has the attributes that dirstate needs of a SyncObject
+        if synctool.param.DIR_STATE and synctool.dirstate.unchanged(self):
+            # it will not be compared
+            return
+
+        self.src_key = _key(self.src_stat)
+        self.dest_key = _key(self.dest_stat)
+        try:
+            self.result = same_contents(self.src_path, self.src_stat,
+                                        self.dest_path, self.dest_stat)
+        except (IOError, OSError):
+            # leave it to the main thread to report the error
+            self.result = None
+
+
+def _key(statbuf):
+    '''Returns tuple that identifies the state of a file'''
+
+    return (statbuf.dev, statbuf.ino, statbuf.size, statbuf.mtime,
+            statbuf.ctime)
+
+
+def same_contents(src_path, src_stat, dest_path, dest_stat):
+    '''compare file contents, using the digest cache if it is enabled
+    src_stat and dest_stat are SyncStat objects
+    Returns True if the same
+    Raises IOError or OSError on error'''
+
+    with open(src_path, 'rb') as f1:
+        with open(dest_path, 'rb') as f2:
+            if synctool.digest.enabled():
+                return synctool.digest.compare(f1, src_stat, f2, dest_stat)
+
+            return synctool.compare.compare_files(f1, f2, src_stat.size)
+
+
+def _worker():
+    '''thread main function'''
+
+    while True:
+        job = JOB_QUEUE.get()
+        if job is None:
+            break
+
+        try:
+            job.run()
+        finally:
+            job.done.set()
+
+
+def start(num_jobs):
+    '''start the pool'''
+
+    global NUM_JOBS, JOB_QUEUE
+
+    NUM_JOBS = num_jobs
+    if NUM_JOBS <= 1:
+        return
+
+    JOB_QUEUE = Queue.Queue()
+
+    for _ in xrange(NUM_JOBS):
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+        THREADS.append(t)
+
+
+def stop():
+    '''stop the pool'''
+
+    global JOB_QUEUE
+
+    if JOB_QUEUE is None:
+        return
+
+    # drop any jobs that did not start yet
+    while True:
+        try:
+            JOB_QUEUE.get_nowait()
+        except Queue.Empty:
+            break
+
+    for _ in THREADS:
+        JOB_QUEUE.put(None)
+
+    # wait for running jobs, they may still write to the digest cache
+    for t in THREADS:
+        while t.is_alive():
+            t.join(1.0)
+
+    del THREADS[:]
+    JOB_QUEUE = None
+    JOBS.clear()
+    RESULTS.clear()
+
+    verbose('prefetch: %d results used, %d discarded' % (USED, WASTED))
+
+
+def active():
+    '''Returns True if the pool is running'''
+
+    return JOB_QUEUE is not None
+
+
+def changed():
+    '''the client changed something; stats that were taken
+    before are no longer to be trusted'''
+
+    global GENERATION
+
+    GENERATION += 1
+
+
+def submit(obj, compare=True):
+    '''submit SyncObject to the pool
+    If compare is False, the pool only stats it'''
+
+    if JOB_QUEUE is None or obj.dest_path in JOBS:
+        return
+
+    job = Job(obj.src_path, obj.dest_path, compare)
+    JOBS[obj.dest_path] = job
+    JOB_QUEUE.put(job)
+
+
+def adopt(obj):
+    '''give SyncObject the stats that the pool took for it'''
+
+    job = JOBS.pop(obj.dest_path, None)
+    if job is None or job.src_path != obj.src_path:
+        return
+
+    # wait with a timeout, or else signals are not delivered
+    while not job.done.is_set():
+        job.done.wait(1.0)
+
+    if job.generation == GENERATION:
+        obj.src_stat = job.src_stat
+        obj.dest_stat = job.dest_stat
+
+    if job.src_key is not None:
+        RESULTS[obj.dest_path] = job
+
+
+def result(src_path, src_stat, dest_path, dest_stat):
+    '''get result of compare from the pool
+    Returns True (same), False (different), or None if there is no
+    valid result'''
+
+    global USED, WASTED
+
+    job = RESULTS.pop(dest_path, None)
+    if job is None:
+        return None
+
+    if (job.result is None or job.src_path != src_path or
+            job.src_key != _key(src_stat) or
+            job.dest_key != _key(dest_stat)):
+        WASTED += 1
+        return None
+
+    USED += 1
+    return job.result
+
+
+# EOB
@@ -0,0 +1,546 @@
+#
+#   synctool.purge.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''mirror purge/ directories onto the target node
+
+    A purge directory makes the destination an exact copy of the source,
+    like 'rsync -a --delete' does: entries that are not in the source are
+    deleted, and entries are copied along with their permissions, owner
+    and timestamps. Owners are only set when running as root.
+    Files that differ only in timestamp are compared by contents (using
+    the digest cache, if enabled); if the contents are the same, only the
+    timestamp is fixed.
+
+    Every purge directory is scanned first, which gives a list of events.
+    The scans may run in a pool of threads. The events are reported and
+    applied by the main thread, in the order of the purge directories.
+    A purge directory that overlaps with an earlier one is scanned only
+    after the earlier one was applied.
+'''
+
+import os
+import sys
+import stat
+import errno
+import threading
+import Queue
+
+import synctool.install
+import synctool.lib
+from synctool.lib import verbose, stdout, stderr, unix_out, prettypath
+import synctool.prefetch
+import synctool.syncstat
+
+# event types
+EV_ERROR = 0
+EV_DELETE = 1
+EV_NEW = 2
+EV_UPDATE = 3
+EV_META = 4
+
+# queue of scans for the pool
+SCAN_QUEUE = None
+THREADS = []
+
+
+class Event(object):
+    '''a change to the destination, found by a scan
+    statbuf is the lstat() of the source; for EV_DELETE, it is the
+    lstat() of the destination. For EV_ERROR, reason is the message'''
+
+    __slots__ = ('ev_type', 'src_path', 'dest_path', 'statbuf', 'reason')
+
+    def __init__(self, ev_type, src_path, dest_path, statbuf, reason):
+        self.ev_type = ev_type
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.statbuf = statbuf
+        self.reason = reason
+
+    def __repr__(self):
+        return '[<Event>: %d %s (%s)]' % (self.ev_type, self.dest_path,
+                                          self.reason)
+
+    def is_dir(self):
+        '''Returns True if the event is about a directory'''
+
+        return self.statbuf is not None and stat.S_ISDIR(self.statbuf.st_mode)
+
+
+class Scan(object):
+    '''compares a purge directory with its destination'''
+
+    def __init__(self, src_dir, dest_dir):
+        self.src_dir = src_dir
+        self.dest_dir = dest_dir
+        self.events = []
+        # DIRS[dest_dir] -> lstat() of the source directory
+        self.dirs = {}
+        self.as_root = (os.geteuid() == 0)
+        # set when the scan is run by the pool
+        self.pooled = False
+        self.done = threading.Event()
+
+    def run(self):
+        '''scan the purge directory'''
+
+        try:
+            src_stat = os.lstat(self.src_dir)
+        except OSError as err:
+            self._error('stat(%s) failed: %s' % (prettypath(self.src_dir),
+                                                 err.strerror))
+        else:
+            self._compare(self.src_dir, src_stat, self.dest_dir)
+
+    def _add(self, ev_type, src_path, dest_path, statbuf, reason):
+        '''add event'''
+
+        self.events.append(Event(ev_type, src_path, dest_path, statbuf,
+                                 reason))
+
+    def _error(self, msg):
+        '''add error event'''
+
+        self._add(EV_ERROR, None, None, None, msg)
+
+    def _compare(self, src_path, src_stat, dest_path):
+        '''compare entry and add events for it'''
+
+        try:
+            dest_stat = os.lstat(dest_path)
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                self._error('stat(%s) failed: %s' % (dest_path, err.strerror))
+                return
+
+            dest_stat = None
+
+        if (dest_stat is not None and
+                stat.S_IFMT(dest_stat.st_mode) !=
+                stat.S_IFMT(src_stat.st_mode)):
+            # it is a different kind of entry; replace it
+            self._delete(dest_path, dest_stat)
+            dest_stat = None
+
+        if dest_stat is None:
+            self._add(EV_NEW, src_path, dest_path, src_stat, 'new')
+        else:
+            ev_type, reason = self._differs(src_path, src_stat, dest_path,
+                                            dest_stat)
+            if ev_type is not None:
+                self._add(ev_type, src_path, dest_path, src_stat, reason)
+
+        if stat.S_ISDIR(src_stat.st_mode):
+            self.dirs[dest_path] = src_stat
+            self._scan_dir(src_path, dest_path, dest_stat is not None)
+
+    def _differs(self, src_path, src_stat, dest_path, dest_stat):
+        '''compare entries of the same type
+        Returns pair: event type or None if the same, reason'''
+
+        mode = src_stat.st_mode
+
+        if stat.S_ISREG(mode):
+            if src_stat.st_size != dest_stat.st_size:
+                return EV_UPDATE, 'file size'
+
+            if int(src_stat.st_mtime) != int(dest_stat.st_mtime):
+                # the digest cache wants SyncStat objects
+                src_syncstat = synctool.syncstat.SyncStat(src_path)
+                dest_syncstat = synctool.syncstat.SyncStat(dest_path)
+                try:
+                    same = synctool.prefetch.same_contents(src_path,
+                                                           src_syncstat,
+                                                           dest_path,
+                                                           dest_syncstat)
+                except (IOError, OSError):
+                    same = False
+
+                if not same:
+                    return EV_UPDATE, 'contents'
+
+                return EV_META, 'timestamp'
+
+        elif stat.S_ISLNK(mode):
+            try:
+                if os.readlink(src_path) != os.readlink(dest_path):
+                    return EV_UPDATE, 'link target'
+            except OSError:
+                return EV_UPDATE, 'link target'
+
+        elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+            if src_stat.st_rdev != dest_stat.st_rdev:
+                return EV_UPDATE, 'device number'
+
+        if (not stat.S_ISLNK(mode) and
+                stat.S_IMODE(mode) != stat.S_IMODE(dest_stat.st_mode)):
+            return EV_META, 'permissions'
+
+        if self.as_root and (src_stat.st_uid != dest_stat.st_uid or
+                             src_stat.st_gid != dest_stat.st_gid):
+            return EV_META, 'owner'
+
+        if stat.S_ISDIR(mode) and (int(src_stat.st_mtime) !=
+                                   int(dest_stat.st_mtime)):
+            return EV_META, 'timestamp'
+
+        return None, None
+
+    def _scan_dir(self, src_dir, dest_dir, dest_exists):
+        '''scan directory'''
+
+        try:
+            src_names = sorted(os.listdir(src_dir))
+        except OSError as err:
+            # do not delete anything from the destination now
+            self._error('failed to read directory %s: %s' %
+                        (prettypath(src_dir), err.strerror))
+            return
+
+        if dest_exists:
+            try:
+                dest_names = sorted(os.listdir(dest_dir))
+            except OSError as err:
+                self._error('failed to read directory %s: %s' %
+                            (dest_dir, err.strerror))
+                return
+
+            src_set = set(src_names)
+            for name in dest_names:
+                if name in src_set:
+                    continue
+
+                path = os.path.join(dest_dir, name)
+                try:
+                    dest_stat = os.lstat(path)
+                except OSError as err:
+                    self._error('stat(%s) failed: %s' % (path, err.strerror))
+                    continue
+
+                self._delete(path, dest_stat)
+
+        for name in src_names:
+            src_path = os.path.join(src_dir, name)
+            try:
+                src_stat = os.lstat(src_path)
+            except OSError as err:
+                self._error('stat(%s) failed: %s' % (prettypath(src_path),
+                                                     err.strerror))
+                continue
+
+            self._compare(src_path, src_stat, os.path.join(dest_dir, name))
+
+    def _delete(self, dest_path, dest_stat):
+        '''add events for deleting the destination
+        The contents of a directory are deleted first'''
+
+        if stat.S_ISDIR(dest_stat.st_mode):
+            try:
+                names = sorted(os.listdir(dest_path))
+            except OSError as err:
+                self._error('failed to read directory %s: %s' %
+                            (dest_path, err.strerror))
+                names = []
+
+            for name in names:
+                path = os.path.join(dest_path, name)
+                try:
+                    statbuf = os.lstat(path)
+                except OSError as err:
+                    self._error('stat(%s) failed: %s' % (path, err.strerror))
+                    continue
+
+                self._delete(path, statbuf)
+
+        self._add(EV_DELETE, None, dest_path, dest_stat, 'deleting')
+
+
+def _overlaps(path1, path2):
+    '''Returns True if either path is under the other'''
+
+    return (path1 == path2 or path1.startswith(path2 + os.sep) or
+            path2.startswith(path1 + os.sep))
+
+
+def _worker():
+    '''thread main function'''
+
+    while True:
+        scan = SCAN_QUEUE.get()
+        if scan is None:
+            break
+
+        try:
+            scan.run()
+        except Exception as err:
+            scan._error('error while scanning %s: %s' %
+                        (prettypath(scan.src_dir), err))
+        finally:
+            scan.done.set()
+
+
+def _start_pool(num_jobs, scans):
+    '''start the pool and let it run the scans'''
+
+    global SCAN_QUEUE
+
+    SCAN_QUEUE = Queue.Queue()
+    for scan in scans:
+        SCAN_QUEUE.put(scan)
+
+    for _ in xrange(min(num_jobs, len(scans))):
+        t = threading.Thread(target=_worker)
+        t.daemon = True
+        t.start()
+        THREADS.append(t)
+
+    for _ in THREADS:
+        SCAN_QUEUE.put(None)
+
+
+def _stop_pool():
+    '''stop the pool'''
+
+    global SCAN_QUEUE
+
+    if SCAN_QUEUE is None:
+        return
+
+    # drop any scans that did not start yet
+    while True:
+        try:
+            scan = SCAN_QUEUE.get_nowait()
+        except Queue.Empty:
+            break
+
+        if scan is not None:
+            scan.done.set()
+
+    for _ in THREADS:
+        SCAN_QUEUE.put(None)
+
+    for t in THREADS:
+        while t.is_alive():
+            t.join(1.0)
+
+    del THREADS[:]
+    SCAN_QUEUE = None
+
+
+def _pretty(event):
+    '''Returns destination path for printing'''
+
+    if event.is_dir():
+        return prettypath(event.dest_path + os.sep)
+
+    return prettypath(event.dest_path)
+
+
+def _report(event):
+    '''print event'''
+
+    if event.ev_type == EV_DELETE:
+        stdout('deleting %s (purge)' % _pretty(event))
+        if event.is_dir():
+            unix_out('rmdir %s' % event.dest_path)
+        else:
+            unix_out('rm -f %s' % event.dest_path)
+        return
+
+    stdout('%s mismatch (purge)' % _pretty(event))
+    verbose('  %s: %s' % (event.dest_path, event.reason))
+
+    mode = event.statbuf.st_mode
+    if event.ev_type == EV_META:
+        unix_out('chown %d.%d %s' % (event.statbuf.st_uid,
+                                     event.statbuf.st_gid, event.dest_path))
+        if not stat.S_ISLNK(mode):
+            unix_out('chmod 0%o %s' % (stat.S_IMODE(mode), event.dest_path))
+            unix_out('touch -r %s %s' % (event.src_path, event.dest_path))
+
+    elif stat.S_ISDIR(mode):
+        unix_out('mkdir %s' % event.dest_path)
+
+    elif stat.S_ISLNK(mode):
+        unix_out('cp -P -p %s %s' % (event.src_path, event.dest_path))
+
+    else:
+        unix_out('cp -p %s %s' % (event.src_path, event.dest_path))
+
+
+def _set_meta(path, statbuf, as_root):
+    '''set owner, permissions and timestamp
+    Timestamps of directories are set later'''
+
+    mode = statbuf.st_mode
+
+    # chown first, because it may clear setuid bits
+    if as_root:
+        os.lchown(path, statbuf.st_uid, statbuf.st_gid)
+
+    if stat.S_ISLNK(mode):
+        return
+
+    os.chmod(path, stat.S_IMODE(mode))
+
+    if not stat.S_ISDIR(mode):
+        os.utime(path, (statbuf.st_atime, statbuf.st_mtime))
+
+
+def _create(src_path, statbuf, dest_path, as_root):
+    '''create dest_path as a copy of src_path
+    An existing dest_path is replaced in one go'''
+
+    mode = statbuf.st_mode
+
+    if stat.S_ISDIR(mode):
+        os.mkdir(dest_path, 0700)
+        _set_meta(dest_path, statbuf, as_root)
+        return
+
+    if stat.S_ISREG(mode):
+        synctool.install.install_file(src_path, dest_path,
+                                      synctool.syncstat.SyncStat(src_path))
+        return
+
+    tmp_path = os.path.join(os.path.dirname(dest_path),
+                            '.%s.purge' % os.path.basename(dest_path))
+    try:
+        os.unlink(tmp_path)
+    except OSError:
+        pass
+
+    try:
+        if stat.S_ISLNK(mode):
+            os.symlink(os.readlink(src_path), tmp_path)
+        else:
+            os.mknod(tmp_path, mode, statbuf.st_rdev)
+
+        _set_meta(tmp_path, statbuf, as_root)
+        os.rename(tmp_path, dest_path)
+
+    except (IOError, OSError):
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+
+        raise
+
+
+def _apply(event, as_root):
+    '''apply event to the destination'''
+
+    if event.ev_type == EV_DELETE:
+        if event.is_dir():
+            os.rmdir(event.dest_path)
+        else:
+            os.unlink(event.dest_path)
+
+    elif event.ev_type == EV_META:
+        _set_meta(event.dest_path, event.statbuf, as_root)
+
+    else:
+        _create(event.src_path, event.statbuf, event.dest_path, as_root)
+
+
+def _finish(scan):
+    '''report and apply the events of scan'''
+
+    # directories whose contents or timestamp changed
+    touched = set()
+
+    for event in scan.events:
+        if event.ev_type == EV_ERROR:
+            stderr('error: %s' % event.reason)
+            continue
+
+        _report(event)
+
+        if synctool.lib.DRY_RUN:
+            continue
+
+        if event.ev_type == EV_NEW and event.dest_path == scan.dest_dir:
+            # make any missing parent directories, like mkdir -p
+            synctool.lib.mkdir_p(os.path.dirname(event.dest_path))
+
+        try:
+            _apply(event, scan.as_root)
+        except (IOError, OSError) as err:
+            stderr('error: failed to purge %s: %s' % (event.dest_path,
+                                                      err.strerror))
+            continue
+
+        touched.add(os.path.dirname(event.dest_path))
+        if event.ev_type != EV_DELETE and event.is_dir():
+            touched.add(event.dest_path)
+
+    # set timestamps of directories, deepest first
+    for path in sorted(touched, reverse=True):
+        statbuf = scan.dirs.get(path)
+        if statbuf is None:
+            continue
+
+        try:
+            os.utime(path, (statbuf.st_atime, statbuf.st_mtime))
+        except OSError as err:
+            stderr('error: failed to set timestamp on %s: %s' %
+                   (path, err.strerror))
+
+
+def purge(paths, num_jobs=1):
+    '''mirror purge directories onto the destination
+    paths is a list of pairs: (src_dir, dest_dir)
+    num_jobs is the number of threads for scanning'''
+
+    scans = []
+    in_pool = []
+    for src_dir, dest_dir in paths:
+        scan = Scan(src_dir, dest_dir)
+
+        # overlapping purge dirs must be done one after another
+        for earlier in scans:
+            if _overlaps(dest_dir, earlier.dest_dir):
+                break
+        else:
+            in_pool.append(scan)
+            scan.pooled = True
+
+        scans.append(scan)
+
+    if num_jobs > 1 and len(in_pool) > 1:
+        _start_pool(num_jobs, in_pool)
+    else:
+        for scan in in_pool:
+            scan.pooled = False
+
+    try:
+        for scan in scans:
+            verbose('purging %s' % prettypath(scan.src_dir + os.sep))
+
+            if scan.pooled:
+                # wait with a timeout, or else signals are not delivered
+                while not scan.done.is_set():
+                    scan.done.wait(1.0)
+            else:
+                scan.run()
+
+            _finish(scan)
+
+            # free memory
+            scan.events = []
+            scan.dirs = {}
+
+            sys.stdout.flush()
+    finally:
+        _stop_pool()
+
+
+# EOB
@@ -0,0 +1,321 @@
+#
+#   synctool.rollout.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''rollout policy: in what order and how fast the nodes are started
+
+    The nodes can be split into waves, given as lists of nodes and
+    groups. A wave is started once the previous wave is done, or once
+    enough of its nodes have succeeded (--wave-success). Nodes that are
+    not in any wave make up the last wave.
+    The number of nodes of a group that run at the same time can be
+    limited, for instance to avoid filling the uplink of a rack, or
+    restarting all servers of a service at once.
+    The start rate limits how many nodes are started per second.
+'''
+
+import time
+import collections
+
+from synctool.lib import verbose, stderr
+import synctool.config
+import synctool.param
+import synctool.range
+
+# list of waves; a wave is a list of node and group names
+WAVES = []
+
+# GROUP_LIMITS[group] -> max number of nodes of group at the same time
+GROUP_LIMITS = {}
+
+# nodes to start per second; 0 means no limit
+START_RATE = 0.0
+
+# percentage of a wave that must succeed before the next wave starts;
+# None means all nodes of the wave must be done
+WAVE_SUCCESS = None
+
+# True if the rollout was stopped because a wave failed
+STOPPED = False
+
+
+def add_wave(namelist):
+    '''add a wave of nodes and groups
+    May throw RangeSyntaxError'''
+
+    names = []
+    for name in synctool.range.split_nodelist(namelist):
+        if '[' in name:
+            names.extend(synctool.range.expand(name))
+        else:
+            names.append(name)
+
+    WAVES.append(names)
+
+
+def add_group_limit(arg):
+    '''parse 'group,...:num' and limit the nodes of these groups
+    May throw RangeSyntaxError
+    Returns False on error'''
+
+    arr = arg.rsplit(':', 1)
+    if len(arr) != 2:
+        return False
+
+    try:
+        num = int(arr[1])
+    except ValueError:
+        return False
+
+    if num < 1:
+        return False
+
+    for group in synctool.range.split_nodelist(arr[0]):
+        if '[' in group:
+            for expanded in synctool.range.expand(group):
+                GROUP_LIMITS[expanded] = num
+        else:
+            GROUP_LIMITS[group] = num
+
+    return True
+
+
+def set_start_rate(arg):
+    '''set the start rate in nodes per second
+    Returns False on error'''
+
+    global START_RATE
+
+    try:
+        START_RATE = float(arg)
+    except ValueError:
+        return False
+
+    return START_RATE > 0
+
+
+def set_wave_success(arg):
+    '''set the percentage of a wave that must succeed
+    Returns False on error'''
+
+    global WAVE_SUCCESS
+
+    try:
+        WAVE_SUCCESS = int(arg)
+    except ValueError:
+        return False
+
+    return 0 < WAVE_SUCCESS <= 100
+
+
+def check():
+    '''check that the groups and nodes in the policy exist
+    Returns False on error'''
+
+    all_groups = synctool.param.ALL_GROUPS
+
+    for wave in WAVES:
+        for name in wave:
+            if not name in all_groups:
+                stderr("no such node or group '%s'" % name)
+                return False
+
+    for group in GROUP_LIMITS:
+        if not group in all_groups:
+            stderr("no such group '%s'" % group)
+            return False
+
+    return True
+
+
+def _make_waves(work, nodename_of):
+    '''Returns list of waves: lists of items of work
+    Items keep the order they have in work'''
+
+    if not WAVES:
+        return [list(work)]
+
+    # WAVE_OF[nodename] -> index of the first wave it is in
+    wave_of = {}
+    for index, names in enumerate(WAVES):
+        for node in synctool.config.get_nodes_in_groups(names):
+            if not node in wave_of:
+                wave_of[node] = index
+
+    last = len(WAVES)
+    waves = [[] for _ in xrange(last + 1)]
+    for item in work:
+        waves[wave_of.get(nodename_of(item), last)].append(item)
+
+    return [wave for wave in waves if wave]
+
+
+def _stop():
+    '''remember that the rollout was stopped'''
+
+    global STOPPED
+
+    STOPPED = True
+
+
+def _identity(item):
+    '''Returns item'''
+
+    return item
+
+
+class Scheduler(object):
+    '''hands out the work according to the rollout policy'''
+
+    def __init__(self, work, nodename_of=None):
+        '''nodename_of(item) gives the nodename for an item of work'''
+
+        if nodename_of is None:
+            nodename_of = _identity
+        self.nodename_of = nodename_of
+
+        self.waves = _make_waves(work, nodename_of)
+        self.wave = 0
+        self.todo = collections.deque(self.waves[0])
+        # WAVE_INDEX[item] -> index of the wave of item
+        self.wave_index = {}
+        for index, wave in enumerate(self.waves):
+            for item in wave:
+                self.wave_index[item] = index
+        self.done_count = 0
+        self.ok_count = 0
+
+        # RUNNING[group] -> number of nodes of group now running
+        self.running = {}
+        # LIMITED[item] -> list of limited groups of item
+        self.limited = {}
+
+        self.next_start = 0.0
+        # seconds until the next node may start, or None if waiting
+        # for nodes to finish
+        self.wait = None
+        self.stopped = False
+
+        if len(self.waves) > 1:
+            self._wave_message()
+
+    def _wave_message(self):
+        '''tell which wave is starting'''
+
+        verbose('starting wave %d of %d: %d nodes' %
+                (self.wave + 1, len(self.waves), len(self.waves[self.wave])))
+
+    def pending(self):
+        '''Returns True if there is work left to start'''
+
+        if self.stopped:
+            return False
+
+        return bool(self.todo) or self.wave < len(self.waves) - 1
+
+    def _groups(self, item):
+        '''Returns list of limited groups of item'''
+
+        if not item in self.limited:
+            groups = synctool.config.get_groups(self.nodename_of(item))
+            self.limited[item] = [g for g in groups if g in GROUP_LIMITS]
+
+        return self.limited[item]
+
+    def _allowed(self, item):
+        '''Returns True if the group limits allow starting item'''
+
+        for group in self._groups(item):
+            if self.running.get(group, 0) >= GROUP_LIMITS[group]:
+                return False
+
+        return True
+
+    def _succeeded(self):
+        '''Returns True if enough nodes of the current wave succeeded'''
+
+        return (self.ok_count * 100 >=
+                WAVE_SUCCESS * len(self.waves[self.wave]))
+
+    def _passed(self):
+        '''Returns True if the next wave may start'''
+
+        if WAVE_SUCCESS is not None:
+            return self._succeeded()
+
+        return self.done_count >= len(self.waves[self.wave])
+
+    def next(self):
+        '''Returns next item to start, or None if none can start now'''
+
+        self.wait = None
+        if self.stopped:
+            return None
+
+        now = time.time()
+        if now < self.next_start:
+            self.wait = self.next_start - now
+            return None
+
+        if (not self.todo and self.wave < len(self.waves) - 1 and
+                self._passed()):
+            self.wave += 1
+            self.todo.extend(self.waves[self.wave])
+            self.done_count = self.ok_count = 0
+            self._wave_message()
+
+        if GROUP_LIMITS:
+            for item in self.todo:
+                if self._allowed(item):
+                    self.todo.remove(item)
+                    break
+            else:
+                return None
+        elif self.todo:
+            item = self.todo.popleft()
+        else:
+            return None
+
+        for group in self._groups(item):
+            self.running[group] = self.running.get(group, 0) + 1
+
+        if START_RATE > 0:
+            self.next_start = now + 1.0 / START_RATE
+
+        return item
+
+    def done(self, item, returncode):
+        '''item is done; returncode is 0 if it went well'''
+
+        for group in self._groups(item):
+            self.running[group] -= 1
+
+        if synctool.param.SLEEP_TIME > 0:
+            self.next_start = max(self.next_start,
+                                  time.time() + synctool.param.SLEEP_TIME)
+
+        if self.wave_index[item] != self.wave:
+            # an item of an earlier wave that already passed
+            return
+
+        self.done_count += 1
+        if returncode == 0:
+            self.ok_count += 1
+
+        size = len(self.waves[self.wave])
+        if (WAVE_SUCCESS is not None and self.done_count >= size and
+                self.wave < len(self.waves) - 1 and not self._succeeded()):
+            stderr('error: only %d of %d nodes in wave %d succeeded; '
+                   'not starting the next wave' %
+                   (self.ok_count, size, self.wave + 1))
+            self.stopped = True
+            _stop()
+
+
+# EOB
@@ -0,0 +1,186 @@
+#
+#   synctool.saved.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''index of the backup copies made by synctool
+
+    Every backup copy that synctool makes is recorded in an index file
+    under the state directory: the time it was made, the destination
+    path, and the path of the backup. --erase-saved works from this
+    index, so it does not have to look for a .saved file next to every
+    entry of the overlay tree.
+    Backups are named path.saved, next to the original. If backup_dir
+    is set, they go into that directory instead, under the full path of
+    the original with the time appended, so that several backups of the
+    same path can be kept.
+    A backup is added to the index as soon as it is made, so that a run
+    that is killed halfway does not leave backups that are not in it.
+'''
+
+import os
+import time
+import errno
+
+from synctool.lib import verbose, stderr
+import synctool.lib
+import synctool.param
+
+INDEX_FILE = 'saved'
+
+# the first line of a complete index; an index without it was started
+# by a run that made backups, and there may be older backups not in it
+INDEX_MAGIC = '# synctool backup index'
+
+
+def _index_filename():
+    '''Returns full path to the index file'''
+
+    return os.path.join(synctool.param.STATE_DIR, INDEX_FILE)
+
+
+def backup_path(path):
+    '''Returns path for a new backup copy of path'''
+
+    if not synctool.param.BACKUP_DIR:
+        return path + '.saved'
+
+    return '%s.saved.%s' % (os.path.join(synctool.param.BACKUP_DIR,
+                                         path.lstrip(os.sep)),
+                            time.strftime('%Y%m%d%H%M%S'))
+
+
+def save_with(func, path):
+    '''make backup copy of path with func(path, backup), which is
+    os.rename or os.link
+    Returns the backup path
+    Raises OSError on error'''
+
+    backup = backup_path(path)
+
+    if synctool.param.BACKUP_DIR:
+        synctool.lib.mkdir_p(os.path.dirname(backup))
+        try:
+            func(path, backup)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+
+            # backup_dir is on another filesystem
+            verbose('can not save %s in %s: %s' %
+                    (path, synctool.param.BACKUP_DIR, err.strerror))
+            backup = path + '.saved'
+            func(path, backup)
+    else:
+        func(path, backup)
+
+    _append(int(time.time()), path, backup)
+    return backup
+
+
+def _append(made, path, backup):
+    '''add a backup to the index'''
+
+    if synctool.lib.DRY_RUN:
+        return
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return
+
+    filename = _index_filename()
+    try:
+        with open(filename, 'a') as f:
+            f.write('%d\t%s\t%s\n' % (made, path, backup))
+    except IOError as err:
+        stderr('failed to write %s: %s' % (filename, err.strerror))
+
+
+def load():
+    '''Returns pair: complete, index
+    where index is a dict of recorded backups:
+    INDEX[backup_path] -> (time, dest_path)'''
+
+    filename = _index_filename()
+    try:
+        f = open(filename)
+    except IOError:
+        return False, {}
+
+    index = {}
+    with f:
+        complete = (f.readline().rstrip('\n') == INDEX_MAGIC)
+        if not complete:
+            f.seek(0)
+
+        for line in f:
+            arr = line.rstrip('\n').split('\t')
+            if len(arr) != 3:
+                continue
+
+            try:
+                index[arr[2]] = (int(arr[0]), arr[1])
+            except ValueError:
+                continue
+
+    return complete, index
+
+
+def _write(index, complete, filename):
+    '''write index to file'''
+
+    with open(filename, 'w') as f:
+        if complete:
+            f.write(INDEX_MAGIC + '\n')
+
+        for backup, (made, path) in index.items():
+            f.write('%d\t%s\t%s\n' % (made, path, backup))
+
+
+def save(index, complete):
+    '''replace the index
+    complete is True if it holds all backups on this node'''
+
+    if synctool.lib.DRY_RUN:
+        return
+
+    if not synctool.lib.mkdir_p(synctool.param.STATE_DIR):
+        return
+
+    filename = _index_filename()
+    tmp_filename = filename + '.tmp'
+    try:
+        _write(index, complete, tmp_filename)
+        os.rename(tmp_filename, filename)
+    except (IOError, OSError) as err:
+        stderr('failed to write %s: %s' % (filename, err.strerror))
+
+
+def expired(index, keep, older_than):
+    '''Returns list of backup paths in index that may be erased:
+    all but the newest 'keep' backups of each path,
+    and only those older than 'older_than' seconds'''
+
+    deadline = time.time() - older_than
+
+    by_path = {}
+    for backup, (made, path) in index.items():
+        if not path in by_path:
+            by_path[path] = []
+        by_path[path].append((made, backup))
+
+    erase = []
+    for path in sorted(by_path):
+        backups = sorted(by_path[path], reverse=True)
+        for made, backup in backups[keep:]:
+            if made <= deadline:
+                erase.append(backup)
+
+    return erase
+
+
+# EOB
@@ -18,6 +18,11 @@ import errno
 
 from synctool.lib import stderr
 
+# names of uids and gids, looked up only once per run
+# (or per pass of synctool-watch; see forget_names())
+UID_NAMES = {}
+GID_NAMES = {}
+
 
 class SyncStat(object):
     '''structure to hold the relevant fields of a stat() buf'''
@@ -27,12 +32,18 @@ class SyncStat(object):
     # However it may be possible that the Python object takes more
     # But then again, this object should take less than the posix.stat_result
     # Python object
-    # Also note how I left device files (major, minor) out, they are so rare
-    # that they get special treatment in object.py
+    # rdev is kept for device files, so they need not be stat'ed again
+    # dev, ino, mtime and ctime are kept for the digest cache
+    # There is no per-instance __dict__; with a stat for every entry
+    # in the overlay tree, that adds up
+
+    __slots__ = ('entry_exists', 'mode', 'uid', 'gid', 'size', 'dev', 'ino',
+                 'mtime', 'ctime', 'rdev')
 
     def __init__(self, path = None):
         self.entry_exists = False
         self.mode = self.uid = self.gid = self.size = None
+        self.dev = self.ino = self.mtime = self.ctime = self.rdev = None
 
         self.stat(path)
 
@@ -51,6 +62,7 @@ class SyncStat(object):
         if not path:
             self.entry_exists = False
             self.mode = self.uid = self.gid = self.size = None
+            self.dev = self.ino = self.mtime = self.ctime = self.rdev = None
             return
 
         try:
@@ -66,6 +78,7 @@ class SyncStat(object):
 
             self.entry_exists = False
             self.mode = self.uid = self.gid = self.size = None
+            self.dev = self.ino = self.mtime = self.ctime = self.rdev = None
 
         else:
             self.entry_exists = True
@@ -74,6 +87,11 @@ class SyncStat(object):
             self.uid = statbuf.st_uid
             self.gid = statbuf.st_gid
             self.size = statbuf.st_size
+            self.dev = statbuf.st_dev
+            self.ino = statbuf.st_ino
+            self.mtime = statbuf.st_mtime
+            self.ctime = statbuf.st_ctime
+            self.rdev = statbuf.st_rdev
 
 
     def is_dir(self):
@@ -97,7 +115,7 @@ class SyncStat(object):
 
 
     def is_blockdev(self):
-        return (self.entry_exists and stat.S_ISCHR(self.mode))
+        return (self.entry_exists and stat.S_ISBLK(self.mode))
 
 
     def filetype(self):
@@ -118,14 +136,16 @@ class SyncStat(object):
         if not self.entry_exists:
             return None
 
-        try:
-            entry = pwd.getpwuid(self.uid)
-            return entry[0]
+        name = UID_NAMES.get(self.uid)
+        if name is None:
+            try:
+                name = pwd.getpwuid(self.uid)[0]
+            except KeyError:
+                name = '%d' % self.uid
 
-        except KeyError:
-            pass
+            UID_NAMES[self.uid] = name
 
-        return '%d' % self.uid
+        return name
 
 
     def ascii_gid(self):
@@ -134,13 +154,24 @@ class SyncStat(object):
         if not self.entry_exists:
             return None
 
-        try:
-            entry = grp.getgrgid(self.gid)
-            return entry[0]
+        name = GID_NAMES.get(self.gid)
+        if name is None:
+            try:
+                name = grp.getgrgid(self.gid)[0]
+            except KeyError:
+                name = '%d' % self.gid
+
+            GID_NAMES[self.gid] = name
+
+        return name
+
 
-        except KeyError:
-            pass
+def forget_names():
+    '''forget the names of uids and gids that were looked up
+    A long running process calls this now and then, as users and
+    groups may be renamed'''
 
-        return '%d' % self.gid
+    UID_NAMES.clear()
+    GID_NAMES.clear()
 
 # EOB
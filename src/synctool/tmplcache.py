@@ -0,0 +1,193 @@
+#
+#   synctool.tmplcache.py    WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''cache of generated template output
+
+    The output of a template generator is kept in the state dir,
+    along with a key: a hash of the template, the generator and the
+    environment that the generator sees (SYNCTOOL_NODE, SYNCTOOL_ROOT
+    and the variables listed with 'template_env').
+    When the key is unchanged, the output is copied from the cache
+    rather than running the generator again.
+    There is one cache slot per template output, so a stale output is
+    replaced when the template is generated anew. Slots that have not
+    been used for MAX_AGE days are removed by cleanup().
+'''
+
+import os
+import time
+import errno
+import shutil
+import hashlib
+
+from synctool.lib import verbose, stderr
+import synctool.lib
+import synctool.param
+
+# remove cache entries that were not used for this many days
+MAX_AGE = 30
+
+# size for doing I/O while checksumming files
+IO_SIZE = 16 * 1024
+
+
+def _cache_dir():
+    '''Returns path to the template cache dir'''
+
+    return os.path.join(synctool.param.STATE_DIR, 'templates')
+
+
+def _slot(newname):
+    '''Returns path to cache slot for template output'''
+
+    return os.path.join(_cache_dir(), hashlib.md5(newname).hexdigest())
+
+
+def _hash_file(checksum, path):
+    '''add contents of file to checksum
+    Raises IOError on error'''
+
+    with open(path, 'rb') as f:
+        while True:
+            data = f.read(IO_SIZE)
+            if not data:
+                break
+
+            checksum.update(data)
+
+
+def make_key(template, generator, newname):
+    '''Returns key for the inputs of the template generator
+    or None on error'''
+
+    checksum = hashlib.md5()
+    checksum.update('%s\0%s\0%s\0' % (template, generator, newname))
+
+    try:
+        _hash_file(checksum, template)
+        checksum.update('\0')
+        _hash_file(checksum, generator)
+    except IOError as err:
+        verbose('not caching template %s: %s' % (template, err.strerror))
+        return None
+
+    env_vars = ['SYNCTOOL_NODE', 'SYNCTOOL_ROOT'] + synctool.param.TEMPLATE_ENV
+    for var in env_vars:
+        checksum.update('\0%s=%s' % (var, os.environ.get(var, '')))
+
+    return checksum.hexdigest()
+
+
+def restore(key, newname):
+    '''copy cached output to newname
+    Returns True on success, False if not in the cache'''
+
+    slot = _slot(newname)
+
+    try:
+        with open(slot + '.key') as f:
+            cached_key = f.read().strip()
+    except IOError:
+        return False
+
+    if cached_key != key:
+        verbose('template output %s is out of date' % newname)
+        return False
+
+    try:
+        shutil.copy2(slot, newname)
+        statbuf = os.stat(slot)
+        os.chown(newname, statbuf.st_uid, statbuf.st_gid)
+    except (IOError, OSError) as err:
+        stderr('failed to restore %s from template cache: %s' %
+               (newname, err.strerror))
+        try:
+            os.unlink(newname)
+        except OSError:
+            pass
+        return False
+
+    # mark the slot as used
+    try:
+        os.utime(slot + '.key', None)
+    except OSError:
+        pass
+
+    return True
+
+
+def store(key, newname):
+    '''put generated output into the cache'''
+
+    try:
+        statbuf = os.lstat(newname)
+    except OSError:
+        return
+
+    if not synctool.lib.mkdir_p(_cache_dir()):
+        return
+
+    slot = _slot(newname)
+
+    try:
+        # invalidate the slot before changing the output
+        if os.path.exists(slot + '.key'):
+            os.unlink(slot + '.key')
+
+        if not os.path.isfile(newname):
+            # can only cache regular files
+            return
+
+        shutil.copy2(newname, slot)
+        os.chown(slot, statbuf.st_uid, statbuf.st_gid)
+
+        with open(slot + '.key', 'w') as f:
+            f.write(key + '\n')
+
+    except (IOError, OSError) as err:
+        stderr('failed to store %s in template cache: %s' %
+               (newname, err.strerror))
+
+
+def cleanup():
+    '''remove cache slots that were not used for a while'''
+
+    cache_dir = _cache_dir()
+    try:
+        entries = os.listdir(cache_dir)
+    except OSError:
+        return
+
+    too_old = time.time() - MAX_AGE * 24 * 3600
+
+    for entry in entries:
+        if entry.endswith('.key'):
+            continue
+
+        slot = os.path.join(cache_dir, entry)
+        try:
+            statbuf = os.stat(slot + '.key')
+        except OSError as err:
+            if err.errno != errno.ENOENT:
+                continue
+
+            # no key; the output is of no use
+            statbuf = None
+
+        if statbuf is None or statbuf.st_mtime < too_old:
+            verbose('removing %s from template cache' % entry)
+            for path in (slot + '.key', slot):
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
+
+
+# EOB
@@ -21,6 +21,7 @@ import synctool.lib
 from synctool.lib import verbose, stdout, stderr, terse, unix_out, prettypath
 import synctool.overlay
 import synctool.param
+from synctool.pathset import PathSet
 
 # UploadFile object, used in callback function for overlay.visit()
 GLOBAL_UPLOAD_FILE = None
@@ -216,7 +217,8 @@ def upload(up):
     # see if file is already in the repository
     # Note: ugly global is needed because of callback function
     GLOBAL_UPLOAD_FILE = up
-    synctool.overlay.visit(synctool.param.OVERLAY_DIR, _upload_callback)
+    synctool.overlay.visit_paths(synctool.param.OVERLAY_DIR,
+                                 PathSet([up.filename]), _upload_callback)
     up = GLOBAL_UPLOAD_FILE
 
     synctool.param.NODENAME = orig_nodename
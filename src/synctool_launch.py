@@ -23,7 +23,8 @@ LAUNCH = {
     'synctool-config' : 'synctool_config.py',
     'synctool-client' : 'synctool_client.py',
     'synctool-client-pkg' : 'synctool_client_pkg.py',
-    'synctool-template' : 'synctool_template.py'
+    'synctool-template' : 'synctool_template.py',
+    'synctool-watch' : 'synctool_watch.py'
 }
 
 
@@ -0,0 +1,19 @@
+#! /usr/bin/env python
+#
+#   synctool-watch  WJ114
+#
+#   synctool Copyright 2014 Walter de Jong <walter@heiho.net>
+#
+#   synctool COMES WITH NO WARRANTY. synctool IS FREE SOFTWARE.
+#   synctool is distributed under terms described in the GNU General Public
+#   License.
+#
+
+'''synctool-watch keeps track of changes on the target node'''
+
+import synctool.main.watch
+
+if __name__ == '__main__':
+    synctool.main.watch.main()
+
+# EOB